@@ -6,7 +6,12 @@ from beclab.wavefunction import (
     WavefunctionSet, REPR_CLASSICAL, REPR_POSITIVE_P, REPR_WIGNER)
 from beclab.samplers import *
 from beclab.bec import (
-    HarmonicPotential, System, Integrator,
-    box_for_tf, ThomasFermiGroundState, ImaginaryTimeGroundState)
+    HarmonicPotential, ArrayPotential, System, Integrator, ChunkedIntegrator, warm_up,
+    box_for_tf, ThomasFermiGroundState, ImaginaryTimeGroundState, MultigridGroundState)
+from beclab.gradient import GradientGroundState
+from beclab.parameters import SystemParameters
+from beclab.ramps import Ramp
+from beclab.parallel import ParallelIntegrator
+from beclab.checkpoint import CheckpointedIntegrator
 from beclab.beam_splitter import BeamSplitter
 from beclab.cutoff import WavelengthCutoff
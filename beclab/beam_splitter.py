@@ -1,9 +1,11 @@
 import numpy
 
 from reikna.cluda import dtypes, functions
-from reikna.core import Computation, Parameter, Annotation, Type
+from reikna.core import Computation, Parameter, Annotation, Type, Transformation
 from reikna.algorithms import PureParallel
 
+from beclab.cache import compile_cached
+
 
 def get_splitter(state_arr, comp1, comp2):
     real_dtype = dtypes.real_for(state_arr.dtype)
@@ -61,6 +63,63 @@ def get_splitter(state_arr, comp1, comp2):
             mul_sr=functions.mul(state_arr.dtype, real_dtype)))
 
 
+def get_splitter_trf(state_arr, comp1, comp2):
+    real_dtype = dtypes.real_for(state_arr.dtype)
+    trajectories = state_arr.shape[0]
+    return Transformation(
+        [
+            Parameter('output', Annotation(state_arr, 'o')),
+            Parameter('input', Annotation(state_arr, 'i')),
+            Parameter('thetas', Annotation(Type(real_dtype, trajectories), 'i')),
+            Parameter('phis', Annotation(Type(real_dtype, trajectories), 'i'))],
+        """
+        <%
+            trajectory = idxs[0]
+            component = idxs[1]
+            coords = ", ".join(idxs[2:])
+            r_ctype = dtypes.ctype(dtypes.real_for(output.dtype))
+        %>
+        const ${output.ctype} psi_${comp1} = ${input.load_idx}(${trajectory}, ${comp1}, ${coords});
+        const ${output.ctype} psi_${comp2} = ${input.load_idx}(${trajectory}, ${comp2}, ${coords});
+
+        const ${thetas.ctype} theta = ${thetas.load_idx}(${trajectory});
+        const ${phis.ctype} phi = ${phis.load_idx}(${trajectory});
+
+        ${r_ctype} sin_half_theta = sin(theta / 2);
+        ${r_ctype} cos_half_theta = cos(theta / 2);
+
+        ${output.ctype} minus_i = COMPLEX_CTR(${output.ctype})(0, -1);
+
+        ${output.ctype} psi;
+        if (${component} == ${comp1})
+        {
+            ${output.ctype} k2 = ${mul_sr}(
+                ${mul_ss}(minus_i, ${polar_unit}(-phi)),
+                sin_half_theta);
+            psi = ${mul_sr}(psi_${comp1}, cos_half_theta) + ${mul_ss}(psi_${comp2}, k2);
+        }
+        else if (${component} == ${comp2})
+        {
+            ${output.ctype} k3 = ${mul_sr}(
+                ${mul_ss}(minus_i, ${polar_unit}(phi)),
+                sin_half_theta);
+            psi = ${mul_ss}(psi_${comp1}, k3) + ${mul_sr}(psi_${comp2}, cos_half_theta);
+        }
+        else
+        {
+            psi = ${input.load_same};
+        }
+
+        ${output.store_same}(psi);
+        """,
+        render_kwds=dict(
+            comp1=comp1,
+            comp2=comp2,
+            polar_unit=functions.polar_unit(real_dtype),
+            mul_ss=functions.mul(state_arr.dtype, state_arr.dtype),
+            mul_sr=functions.mul(state_arr.dtype, real_dtype)))
+
+
 class BeamSplitterMatrix(Computation):
 
     def __init__(self, state_arr, comp1, comp2):
@@ -110,6 +169,10 @@ class BeamSplitter:
     :param f_rabi: Rabi frequency :math:`\Omega` of the oscillator.
         Connected to the time of the pulse as :math:`\theta = \Omega t_{\mathrm{pulse}}`.
     :param seed: RNG seed for calls with ``theta_noise > 0``.
+
+    .. py:attribute:: components
+
+        A tuple ``(comp1_num, comp2_num)`` of the affected components.
     """
 
     def __init__(self, wfs_meta, comp1_num=0, comp2_num=1,
@@ -119,24 +182,45 @@ class BeamSplitter:
         self._starting_phase = starting_phase
         self._detuning = 2 * numpy.pi * f_detuning
         self._f_rabi = f_rabi
+        self.components = (comp1_num, comp2_num)
         self._trajectories = wfs_meta.trajectories
         self._thread = wfs_meta.thread
         self._real_dtype = dtypes.real_for(wfs_meta.dtype)
-        self._splitter = BeamSplitterMatrix(
-            wfs_meta.data, comp1_num, comp2_num).compile(wfs_meta.thread)
+        self._splitter = compile_cached(
+            wfs_meta.thread, BeamSplitterMatrix, wfs_meta.data, comp1_num, comp2_num)
 
-    def __call__(self, wfs_data, t, theta, theta_noise=0, phi_noise=0):
-        r"""
-        Applies beam splitter to an on-device wavefunction array.
+    def get_transformation(self, state_arr):
+        """
+        Returns a Reikna ``Transformation`` object with the parameters
+        ``(output, input, thetas, phis)`` applying the beam splitter to ``input``
+        (an array with the same shape and dtype as ``wfs_meta.data``).
+        It can be connected to an input of a computation to measure the rotated wavefunction
+        without modifying the original one.
+        ``thetas`` and ``phis`` are the arrays of per-trajectory angles
+        returned by :py:meth:`get_angles`.
+        """
+        return get_splitter_trf(state_arr, *self.components)
 
-        :param wfs_data: a Reikna ``Array`` (with the same dtype and shape as ``wfs_meta.data``).
-        :param t: time of application (affects the total phase :math:`\phi`).
-        :param theta: rotation angle :math:`\theta`, in radians.
-        :param theta_noise: standard deviation of :math:`\theta` values for different trajectories.
-        :param phi_noise: standard deviation of :math:`\phi` values for different trajectories.
+    def get_state(self):
+        """
+        Returns the state of the noise RNG
+        (a tuple that can be passed to :py:meth:`set_state`).
+        """
+        return self._rng.get_state()
+
+    def set_state(self, state):
+        """
+        Restores the state of the noise RNG saved with :py:meth:`get_state`.
+        """
+        self._rng.set_state(state)
+
+    def get_angles(self, t, theta, theta_noise=0, phi_noise=0):
+        """
+        Returns a tuple ``(thetas, phis)`` of Reikna arrays with per-trajectory angles
+        of the rotation.
+        The parameters have the same meaning as in :py:meth:`__call__`.
         """
         phi = t * self._detuning + self._starting_phase
-        t_pulse = (theta / numpy.pi / 2.0) / self._f_rabi
 
         # TODO: use GPU RNG?
         if phi_noise > 0.0:
@@ -152,5 +236,20 @@ class BeamSplitter:
         thetas = self._thread.to_device(thetas.astype(self._real_dtype))
         phis = self._thread.to_device(phis.astype(self._real_dtype))
 
+        return thetas, phis
+
+    def __call__(self, wfs_data, t, theta, theta_noise=0, phi_noise=0):
+        r"""
+        Applies beam splitter to an on-device wavefunction array.
+
+        :param wfs_data: a Reikna ``Array`` (with the same dtype and shape as ``wfs_meta.data``).
+        :param t: time of application (affects the total phase :math:`\phi`).
+        :param theta: rotation angle :math:`\theta`, in radians.
+        :param theta_noise: standard deviation of :math:`\theta` values for different trajectories.
+        :param phi_noise: standard deviation of :math:`\phi` values for different trajectories.
+        """
+        t_pulse = (theta / numpy.pi / 2.0) / self._f_rabi
+        thetas, phis = self.get_angles(
+            t, theta, theta_noise=theta_noise, phi_noise=phi_noise)
         self._splitter(wfs_data, wfs_data, thetas, phis)
         return t + t_pulse
@@ -1,22 +1,43 @@
+import os
+import glob
+
 import numpy
 
-from reikna.cluda import Module
+from reikna.cluda import Module, functions
+import reikna.cluda.dtypes as dtypes
+from reikna.core import Computation, Parameter, Annotation, Type
+from reikna.algorithms import PureParallel
+from reikna.fft import FFT
 import reiknacontrib.integrator as integrator
 from reiknacontrib.integrator import RK46NLStepper, Wiener
 
 import beclab.constants as const
-from beclab.modules import get_drift, get_diffusion
-from beclab.wavefunction import WavefunctionSet, WavefunctionSetMetadata, REPR_WIGNER
-from beclab.samplers import EnergySampler, StoppingEnergySampler
-from beclab.filters import NormalizationFilter
+from beclab.modules import get_drift, get_diffusion, get_packed_real_drift
+from beclab.wavefunction import (
+    WavefunctionSet, WavefunctionSetMetadata, WignerCoherent,
+    REPR_CLASSICAL, REPR_WIGNER, get_wigner_corrections, trf_mask)
+from beclab.samplers import (
+    ConvergenceSampler, UnpackingSampler, finalize_results, release_samplers)
+from beclab.filters import NormalizationFilter, FreezeFilter, PackedNormalizationFilter
+from beclab.packing import (
+    get_pack, get_unpack, get_packed_meta, get_packing_axis, PACK_TRAJECTORIES)
 from beclab.cutoff import WavelengthCutoff
+from beclab.grid import UniformGrid
+from beclab.cache import cached, compile_cached, stable_hash
 
 
 class Potential:
     """
     Abstract base class of an external potential.
+
+    .. py:attribute:: tabulated
+
+        If ``True``, the values returned by :py:meth:`get_array` are time-independent,
+        and meters read them from a device array instead of calling the module functions.
     """
 
+    tabulated = False
+
     def get_module(self, dtype, grid, components):
         """
         Returns the module calculating the value of the potential.
@@ -56,20 +77,37 @@ class HarmonicPotential(Potential):
     :param displacements: a list of tuples ``(component, dimension, displacement)``,
         specifying the displacement :math:`l_{i,d}` for the given component :math:`i`
         and the dimension :math:`d`.
+    :param frequency_ramps: a dictionary ``{dimension: ramp}`` of
+        :py:class:`~beclab.Ramp` objects with time-dependent trap frequencies (in Hz),
+        replacing the corresponding elements of ``freqs``.
+    :param displacement_ramps: a list of tuples ``(component, dimension, ramp)``
+        with :py:class:`~beclab.Ramp` objects specifying time-dependent displacements
+        (added to the ones from ``displacements``).
+
+    :py:meth:`get_array` and the functions of the module at ``t = 0``
+    use the values of the ramps at ``t = 0``;
+    :py:func:`box_for_tf` and the Thomas-Fermi ground state use ``freqs``.
     """
 
-    def __init__(self, freqs, displacements=None):
+    def __init__(self, freqs, displacements=None,
+            frequency_ramps=None, displacement_ramps=None):
         if not isinstance(freqs, tuple):
             raise NotImplementedError
 
         self.trap_frequencies = freqs
         self.displacements = displacements
-
-    def _get_coeffs(self, grid, components):
+        self.frequency_ramps = {} if frequency_ramps is None else frequency_ramps
+        self.displacement_ramps = [] if displacement_ramps is None else displacement_ramps
+
+    def _get_coeffs(self, grid, components, t=None):
+        freqs = [
+            self.frequency_ramps[dim](t)
+                if t is not None and dim in self.frequency_ramps else freq
+            for dim, freq in enumerate(self.trap_frequencies)]
         return numpy.array([
             [
                 components[comp_num].m * (2 * numpy.pi * freq) ** 2 / 2
-                for freq in self.trap_frequencies]
+                for freq in freqs]
             for comp_num in range(len(components))])
 
     def get_module(self, dtype, grid, components):
@@ -79,6 +117,15 @@ class HarmonicPotential(Potential):
         else:
             displacements = self.displacements
 
+        real_dtype = dtypes.real_for(dtype)
+        frequency_ramps = [
+            self.frequency_ramps[dim].get_module(real_dtype)
+                if dim in self.frequency_ramps else None
+            for dim in range(grid.dimensions)]
+        displacement_ramps = [
+            (dcomp, ddim, ramp.get_module(real_dtype))
+            for dcomp, ddim, ramp in self.displacement_ramps]
+
         return Module.create(
             """
             <%
@@ -104,9 +151,25 @@ class HarmonicPotential(Potential):
                 %endif
                 %endfor
 
+                %for dcomp, ddim, ramp in displacement_ramps:
+                %if comp_num == dcomp:
+                x_${ddim} += ${ramp}(t);
+                %endif
+                %endfor
+
+                %for dim in range(grid.dimensions):
+                %if frequency_ramps[dim] is not None:
+                const ${r_ctype} f_${dim} = ${frequency_ramps[dim]}(t);
+                const ${r_ctype} coeff_${dim} =
+                    ${r_const(frequency_coeffs[comp_num])} * f_${dim} * f_${dim};
+                %else:
+                const ${r_ctype} coeff_${dim} = ${r_const(coeffs[comp_num, dim])};
+                %endif
+                %endfor
+
                 return
                     %for dim in range(grid.dimensions):
-                    + ${r_const(coeffs[comp_num, dim])} * x_${dim} * x_${dim}
+                    + coeff_${dim} * x_${dim} * x_${dim}
                     %endfor
                     ;
             }
@@ -115,29 +178,156 @@ class HarmonicPotential(Potential):
             render_kwds=dict(
                 grid=grid,
                 coeffs=self._get_coeffs(grid, components),
+                frequency_coeffs=[
+                    component.m * (2 * numpy.pi) ** 2 / 2 for component in components],
                 displacements=displacements,
+                frequency_ramps=frequency_ramps,
+                displacement_ramps=displacement_ramps,
                 s_dtype=dtype,
                 ))
 
     def get_array(self, grid, components):
-        coeffs = self._get_coeffs(grid, components)
+        coeffs = self._get_coeffs(grid, components, t=0)
 
-        result = numpy.empty((len(components),) + grid.shape)
+        result = numpy.zeros((len(components),) + grid.shape)
         for comp_num in range(len(components)):
 
-            xxs = numpy.meshgrid(*grid.xs, indexing="ij")
+            shifts = [0.] * grid.dimensions
 
             if self.displacements is not None:
                 for dcomp, ddim, value in self.displacements:
                     if dcomp == comp_num:
-                        xxs[ddim] += value
+                        shifts[ddim] += value
+
+            for dcomp, ddim, ramp in self.displacement_ramps:
+                if dcomp == comp_num:
+                    shifts[ddim] += ramp(0)
 
-            result[comp_num] = sum(
-                coeffs[comp_num, dim] * xxs[dim] ** 2 for dim in range(grid.dimensions))
+            # Broadcasting one-dimensional terms instead of creating a full meshgrid
+            for dim in range(grid.dimensions):
+                x = (grid.xs[dim] + shifts[dim]).reshape(
+                    tuple(-1 if d == dim else 1 for d in range(grid.dimensions)))
+                result[comp_num] += coeffs[comp_num, dim] * x ** 2
 
         return result
 
 
+# The minimum size of the constant memory guaranteed by OpenCL and CUDA devices.
+_CONSTANT_MEMORY_SIZE = 64 * 1024
+
+
+def _check_table_size(size, real_dtype):
+    table_size = size * numpy.dtype(real_dtype).itemsize
+    if table_size > _CONSTANT_MEMORY_SIZE:
+        raise ValueError(
+            "The potential table takes {table_size} bytes in {dtype} precision, "
+            "which exceeds the constant memory size ({limit} bytes); "
+            "use a smaller grid or an analytical potential".format(
+                table_size=table_size, dtype=numpy.dtype(real_dtype).name,
+                limit=_CONSTANT_MEMORY_SIZE))
+
+
+class ArrayPotential(Potential):
+    """
+    A time-independent potential defined by its values on the grid.
+    In the drift of integrators (which cannot take array arguments)
+    the values are read from a constant table compiled into the kernel,
+    so the total size of the table must not exceed the constant memory size of the device
+    (64 KB, that is 16384 values in single precision or 8192 in double precision),
+    and creating an integrator for different values requires a new compilation.
+    Meters load them from a device array created once for every meter.
+
+    :param values: a numpy array with the shape ``(components,) + grid.shape``.
+    """
+
+    tabulated = True
+
+    def __init__(self, values):
+        self.values = numpy.asarray(values, numpy.float64)
+        # Checking for the single precision, the smallest table possible;
+        # the double precision is checked in get_module().
+        _check_table_size(self.values.size, numpy.float32)
+
+    @classmethod
+    def tabulate(cls, thread, potential, grid, components, t=0):
+        """
+        Evaluates the module of a :py:class:`Potential` object ``potential``
+        on the device at time ``t`` and returns an :py:class:`ArrayPotential` object
+        with the resulting values.
+        Useful for analytical potentials that are expensive to evaluate.
+
+        :param thread: a Reikna ``Thread`` object.
+        :param grid: a :py:class:`~beclab.grid.Grid` object.
+        :param components: a list of :py:class:`~beclab.constants.Component` objects.
+        """
+        # Using the double precision, since the tabulation happens only once.
+        real_dtype = numpy.float64
+        module = potential.get_module(numpy.complex128, grid, components)
+        comp = PureParallel(
+            [Parameter('output', Annotation(
+                Type(real_dtype, (len(components),) + grid.shape), 'o'))],
+            """
+            <%
+                coords = ", ".join(idxs[1:])
+            %>
+            %for comp in range(components):
+            if (${idxs[0]} == ${comp})
+                ${output.store_same}(${potential}${comp}(${coords}, ${r_const(t)}));
+            %endfor
+            """,
+            render_kwds=dict(
+                components=len(components),
+                potential=module,
+                r_const=lambda x: dtypes.c_constant(x, real_dtype),
+                t=t))
+
+        comp_c = comp.compile(thread)
+        output = thread.empty_like(comp_c.parameter.output)
+        comp_c(output)
+        return cls(output.get())
+
+    def get_module(self, dtype, grid, components):
+        assert self.values.shape == (len(components),) + grid.shape
+
+        real_dtype = dtypes.real_for(dtype)
+        _check_table_size(self.values.size, real_dtype)
+        return Module.create(
+            """
+            <%
+                r_ctype = dtypes.ctype(r_dtype)
+            %>
+            CONSTANT_MEM ${r_ctype} ${prefix}values[${values.size}] = {${table}};
+
+            %for comp_num in range(values.shape[0]):
+            INLINE WITHIN_KERNEL ${r_ctype} ${prefix}${comp_num}(
+                %for dim in range(grid.dimensions):
+                const int idx_${dim},
+                %endfor
+                ${r_ctype} t)
+            {
+                return ${prefix}values[
+                    ${comp_num * grid.size}
+                    %for dim in range(grid.dimensions):
+                    + idx_${dim} * ${strides[dim]}
+                    %endfor
+                    ];
+            }
+            %endfor
+            """,
+            render_kwds=dict(
+                grid=grid,
+                values=self.values,
+                strides=[
+                    int(numpy.prod(grid.shape[dim+1:])) for dim in range(grid.dimensions)],
+                table=", ".join(
+                    dtypes.c_constant(value, real_dtype) for value in self.values.flat),
+                r_dtype=real_dtype))
+
+    def get_array(self, grid, components):
+        assert self.values.shape == (len(components),) + grid.shape
+        return self.values.copy()
+
+
 class System:
     r"""
     Main descriptor of a BEC system with the Hamiltonian
@@ -177,22 +367,53 @@ class System:
         ``0``...``components-1`` (corresponding to the subscript index)
         that will be passed ``psi_0,..., psi_C, t``,
         and their return values added to the equation of the corresponding component.
+    :param interaction_ramps: a dictionary ``{(j, k): ramp}`` of :py:class:`~beclab.Ramp`
+        objects with time-dependent values of :math:`U_{jk}`
+        (also used for :math:`U_{kj}`, unless given separately).
+    :param loss_ramps: a dictionary ``{loss_number: ramp}`` of :py:class:`~beclab.Ramp`
+        objects with time-dependent values of :math:`\kappa_{\mathbf{l}}`
+        for the elements of ``losses``.
+
+    The ramps are used by the drift of :py:class:`Integrator` (which is passed the current time)
+    and by the meters (which are passed the time of the measurement).
+    Ground states are calculated for the values at ``t = 0``
+    (see :py:meth:`get_interactions`).
     """
 
-    def __init__(self, components, interactions, losses=None, potential=None, linear_terms=None):
+    def __init__(self, components, interactions, losses=None, potential=None, linear_terms=None,
+            interaction_ramps=None, loss_ramps=None):
 
         self.potential = potential
         self.components = components
         self.interactions = interactions
         self.linear_terms = linear_terms
+        self.interaction_ramps = {} if interaction_ramps is None else interaction_ramps
 
         if losses is None or len(losses) == 0:
             self.losses = None
+            if loss_ramps:
+                raise ValueError("Loss ramps are given, but no losses are specified")
         else:
             self.losses = losses
 
+        self.loss_ramps = {} if loss_ramps is None else loss_ramps
+
         self.kinetic_coeff = -const.HBAR ** 2 / (2 * components[0].m)
 
+    def get_interactions(self, t=0):
+        """
+        Returns a numpy array with the interaction coefficients :math:`U_{jk}` at time ``t``
+        (the values of ``interaction_ramps`` replacing the corresponding elements
+        of ``interactions``).
+        """
+        interactions = numpy.array(self.interactions, numpy.float64)
+        for (comp1, comp2), ramp in self.interaction_ramps.items():
+            value = float(ramp(t))
+            interactions[comp1, comp2] = value
+            if (comp2, comp1) not in self.interaction_ramps:
+                interactions[comp2, comp1] = value
+        return interactions
+
 
 def box_for_tf(system, comp_num, N, pad=1.2):
     """
@@ -202,7 +423,7 @@ def box_for_tf(system, comp_num, N, pad=1.2):
     dims = len(system.potential.trap_frequencies)
     assert dims in (1, 3)
     m = system.components[comp_num].m
-    g = system.interactions[comp_num, comp_num]
+    g = system.get_interactions(0)[comp_num, comp_num]
     mu = (const.mu_tf_3d if dims == 3 else const.mu_tf_1d)(
         system.potential.trap_frequencies, N, m, g)
     diameter = lambda f: (
@@ -210,15 +431,97 @@ def box_for_tf(system, comp_num, N, pad=1.2):
     return tuple(diameter(f) for f in system.potential.trap_frequencies)
 
 
+def get_thomas_fermi_profile(wfs_meta, system, mus_arr):
+    """
+    Returns a computation calculating the Thomas-Fermi profile
+    ``sqrt(max(mu_j - V_j, 0) / g_jj)`` for each component
+    with the chemical potentials taken from ``mus``
+    (an array with the shape ``(trajectories, components)``).
+    """
+    real_dtype = dtypes.real_for(wfs_meta.dtype)
+    return PureParallel(
+        [
+            Parameter('output', Annotation(wfs_meta.data, 'o')),
+            Parameter('mus', Annotation(mus_arr, 'i'))],
+        """
+        <%
+            r_ctype = dtypes.ctype(r_dtype)
+            r_const = lambda x: dtypes.c_constant(x, r_dtype)
+            coords = ", ".join(idxs[2:])
+        %>
+        ${output.ctype} psi = ${dtypes.c_constant(0, output.dtype)};
+        %for comp in range(components):
+        if (${idxs[1]} == ${comp})
+        {
+            const ${r_ctype} V = ${potential}${comp}(${coords}, 0);
+            const ${r_ctype} n =
+                (${mus.load_idx}(${idxs[0]}, ${comp}) - V) / ${r_const(gs[comp])};
+            psi = COMPLEX_CTR(${output.ctype})(n > 0 ? sqrt(n) : 0, 0);
+        }
+        %endfor
+        ${output.store_same}(psi);
+        """,
+        guiding_array='output',
+        render_kwds=dict(
+            components=wfs_meta.components,
+            potential=system.potential.get_module(
+                wfs_meta.dtype, wfs_meta.grid, system.components),
+            gs=numpy.diag(system.get_interactions(0)),
+            r_dtype=real_dtype))
+
+
+class _ThomasFermi(Computation):
+    """
+    Fills the wavefunction with the Thomas-Fermi profile for the given chemical potentials
+    and projects it on the modes inside the cutoff (if the wavefunction has one).
+    """
+
+    def __init__(self, wfs_meta, system):
+        mus_arr = Type(
+            dtypes.real_for(wfs_meta.dtype), (wfs_meta.trajectories, wfs_meta.components))
+        self._profile = get_thomas_fermi_profile(wfs_meta, system, mus_arr)
+
+        self._cutoff = wfs_meta.cutoff
+        if self._cutoff is not None:
+            axes = range(2, len(wfs_meta.shape))
+            self._cutoff_mask = self._cutoff.get_mask(wfs_meta.grid)
+            self._fft = FFT(wfs_meta.data, axes=axes)
+            self._fft_masked = FFT(wfs_meta.data, axes=axes)
+            mask = trf_mask(wfs_meta.data, self._cutoff_mask)
+            self._fft_masked.parameter.output.connect(
+                mask, mask.input, masked_output=mask.output, mask=mask.mask)
+
+        Computation.__init__(self, [
+            Parameter('output', Annotation(wfs_meta.data, 'o')),
+            Parameter('mus', Annotation(mus_arr, 'i'))])
+
+    def _build_plan(self, plan_factory, device_params, output, mus):
+        plan = plan_factory()
+        plan.computation_call(self._profile, output, mus)
+
+        if self._cutoff is not None:
+            mask_device = plan.persistent_array(self._cutoff_mask)
+            spectrum = plan.temp_array_like(output)
+            plan.computation_call(
+                self._fft_masked, masked_output=spectrum, mask=mask_device, input=output)
+            plan.computation_call(self._fft, output, spectrum, inverse=True)
+
+        return plan
+
+
 class ThomasFermiGroundState:
     """
     Thomas-Fermi ground state generator.
+    The profile, the cutoff projection and the renormalization are performed on the device,
+    so only the populations and the chemical potentials are transferred from the host.
 
     :param thr: a Reikna ``Thread``.
     :param dtype: the dtype of the generated wavefunction
     :param grid: a :py:class:`~beclab.grid.Grid` object.
     :param system: a :py:class:`System` object.
     :param cutoff: a :py:class:`~beclab.cutoff.Cutoff` object.
+    :param accumulation_dtype: the real dtype used for reductions
+        (see :py:class:`~beclab.wavefunction.WavefunctionSetMetadata`).
 
     .. py:attribute:: wfs_meta
 
@@ -226,7 +529,7 @@ class ThomasFermiGroundState:
         the generated states.
     """
 
-    def __init__(self, thr, dtype, grid, system, cutoff=None):
+    def __init__(self, thr, dtype, grid, system, cutoff=None, accumulation_dtype=None):
 
         if grid.dimensions not in (1, 3):
             raise NotImplementedError()
@@ -238,7 +541,26 @@ class ThomasFermiGroundState:
 
         self.wfs_meta = WavefunctionSetMetadata(
             thr, dtype, grid, components=len(self.system.components),
-            cutoff=cutoff)
+            cutoff=cutoff, accumulation_dtype=accumulation_dtype)
+        self._tf = compile_cached(thr, _ThomasFermi, self.wfs_meta, system)
+
+    def _get_mus(self, Ns):
+        gs = numpy.diag(self.system.get_interactions(0))
+        return numpy.array([
+            (const.mu_tf_3d if self.grid.dimensions == 3 else const.mu_tf_1d)(
+                self.system.potential.trap_frequencies, N, component.m, gs[i])
+                if N > 0 else 0
+            for i, (component, N) in enumerate(zip(self.system.components, Ns))])
+
+    def _generate(self, wfs, tf, Ns_arr):
+        mus = numpy.array([self._get_mus(Ns) for Ns in Ns_arr])
+        tf(wfs.data, self.thr.to_device(mus.astype(tf.parameter.mus.dtype)))
+
+        # renormalize to account for coarse grids or a cutoff
+        # (also zeroes the components with N == 0)
+        NormalizationFilter(wfs, Ns_arr)(wfs.data, 0)
+
+        return wfs
 
     def __call__(self, Ns):
         """
@@ -251,33 +573,59 @@ class ThomasFermiGroundState:
         assert len(Ns) == len(self.system.components)
 
         wfs = WavefunctionSet.for_meta(self.wfs_meta)
-        psi_TF = numpy.empty(wfs.shape, wfs.dtype)
+        return self._generate(wfs, self._tf, numpy.array([Ns], numpy.float64))
 
-        V = self.system.potential.get_array(self.grid, self.system.components)
+    def batched(self, Ns_list):
+        """
+        Gererate ground states for several sets of populations,
+        one trajectory for each set.
+        Returns a :py:class:`WavefunctionSet` object with ``len(Ns_list)`` trajectories.
+        """
 
-        for i, component in enumerate(self.system.components):
-            N = Ns[i]
+        Ns_arr = numpy.array(Ns_list, numpy.float64)
+        assert Ns_arr.shape[1] == len(self.system.components)
 
-            if N == 0:
-                psi_TF[0, i] = 0
-                continue
+        wfs = WavefunctionSet(
+            self.thr, self.dtype, self.grid,
+            components=self.wfs_meta.components, trajectories=Ns_arr.shape[0],
+            cutoff=self.wfs_meta.cutoff, accumulation_dtype=self.wfs_meta.accumulation_dtype)
+        tf = compile_cached(self.thr, _ThomasFermi, wfs, self.system)
+        return self._generate(wfs, tf, Ns_arr)
 
-            mu = (const.mu_tf_3d if self.grid.dimensions == 3 else const.mu_tf_1d)(
-                self.system.potential.trap_frequencies, N,
-                component.m, self.system.interactions[i, i])
 
-            psi_TF[0, i] = numpy.sqrt((mu - V[i]).clip(0) / self.system.interactions[i, i])
+def _get_imaginary_time_integrator(
+        thr, dtype, grid, system, stepper_cls, cutoff, verbose, trajectories=1,
+        real=False):
 
-            if wfs.cutoff is not None:
-                mask = wfs.cutoff.get_mask(wfs.grid)
-                psi_TF[0, i] = numpy.fft.ifftn(numpy.fft.fftn(psi_TF[0, i]) * mask)
+    if real:
+        wfs_meta = WavefunctionSetMetadata(
+            thr, dtype, grid, components=len(system.components), trajectories=trajectories)
+        drift = get_packed_real_drift(
+            dtype, grid.dimensions, len(system.components),
+            interactions=system.get_interactions(0),
+            potential=system.potential.get_module(dtype, grid, system.components),
+            unitary_coefficient=-1 / const.HBAR,
+            by_trajectories=(get_packing_axis(wfs_meta) == PACK_TRAJECTORIES))
+        trajectories = get_packed_meta(wfs_meta).trajectories
+    else:
+        drift = get_drift(
+            dtype, grid.dimensions, len(system.components),
+            interactions=system.get_interactions(0),
+            potential=system.potential.get_module(dtype, grid, system.components),
+            unitary_coefficient=-1 / const.HBAR)
 
-            # renormalize to account for coarse grids or a cutoff
-            N0 = (numpy.abs(psi_TF[0, i]) ** 2).sum() * self.grid.dV
-            psi_TF[0, i] *= numpy.sqrt(N / N0)
+    if cutoff is None:
+        ksquared_cutoff = None
+    else:
+        ksquared_cutoff = cutoff.ksquared
 
-        wfs.fill_with(psi_TF)
-        return wfs
+    stepper = stepper_cls(
+        grid.shape, grid.box, drift,
+        kinetic_coeffs=-1 / const.HBAR * system.kinetic_coeff,
+        trajectories=trajectories,
+        ksquared_cutoff=ksquared_cutoff)
+
+    return integrator.Integrator(thr, stepper, verbose=verbose)
 
 
 class ImaginaryTimeGroundState:
@@ -291,6 +639,34 @@ class ImaginaryTimeGroundState:
     :param stepper_cls: one of the ``reiknacontrib.integrator.Stepper`` classes.
     :param cutoff: a :py:class:`~beclab.cutoff.Cutoff` object.
     :param verbose: whether do display additional information about the integration process.
+    :param accumulation_dtype: the real dtype used for reductions
+        (see :py:class:`~beclab.wavefunction.WavefunctionSetMetadata`).
+    :param cache_dir: if given, converged ground states are saved in this directory.
+        The files are keyed on the components, interactions and potential of the system,
+        the grid, the cutoff, the dtypes, the stepper, the populations and the tolerances.
+        If a state for the same parameters is found, it is loaded instead of
+        being calculated (unless ``samplers`` or ``return_info`` are passed to
+        :py:meth:`__call__`).
+        If only the populations or the tolerances differ, the saved state
+        with the closest populations is used as the initial state of the propagation
+        instead of the Thomas-Fermi one.
+        The populations are a part of the file names,
+        so only the file of the chosen state is opened.
+    :param real: if ``True``, the state is assumed to be real-valued
+        (which is the case for a system without rotation or phase imprinting),
+        and is propagated in a packed form, with two real components stored
+        in the real and the imaginary parts of a single complex one
+        (see :py:mod:`beclab.packing`).
+        In :py:meth:`__call__` the components are paired,
+        so the stepper memory and the number of FFTs are halved for an even number
+        of components, reduced by a smaller factor for an odd one,
+        and not reduced for a single component.
+        In :py:meth:`batched` the trajectories are paired instead if that gives
+        fewer packed fields (e.g. for a single component),
+        so the cost is nearly halved for any number of components.
+        The energy is measured and the populations are normalized on the packed state directly,
+        and the complex state is only allocated at the end of the propagation
+        (or during it, as a buffer for the unpacked state, if ``samplers`` are given).
 
     .. py:attribute:: wfs_meta
 
@@ -299,7 +675,8 @@ class ImaginaryTimeGroundState:
     """
 
     def __init__(self, thr, dtype, grid, system, stepper_cls=RK46NLStepper,
-            cutoff=None, verbose=True):
+            cutoff=None, verbose=True, accumulation_dtype=None,
+            cache_dir=None, real=False):
 
         if grid.dimensions not in (1, 3):
             raise NotImplementedError()
@@ -309,33 +686,116 @@ class ImaginaryTimeGroundState:
         self.grid = grid
         self.system = system
 
-        self.tf_gen = ThomasFermiGroundState(thr, dtype, grid, system, cutoff=cutoff)
+        self.tf_gen = ThomasFermiGroundState(
+            thr, dtype, grid, system, cutoff=cutoff, accumulation_dtype=accumulation_dtype)
         self.wfs_meta = self.tf_gen.wfs_meta
 
-        drift = get_drift(
-            dtype, grid.dimensions, len(system.components),
-            interactions=system.interactions,
-            potential=system.potential.get_module(dtype, grid, system.components),
-            unitary_coefficient=-1 / const.HBAR)
-
-        if cutoff is None:
-            ksquared_cutoff = None
+        self.integrator = cached(
+            lambda: _get_imaginary_time_integrator(
+                thr, dtype, grid, system, stepper_cls, cutoff, verbose),
+            _get_imaginary_time_integrator,
+            thr, dtype, grid, system, stepper_cls, cutoff, verbose)
+        self._integrator_args = (
+            thr, dtype, grid, system, stepper_cls, cutoff, verbose)
+
+        self._real = real
+        if real:
+            # The drift is different, so a separate integrator is needed.
+            self.integrator = cached(
+                lambda: _get_imaginary_time_integrator(
+                    *self._integrator_args, real=True),
+                _get_imaginary_time_integrator, self._integrator_args, dict(real=True))
+            self._packed_meta = get_packed_meta(self.wfs_meta)
+            self._pack = compile_cached(thr, get_pack, self.wfs_meta)
+            self._unpack = compile_cached(thr, get_unpack, self.wfs_meta)
+
+        self._cache_dir = cache_dir
+        if cache_dir is not None:
+            # Only the parts of the system used by the imaginary time propagation.
+            self._cache_key = stable_hash(
+                system.components, system.get_interactions(0), system.potential,
+                system.kinetic_coeff, grid, cutoff, stepper_cls,
+                numpy.dtype(dtype), self.wfs_meta.accumulation_dtype)
         else:
-            ksquared_cutoff = cutoff.ksquared
-
-        stepper = stepper_cls(
-            grid.shape, grid.box, drift,
-            kinetic_coeffs=-1 / const.HBAR * system.kinetic_coeff,
-            ksquared_cutoff=ksquared_cutoff)
-
-        self.integrator = integrator.Integrator(thr, stepper, verbose=verbose)
+            self._cache_key = None
+
+    def _cache_path(self, Ns, tolerances):
+        # The populations are written in the file name (with the exact round-trip precision),
+        # so that the warm start state can be found without opening the files.
+        return os.path.join(
+            self._cache_dir,
+            'ground_state-{key}-{tolerances_key}-N{Ns}.npz'.format(
+                key=self._cache_key,
+                tolerances_key=stable_hash(tolerances),
+                Ns=','.join(repr(float(N)) for N in Ns)))
+
+    def _has_cached_state(self, Ns, E_diff=1e-9, E_conv=1e-9, sample_time=1e-3,
+            samplers=None, return_info=False, residual_limit=None, **kwds):
+        """
+        Returns ``True`` if the call with the given parameters
+        will load the state from the disk cache.
+        """
+        if self._cache_key is None or samplers is not None or return_info:
+            return False
+        tolerances = (float(E_diff), float(E_conv), float(sample_time), residual_limit)
+        return os.path.exists(self._cache_path(Ns, tolerances))
+
+    def _load_cached(self, path):
+        with numpy.load(path) as data:
+            psi = WavefunctionSet.for_meta(self.wfs_meta)
+            psi.fill_with(data['data'])
+            return psi, data['Ns']
+
+    def _save_cached(self, path, psi, Ns):
+        if not os.path.exists(self._cache_dir):
+            os.makedirs(self._cache_dir)
+
+        # Writing to a temporary file first, so that the cache is not corrupted
+        # by an interrupted or a concurrent save.
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            numpy.savez(f, data=psi.data.get(), Ns=numpy.array(Ns, numpy.float64))
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+
+    def _find_warm_start(self, Ns):
+        """
+        Returns the path to the saved state with the populations closest to ``Ns``,
+        which has non-zero populations for all the components where ``Ns`` are non-zero,
+        or ``None`` if there are no such states.
+        """
+        Ns = numpy.array(Ns, numpy.float64)
+        best_path = None
+        best_distance = None
+        pattern = os.path.join(
+            self._cache_dir, 'ground_state-{key}-*-N*.npz'.format(key=self._cache_key))
+        for path in glob.glob(pattern):
+            # The populations are the last part of the name (see _cache_path()),
+            # and may contain dashes in exponents.
+            name = os.path.basename(path)[:-len('.npz')]
+            try:
+                cached_Ns = numpy.array(
+                    [float(N) for N in name.split('-', 3)[3][1:].split(',')])
+            except ValueError:
+                continue
+            if cached_Ns.shape != Ns.shape or ((cached_Ns == 0) & (Ns > 0)).any():
+                continue
+            distance = (numpy.abs(cached_Ns - Ns) / numpy.maximum(Ns, 1)).sum()
+            if best_distance is None or distance < best_distance:
+                best_path = path
+                best_distance = distance
+        return best_path
 
     def __call__(self, Ns, E_diff=1e-9, E_conv=1e-9, sample_time=1e-3,
-            samplers=None, return_info=False):
+            samplers=None, return_info=False, residual_limit=None, initial_state=None):
         """
         Gererate a ground state with given populations.
         The propagation in imaginary time will continue until the difference in energy
         between two successive samples is larger than the given threshold.
+        The energy and the chemical potentials are measured once per sample
+        (see :py:class:`~beclab.samplers.ConvergenceSampler`),
+        and the same measurement is used for the convergence estimation.
 
         :param Ns: a list of target populations for each component.
             The length of the list must be equal to the number of components
@@ -350,6 +810,15 @@ class ImaginaryTimeGroundState:
             to invoke during propagation.
         :param return_info: whether to return additional information about the propagation
             (see the return section below).
+        :param residual_limit: if given, the propagation will continue until the relative
+            residual :math:`\\Vert H \\Psi - \\mu \\Psi \\Vert` is less than this value
+            (``E_diff`` is ignored in this case).
+        :param initial_state: a numpy array with the shape ``(components,) + grid.shape``,
+            or a :py:class:`WavefunctionSet` object with the metadata of :py:attr:`wfs_meta`
+            (copied on the device),
+            to start the propagation from instead of the Thomas-Fermi state
+            (it will be renormalized to ``Ns``;
+            if ``real`` was set in the constructor, its imaginary part is discarded).
         :returns: if ``return_info == False``, returns a :py:class:`WavefunctionSet` object.
             Otherwise returns a tuple ``(wfs, result, info)``, where
             ``wfs`` is a :py:class:`WavefunctionSet` object,
@@ -358,35 +827,431 @@ class ImaginaryTimeGroundState:
             returned by ``reiknacontrib.integrator.Integrator.adaptive_step``.
         """
 
-        # Initial TF state
-        psi = self.tf_gen(Ns)
-
-        e_sampler = EnergySampler(psi, self.system)
-        e_stopper = StoppingEnergySampler(psi, self.system, limit=E_diff)
-        prop_samplers = dict(E_conv=e_sampler, E=e_stopper)
-        if samplers is not None:
-            prop_samplers.update(samplers)
-
-        psi_filter = NormalizationFilter(psi, Ns)
+        use_cache = (self._cache_key is not None)
+        if use_cache:
+            tolerances = (float(E_diff), float(E_conv), float(sample_time), residual_limit)
+            cache_path = self._cache_path(Ns, tolerances)
+            if self._has_cached_state(Ns, E_diff, E_conv, sample_time, samplers=samplers,
+                    return_info=return_info, residual_limit=residual_limit):
+                psi, _ = self._load_cached(cache_path)
+                return psi
+
+        if use_cache and initial_state is None:
+            warm_start_path = self._find_warm_start(Ns)
+        else:
+            warm_start_path = None
+
+        if initial_state is not None or warm_start_path is not None:
+            if initial_state is not None:
+                psi = WavefunctionSet.for_meta(self.wfs_meta)
+                if isinstance(initial_state, WavefunctionSet):
+                    psi.fill_with(initial_state.data)
+                else:
+                    psi.fill_with(numpy.asarray(initial_state).astype(self.wfs_meta.dtype))
+            else:
+                psi, _ = self._load_cached(warm_start_path)
+            # The propagation renormalizes the state after every step.
+            NormalizationFilter(psi, Ns)(psi.data, 0)
+        else:
+            # Initial TF state (already normalized)
+            psi = self.tf_gen(Ns)
+
+        e_sampler = ConvergenceSampler(
+            self.wfs_meta, self.system, E_diff=E_diff, residual_limit=residual_limit,
+            packed=self._real)
+        prop_samplers = dict(E=e_sampler)
+
+        if self._real:
+            prop_data = self.thr.empty_like(self._packed_meta.data)
+            self._pack(prop_data, psi.data)
+            if samplers is not None:
+                # The additional samplers get the state unpacked into ``psi``.
+                prop_samplers.update(
+                    (name, UnpackingSampler(psi, sampler))
+                    for name, sampler in samplers.items())
+            else:
+                # The complex state is not needed until the end of the propagation.
+                psi = None
+            psi_filter = PackedNormalizationFilter(self.wfs_meta, Ns)
+        else:
+            if samplers is not None:
+                prop_samplers.update(samplers)
+            prop_data = psi.data
+            psi_filter = NormalizationFilter(psi, Ns)
 
         result, info = self.integrator.adaptive_step(
-            psi.data, 0, sample_time,
+            prop_data, 0, sample_time,
             display=['E'],
             samplers=prop_samplers,
             filters=[psi_filter],
-            weak_convergence=dict(E_conv=E_conv))
+            weak_convergence=dict(E=E_conv))
 
-        del result['E_conv']
+        finalize_results(result, samplers)
+
+        if self._real:
+            if psi is None:
+                psi = WavefunctionSet.for_meta(self.wfs_meta)
+            self._unpack(psi.data, prop_data)
+
+        if use_cache:
+            self._save_cached(cache_path, psi, Ns)
 
         if return_info:
             return psi, result, info
         else:
             return psi
 
+    def batched(self, Ns_list, E_diff=1e-9, E_conv=1e-9, sample_time=1e-3,
+            samplers=None, return_info=False, residual_limit=None):
+        """
+        Generates ground states for several sets of populations in a single propagation,
+        using a separate trajectory for each set.
+        The convergence of every trajectory is estimated separately,
+        and the converged trajectories are frozen until the rest converge
+        (see :py:class:`~beclab.filters.FreezeFilter`).
+        The disk cache is not used.
+
+        :param Ns_list: a list of lists of target populations for each component.
+        :returns: same as :py:meth:`__call__`, except that the returned
+            :py:class:`WavefunctionSet` object has ``len(Ns_list)`` trajectories
+            containing the states for the corresponding populations.
+        """
+
+        Ns_arr = numpy.array(Ns_list, numpy.float64)
+        trajectories = Ns_arr.shape[0]
+        assert Ns_arr.shape[1] == len(self.system.components)
+
+        psi = self.tf_gen.batched(Ns_arr)
+
+        if self._real:
+            batch_integrator = cached(
+                lambda: _get_imaginary_time_integrator(
+                    *self._integrator_args, trajectories=trajectories, real=True),
+                _get_imaginary_time_integrator, self._integrator_args, trajectories,
+                dict(real=True))
+            packed_meta = get_packed_meta(psi)
+            prop_data = self.thr.empty_like(packed_meta.data)
+            compile_cached(self.thr, get_pack, psi)(prop_data, psi.data)
+            freeze_filter = FreezeFilter(packed_meta)
+            psi_filter = PackedNormalizationFilter(psi, Ns_arr)
+        else:
+            batch_integrator = cached(
+                lambda: _get_imaginary_time_integrator(
+                    *self._integrator_args, trajectories=trajectories),
+                _get_imaginary_time_integrator, self._integrator_args, trajectories)
+            prop_data = psi.data
+            freeze_filter = FreezeFilter(psi)
+            psi_filter = NormalizationFilter(psi, Ns_arr)
+
+        e_sampler = ConvergenceSampler(
+            psi, self.system, E_diff=E_diff, residual_limit=residual_limit,
+            freeze_filter=freeze_filter, packed=self._real)
+        prop_samplers = dict(E=e_sampler)
+        if samplers is not None:
+            if self._real:
+                prop_samplers.update(
+                    (name, UnpackingSampler(psi, sampler))
+                    for name, sampler in samplers.items())
+            else:
+                prop_samplers.update(samplers)
+
+        result, info = batch_integrator.adaptive_step(
+            prop_data, 0, sample_time,
+            display=['E'],
+            samplers=prop_samplers,
+            filters=[psi_filter, freeze_filter],
+            weak_convergence=dict(E=E_conv))
+        finalize_results(result, samplers)
+
+        if self._real:
+            compile_cached(self.thr, get_unpack, psi)(psi.data, prop_data)
+
+        if return_info:
+            return psi, result, info
+        else:
+            return psi
+
+
+def upsample_spectral(data, shape):
+    """
+    Interpolates ``data`` (a numpy array with the spatial dimensions last)
+    to the grid with the same box and the spatial shape ``shape``
+    by zero-padding its Fourier spectrum.
+    """
+    dimensions = len(shape)
+    axes = tuple(range(-dimensions, 0))
+    old_shape = data.shape[-dimensions:]
+
+    spectrum = numpy.fft.fftshift(numpy.fft.fftn(data, axes=axes), axes=axes)
+    padded = numpy.zeros(data.shape[:-dimensions] + tuple(shape), spectrum.dtype)
+    # Keeping the zero frequency in the center of the shifted spectrum
+    padded[(Ellipsis,) + tuple(
+        slice(new // 2 - old // 2, new // 2 - old // 2 + old)
+        for old, new in zip(old_shape, shape))] = spectrum
+
+    result = numpy.fft.ifftn(numpy.fft.ifftshift(padded, axes=axes), axes=axes)
+    return result * (float(numpy.prod(shape)) / numpy.prod(old_shape))
+
+
+class _UpsampleSpectral(Computation):
+    """
+    Interpolates a wavefunction to a grid with the same box and a larger shape
+    by zero-padding its Fourier spectrum on the device
+    (same as :py:func:`upsample_spectral`).
+    The dtype of the result is taken from ``fine_meta``.
+    """
+
+    def __init__(self, coarse_meta, fine_meta):
+        assert coarse_meta.shape[:2] == fine_meta.shape[:2]
+
+        coarse_shape = coarse_meta.grid.shape
+        fine_shape = fine_meta.grid.shape
+        real_dtype = dtypes.real_for(fine_meta.dtype)
+
+        axes = range(2, len(coarse_meta.shape))
+        self._fft_coarse = FFT(coarse_meta.data, axes=axes)
+        self._fft_fine = FFT(fine_meta.data, axes=axes)
+
+        # The frequency ``f`` of the coarse spectrum goes to the same frequency
+        # of the fine one, the rest of the fine spectrum is zeroed.
+        self._pad = PureParallel(
+            [
+                Parameter('output', Annotation(fine_meta.data, 'o')),
+                Parameter('input', Annotation(coarse_meta.data, 'i'))],
+            """
+            <%
+                r_const = lambda x: dtypes.c_constant(x, r_dtype)
+                coords = idxs[2:]
+            %>
+            bool inside = true;
+            %for dim in range(len(coarse_shape)):
+            <%
+                old = coarse_shape[dim]
+                new = fine_shape[dim]
+            %>
+            const int f${dim} = ${coords[dim]} < ${new - new // 2} ?
+                ${coords[dim]} : ${coords[dim]} - ${new};
+            inside = inside && f${dim} >= ${-(old // 2)} && f${dim} <= ${(old - 1) // 2};
+            const int c${dim} = f${dim} >= 0 ? f${dim} : f${dim} + ${old};
+            %endfor
+
+            ${output.ctype} psi = ${dtypes.c_constant(0, output.dtype)};
+            if (inside)
+            {
+                psi = ${mul}(
+                    ${cast}(${input.load_idx}(${idxs[0]}, ${idxs[1]},
+                        ${", ".join("c" + str(dim) for dim in range(len(coarse_shape)))})),
+                    ${r_const(scale)});
+            }
+            ${output.store_same}(psi);
+            """,
+            guiding_array='output',
+            render_kwds=dict(
+                coarse_shape=coarse_shape,
+                fine_shape=fine_shape,
+                scale=float(numpy.prod(fine_shape)) / numpy.prod(coarse_shape),
+                r_dtype=real_dtype,
+                cast=functions.cast(fine_meta.dtype, coarse_meta.dtype),
+                mul=functions.mul(fine_meta.dtype, real_dtype, out_dtype=fine_meta.dtype)))
+
+        Computation.__init__(self, [
+            Parameter('output', Annotation(fine_meta.data, 'o')),
+            Parameter('input', Annotation(coarse_meta.data, 'i'))])
+
+    def _build_plan(self, plan_factory, device_params, output, input_):
+        plan = plan_factory()
+        coarse_spectrum = plan.temp_array_like(input_)
+        fine_spectrum = plan.temp_array_like(output)
+        plan.computation_call(self._fft_coarse, coarse_spectrum, input_)
+        plan.computation_call(self._pad, fine_spectrum, coarse_spectrum)
+        plan.computation_call(self._fft_fine, output, fine_spectrum, inverse=True)
+        return plan
+
+
+class MultigridGroundState:
+    """
+    Ground state generator based on imaginary time propagation
+    on a sequence of grids with the same box and increasing shapes.
+    The state converged on each grid is upsampled spectrally on the device
+    (same as :py:func:`upsample_spectral`) and used as the initial state for the next one,
+    so that the long-wavelength modes converge on the coarse grids,
+    where the steps are cheaper and the kinetic term is less stiff.
+    The coarsest grid starts from the Thomas-Fermi state.
+
+    The potential of the system must be defined for any grid
+    (e.g. :py:class:`ArrayPotential` objects are not supported).
+
+    :param thr: a Reikna ``Thread``.
+    :param dtype: the dtype of the generated wavefunction
+    :param grid: a :py:class:`~beclab.grid.UniformGrid` object for the final level.
+    :param system: a :py:class:`System` object.
+    :param levels: the number of levels;
+        the grid shape is halved (down to ``min_size``) for every coarser level.
+    :param min_size: the minimal size of a coarse grid along every dimension.
+    :param coarse_dtype: the dtype for the coarse levels (e.g. ``numpy.complex64``);
+        defaults to ``dtype``.
+    :param kwds: other keyword parameters for :py:class:`ImaginaryTimeGroundState`
+        (``accumulation_dtype`` and ``cache_dir`` are used only for the final level).
+
+    .. py:attribute:: grids
+
+        A list of :py:class:`~beclab.grid.UniformGrid` objects for all the levels.
+
+    .. py:attribute:: wfs_meta
+
+        A :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object representing
+        the generated states.
+    """
+
+    def __init__(self, thr, dtype, grid, system, levels=3, min_size=8, coarse_dtype=None,
+            **kwds):
+
+        if coarse_dtype is None:
+            coarse_dtype = dtype
+
+        shapes = []
+        for level in range(levels - 1, 0, -1):
+            shape = tuple(min(n, max(n // 2 ** level, min_size)) for n in grid.shape)
+            if shape != grid.shape and (len(shapes) == 0 or shape != shapes[-1]):
+                shapes.append(shape)
+
+        coarse_kwds = dict(kwds)
+        coarse_kwds.pop('accumulation_dtype', None)
+        coarse_kwds.pop('cache_dir', None)
+
+        self.grids = [UniformGrid(shape, grid.box) for shape in shapes] + [grid]
+        self._generators = [
+            ImaginaryTimeGroundState(thr, coarse_dtype, coarse_grid, system, **coarse_kwds)
+            for coarse_grid in self.grids[:-1]]
+        self._generators.append(ImaginaryTimeGroundState(thr, dtype, grid, system, **kwds))
+
+        self._upsamplers = [
+            compile_cached(thr, _UpsampleSpectral, coarse_gen.wfs_meta, fine_gen.wfs_meta)
+            for coarse_gen, fine_gen in zip(self._generators[:-1], self._generators[1:])]
+
+        self.wfs_meta = self._generators[-1].wfs_meta
+
+    def _upsample(self, level, psi):
+        """
+        Returns a :py:class:`WavefunctionSet` object for the generator of the level ``level``
+        with the state ``psi`` from the previous level upsampled to its grid.
+        """
+        initial_state = WavefunctionSet.for_meta(self._generators[level].wfs_meta)
+        self._upsamplers[level - 1](initial_state.data, psi.data)
+        return initial_state
+
+    def __call__(self, Ns, E_diff=1e-9, E_conv=1e-9, sample_time=1e-3,
+            coarse_E_diff=1e-6, coarse_E_conv=1e-6, **kwds):
+        """
+        Gererate a ground state with given populations.
+
+        :param Ns: a list of target populations for each component.
+        :param E_diff: a relative energy difference threshold for the final level.
+        :param E_conv: a convergence threshold for the final level.
+        :param sample_time: time between successive sampling of energy.
+        :param coarse_E_diff: a relative energy difference threshold for the coarse levels.
+        :param coarse_E_conv: a convergence threshold for the coarse levels.
+        :param kwds: other keyword parameters for
+            :py:meth:`ImaginaryTimeGroundState.__call__` of the final level
+            (``samplers``, ``return_info`` and ``residual_limit``).
+        :returns: same as :py:meth:`ImaginaryTimeGroundState.__call__`.
+        """
+
+        final_gen = self._generators[-1]
+        if final_gen._has_cached_state(
+                Ns, E_diff=E_diff, E_conv=E_conv, sample_time=sample_time, **kwds):
+            return final_gen(Ns, E_diff=E_diff, E_conv=E_conv, sample_time=sample_time, **kwds)
+
+        psi = None
+        for level, gen in enumerate(self._generators[:-1]):
+            initial_state = None if psi is None else self._upsample(level, psi)
+            psi = gen(
+                Ns, E_diff=coarse_E_diff, E_conv=coarse_E_conv, sample_time=sample_time,
+                initial_state=initial_state)
+
+        level = len(self._generators) - 1
+        initial_state = None if psi is None else self._upsample(level, psi)
+        return final_gen(
+            Ns, E_diff=E_diff, E_conv=E_conv, sample_time=sample_time,
+            initial_state=initial_state, **kwds)
+
+
+def _get_integrator(wfs_meta, system, stepper_cls, cutoff, profile):
+
+    thr = wfs_meta.thread
+    dtype = wfs_meta.dtype
+    grid = wfs_meta.grid
+
+    wigner = (wfs_meta.representation == REPR_WIGNER)
+
+    if wigner:
+        _, corrections = get_wigner_corrections(wfs_meta, len(system.components))
+    else:
+        corrections = None
+
+    noises = (wigner and system.losses is not None)
+
+    drift = get_drift(
+        dtype, grid.dimensions, len(system.components),
+        interactions=system.interactions,
+        corrections=corrections,
+        potential=system.potential.get_module(dtype, grid, system.components),
+        losses=system.losses,
+        unitary_coefficient=-1j / const.HBAR,
+        linear_terms=system.linear_terms,
+        interaction_ramps=system.interaction_ramps,
+        loss_ramps=system.loss_ramps)
+
+    if noises:
+        diffusion = get_diffusion(
+            dtype, grid.dimensions, len(system.components), losses=system.losses,
+            loss_ramps=system.loss_ramps)
+    else:
+        diffusion = None
+
+    if cutoff is None:
+        ksquared_cutoff = None
+    else:
+        ksquared_cutoff = cutoff.ksquared
+
+    stepper = stepper_cls(
+        grid.shape, grid.box, drift,
+        kinetic_coeffs=-1j / const.HBAR * system.kinetic_coeff,
+        trajectories=wfs_meta.trajectories,
+        diffusion=diffusion,
+        ksquared_cutoff=ksquared_cutoff)
+
+    return integrator.Integrator(
+        thr, stepper,
+        profile=profile)
+
+
+def _find_rng_counters(obj, depth=2):
+    """
+    Returns a list of device arrays with ``reikna.cbrng`` counters
+    (recognized by their structure dtype with the field ``v``)
+    held by ``obj`` or by its attributes, up to ``depth`` levels deep,
+    in a deterministic order.
+    """
+    found = []
+    attrs = getattr(obj, '__dict__', {})
+    for name in sorted(attrs):
+        value = attrs[name]
+        dtype = getattr(value, 'dtype', None)
+        if isinstance(dtype, numpy.dtype) and hasattr(value, 'get'):
+            if dtype.names is not None and 'v' in dtype.names:
+                found.append(value)
+        elif depth > 1 and hasattr(value, '__dict__'):
+            found.extend(_find_rng_counters(value, depth=depth - 1))
+    return found
+
 
 class Integrator:
     """
     BEC integration class.
+    The propagation is performed in the precision of ``wfs_meta.dtype``;
+    samplers and filters accumulate their results in ``wfs_meta.accumulation_dtype``
+    (see :py:class:`~beclab.wavefunction.WavefunctionSetMetadata`).
 
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
     :param system: a :py:class:`System` object.
@@ -397,73 +1262,251 @@ class Integrator:
     :param profile: whether to synchronize with GPU before sampling.
         Passed to ``reiknacontrib.integrator.Integrator.fixed_step`` or
         ``reiknacontrib.integrator.Integrator.adaptive_step``.
+
+    The coefficients of ``system`` are compiled into the drift and diffusion kernels,
+    so an integrator for a system with different coefficients requires a new compilation
+    (:py:class:`~beclab.parameters.SystemParameters` only applies to the energy measurement).
+
+    .. py:attribute:: stochastic
+
+        ``True`` if the integrated equation has noise terms
+        (which is the case for a system with losses in the Wigner representation).
+        The state of their generator can be saved and restored with
+        :py:meth:`get_noise_state` and :py:meth:`set_noise_state`.
     """
 
     def __init__(self, wfs_meta, system,
             stepper_cls=RK46NLStepper,
             cutoff=None, profile=False):
 
-        thr = wfs_meta.thread
-        dtype = wfs_meta.dtype
-        grid = wfs_meta.grid
-
-        wigner = (wfs_meta.representation == REPR_WIGNER)
-
-        if wigner:
-            corrections = -(
-                numpy.ones_like(system.interactions) / 2 +
-                numpy.eye(system.interactions.shape[0]) / 2
-                ) * wfs_meta.modes / grid.V
-        else:
-            corrections = None
-
-        noises = (wigner and system.losses is not None)
-
-        drift = get_drift(
-            dtype, grid.dimensions, len(system.components),
-            interactions=system.interactions,
-            corrections=corrections,
-            potential=system.potential.get_module(dtype, grid, system.components),
-            losses=system.losses,
-            unitary_coefficient=-1j / const.HBAR,
-            linear_terms=system.linear_terms)
-
-        if noises:
-            diffusion = get_diffusion(
-                dtype, grid.dimensions, len(system.components), losses=system.losses)
-        else:
-            diffusion = None
+        self.stochastic = (
+            wfs_meta.representation == REPR_WIGNER and system.losses is not None)
+        self._integrator = cached(
+            lambda: _get_integrator(
+                wfs_meta, system, stepper_cls, cutoff, profile),
+            _get_integrator, wfs_meta, system, stepper_cls, cutoff, profile)
 
-        if cutoff is None:
-            ksquared_cutoff = None
-        else:
-            ksquared_cutoff = cutoff.ksquared
+    def _noise_counters(self):
+        counters = _find_rng_counters(self._integrator)
+        if self.stochastic and len(counters) == 0:
+            raise ValueError("Cannot find the state of the noise generator of the integrator")
+        return counters
 
-        stepper = stepper_cls(
-            grid.shape, grid.box, drift,
-            kinetic_coeffs=-1j / const.HBAR * system.kinetic_coeff,
-            trajectories=wfs_meta.trajectories,
-            diffusion=diffusion,
-            ksquared_cutoff=ksquared_cutoff)
+    def get_noise_state(self):
+        """
+        Returns a list of ``numpy`` arrays with the counters of the noise generators
+        (empty if the integrator is not :py:attr:`stochastic`).
+        """
+        return [counters.get() for counters in self._noise_counters()]
 
-        self._integrator = integrator.Integrator(
-            thr, stepper,
-            profile=profile)
+    def set_noise_state(self, state):
+        """
+        Restores the counters of the noise generators saved by :py:meth:`get_noise_state`.
+        """
+        counters_list = self._noise_counters()
+        if len(counters_list) != len(state):
+            raise ValueError("The noise state was saved for a different integrator")
+        for counters, saved in zip(counters_list, state):
+            counters.set(saved)
+
+    def _integrate(self, method, wfs, args, kwds, on_finish=None):
+        samplers = kwds.get('samplers')
+        try:
+            result, info = method(wfs.data, *args, **kwds)
+        except:
+            release_samplers(samplers)
+            raise
+        if on_finish is not None:
+            # Called before the results are finalized,
+            # so that the device can do some work while the host waits for the samples.
+            on_finish()
+        return finalize_results(result, samplers), info
 
     def fixed_step(self, wfs, *args, **kwds):
         """
         Start integration with fixed step for the :py:class:`beclab.WavefunctionSet` ``wfs``.
         Other parameters and return values are the same as in
         ``reiknacontrib.integrator.Integrator.fixed_step``
-        (except that ``data`` is replaced by ``wfs``).
+        (except that ``data`` is replaced by ``wfs``,
+        and the results of the samplers are processed by
+        :py:func:`~beclab.samplers.finalize_results`).
         """
-        return self._integrator.fixed_step(wfs.data, *args, **kwds)
+        return self._integrate(self._integrator.fixed_step, wfs, args, kwds)
 
     def adaptive_step(self, wfs, *args, **kwds):
         """
         Start integration with adaptive step for the :py:class:`beclab.WavefunctionSet` ``wfs``.
         Other parameters and return values are the same as in
         ``reiknacontrib.integrator.Integrator.adaptive_step``
-        (except that ``data`` is replaced by ``wfs``).
+        (except that ``data`` is replaced by ``wfs``,
+        and the results of the samplers are processed by
+        :py:func:`~beclab.samplers.finalize_results`).
+        """
+        return self._integrate(self._integrator.adaptive_step, wfs, args, kwds)
+
+
+def warm_up(thr, dtype, grid, system, trajectories=1, representation=REPR_CLASSICAL,
+        cutoff=None, stepper_cls=RK46NLStepper, samplers=None, ground_state_Ns=None,
+        accumulation_dtype=None):
+    """
+    Creates the computations for the given configuration ahead of time
+    (see :py:mod:`beclab.cache`), so that the subsequent creation of
+    :py:class:`Integrator`, :py:class:`ImaginaryTimeGroundState` and samplers
+    with the same parameters does not require compilation.
+    If :py:func:`~beclab.cache.enable_binary_cache` was called for ``thr``,
+    the compiled binaries are also saved for the other processes.
+
+    :param trajectories: the number of trajectories in the integrated wavefunction.
+    :param representation: the representation of the integrated wavefunction.
+    :param samplers: a function taking a
+        :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object
+        and creating the samplers that will be used during the integration.
+    :param ground_state_Ns: if given, the computations used by
+        :py:class:`ImaginaryTimeGroundState` to generate a ground state
+        are also created (the populations are passed to the kernels at runtime,
+        so the same computations are used for any other populations).
+
+    The rest of the parameters have the same meaning as in :py:class:`Integrator`
+    and :py:class:`ImaginaryTimeGroundState`.
+    """
+    wfs_meta = WavefunctionSetMetadata(
+        thr, dtype, grid, components=len(system.components), trajectories=trajectories,
+        representation=representation, cutoff=cutoff, accumulation_dtype=accumulation_dtype)
+    Integrator(wfs_meta, system, stepper_cls=stepper_cls, cutoff=cutoff)
+    if samplers is not None:
+        samplers(wfs_meta)
+
+    if ground_state_Ns is not None:
+        gs_gen = ImaginaryTimeGroundState(
+            thr, dtype, grid, system, stepper_cls=stepper_cls, cutoff=cutoff,
+            accumulation_dtype=accumulation_dtype)
+        ConvergenceSampler(gs_gen.wfs_meta, system)
+        NormalizationFilter(gs_gen.wfs_meta, ground_state_Ns)
+
+
+class ChunkedIntegrator:
+    """
+    Integrates a Wigner ensemble in chunks of trajectories,
+    so that the required device memory scales with the size of a chunk
+    and not with the size of the whole ensemble.
+    The initial state of each chunk is generated from the classical state
+    with independent vacuum noise, and the results for all the chunks
+    are merged with ``reiknacontrib.integrator.join_results``.
+    The noise of a chunk only depends on ``seed`` and the number of the chunk,
+    so the results do not depend on the order in which the chunks are integrated
+    (see :py:meth:`integrate_chunks`).
+
+    If ``prefetch`` is ``True``, the initial state of the next chunk is generated
+    in a second buffer as soon as the integration of the current chunk is finished,
+    while the host is still collecting its samples
+    (which includes waiting for the downloads of
+    :py:class:`~beclab.samplers.AsyncSampler` objects),
+    and the next integration starts from it without any additional setup.
+    This doubles the device memory taken by the chunk state.
+
+    :param wfs: a :py:class:`WavefunctionSet` object in the classical representation
+        with one trajectory.
+    :param system: a :py:class:`System` object.
+    :param trajectories: the total number of trajectories.
+    :param chunk_size: the number of trajectories integrated at the same time
+        (must be a divisor of ``trajectories``).
+    :param samplers: a function taking a
+        :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object for a chunk
+        and returning a dictionary of samplers.
+        The samplers are created once and used for every chunk.
+    :param seed: the seed for the vacuum noise.
+    :param prefetch: whether to prepare the initial state of the next chunk
+        while the current one is being finished.
+    :param kwds: passed to the :py:class:`Integrator` constructor.
+
+    .. py:attribute:: wfs_meta
+
+        A :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object
+        for a single chunk.
+    """
+
+    def __init__(self, wfs, system, trajectories, chunk_size, samplers=None, seed=None,
+            prefetch=True, **kwds):
+
+        assert wfs.representation == REPR_CLASSICAL
+        assert wfs.trajectories == 1
+        if trajectories % chunk_size != 0:
+            raise ValueError(
+                "The number of trajectories must be a multiple of the chunk size")
+
+        self._initial = wfs
+        self._chunks = trajectories // chunk_size
+
+        self._buffers = [
+            WavefunctionSet(
+                wfs.thread, wfs.dtype, wfs.grid,
+                components=wfs.components, trajectories=chunk_size,
+                representation=REPR_WIGNER, cutoff=wfs.cutoff,
+                accumulation_dtype=wfs.accumulation_dtype)
+            for i in range(2 if prefetch else 1)]
+        self.wfs_meta = self._buffers[0]
+
+        self._wigner_coherent = WignerCoherent(
+            wfs.grid, self.wfs_meta.data, wfs.data,
+            cutoff=wfs.cutoff, seed=seed).compile(wfs.thread)
+
+        self._samplers = samplers(self.wfs_meta) if samplers is not None else None
+        self._integrator = Integrator(self.wfs_meta, system, **kwds)
+
+    def integrate_chunks(self, method_name, chunks, *args, **kwds):
+        """
+        Integrates the chunks with the given numbers using the :py:class:`Integrator` method
+        ``method_name`` (``'fixed_step'`` or ``'adaptive_step'``; the ``wfs`` argument
+        is omitted), and returns a tuple ``(results, infos)`` of lists
+        with the separate result and ``reiknacontrib.integrator.IntegrationInfo`` object
+        for each chunk.
+        """
+        if self._samplers is not None:
+            kwds['samplers'] = self._samplers
+        method = getattr(self._integrator._integrator, method_name)
+        chunks = list(chunks)
+        buffers = self._buffers
+
+        def prepare(i):
+            # The stream number depends only on the chunk number,
+            # so the initial noise does not depend on the order of integration.
+            wfs = buffers[i % len(buffers)]
+            self._wigner_coherent(wfs.data, self._initial.data, chunks[i])
+
+        results = []
+        infos = []
+        for i in range(len(chunks)):
+            if len(buffers) == 1 or i == 0:
+                prepare(i)
+            if len(buffers) > 1 and i + 1 < len(chunks):
+                on_finish = lambda: prepare(i + 1)
+            else:
+                on_finish = None
+
+            result, info = self._integrator._integrate(
+                method, buffers[i % len(buffers)], args, kwds, on_finish=on_finish)
+            results.append(result)
+            infos.append(info)
+
+        return results, infos
+
+    def _run(self, method_name, *args, **kwds):
+        results, infos = self.integrate_chunks(
+            method_name, range(self._chunks), *args, **kwds)
+        return integrator.join_results(results), infos
+
+    def fixed_step(self, *args, **kwds):
+        """
+        Integrates all the chunks with
+        :py:meth:`Integrator.fixed_step` (the ``wfs`` argument is omitted)
+        and returns a tuple ``(result, infos)``, where ``result`` is the merged result
+        and ``infos`` is a list of ``reiknacontrib.integrator.IntegrationInfo`` objects
+        for each chunk.
+        """
+        return self._run('fixed_step', *args, **kwds)
+
+    def adaptive_step(self, *args, **kwds):
+        """
+        Same as :py:meth:`fixed_step`, but uses :py:meth:`Integrator.adaptive_step`.
         """
-        return self._integrator.adaptive_step(wfs.data, *args, **kwds)
+        return self._run('adaptive_step', *args, **kwds)
@@ -0,0 +1,258 @@
+"""
+In-memory cache of constructed and compiled computations.
+
+Most of the time spent on creating meters, samplers and integrators is taken
+by building Reikna computation plans, rendering their templates and compiling the kernels.
+The objects created by :py:func:`cached` are stored
+under a key describing the contents of their arguments,
+so creating another object with the same parameters
+(e.g. in a parameter scan launching many short simulations) reuses them.
+The cache holds at most a given number of objects (see :py:func:`set_cache_size`),
+discarding the least recently used ones.
+Objects that cannot be described by their contents (e.g. Python functions)
+are identified by their ``id()``, so the keys are only valid within one process.
+
+To avoid the compilation in subsequent processes, the program binaries can be saved on disk
+(see :py:func:`enable_binary_cache`); they are keyed on the rendered source,
+the compilation options and the device, and do not depend on the in-memory keys.
+"""
+
+import os
+import tempfile
+import hashlib
+from collections import OrderedDict
+
+import numpy
+
+import reikna.cluda as cluda
+from reikna.core import Computation
+
+from beclab.wavefunction import WavefunctionSetMetadata
+
+
+_cache = OrderedDict()
+_enabled = True
+_max_size = 256
+
+
+def _make_key(obj, refs):
+    """
+    Returns a hashable object describing the contents of ``obj``.
+    Scalars are tagged with their type, so that, for example, ``1``, ``1.0`` and ``True``
+    (which are equal in Python) give different keys.
+    Objects that cannot be described by their contents are identified by their ``id()``,
+    and are added to ``refs`` to keep them (and, therefore, their ``id()``) alive
+    while the cache entry exists.
+    """
+    if obj is None or isinstance(obj, type):
+        return obj
+    elif isinstance(obj, (bool, int, float, complex, str)):
+        return (type(obj).__name__, obj)
+    elif isinstance(obj, numpy.dtype):
+        return ('dtype', obj.str)
+    elif isinstance(obj, numpy.generic):
+        return ('scalar', obj.dtype.str, obj.item())
+    elif isinstance(obj, numpy.ndarray):
+        return (
+            'ndarray', obj.shape, obj.dtype.str,
+            hashlib.sha1(numpy.ascontiguousarray(obj).tobytes()).hexdigest())
+    elif isinstance(obj, (tuple, list)):
+        return (type(obj).__name__,) + tuple(_make_key(elem, refs) for elem in obj)
+    elif isinstance(obj, dict):
+        return ('dict',) + tuple(
+            (_make_key(key, refs), _make_key(obj[key], refs)) for key in sorted(obj))
+    elif isinstance(obj, WavefunctionSetMetadata):
+        # Wavefunction containers are described by their metadata only.
+        return ('wfs_meta',) + tuple(
+            _make_key(elem, refs) for elem in (
+                obj.thread, obj.dtype, obj.grid, obj.components, obj.trajectories,
+                obj.representation, obj.cutoff, obj.accumulation_dtype))
+    elif hasattr(obj, 'shape') and hasattr(obj, 'dtype'):
+        # Array metadata (e.g. Reikna ``Type`` objects)
+        return (
+            'array', tuple(obj.shape), numpy.dtype(obj.dtype).str,
+            _make_key(getattr(obj, 'strides', None), refs))
+    elif (type(obj).__module__.startswith('beclab.') and hasattr(obj, '__dict__')
+            and not isinstance(obj, Computation)):
+        return (type(obj), _make_key(vars(obj), refs))
+    else:
+        refs.append(obj)
+        return ('id', id(obj))
+
+
+def cached(factory, *key_objects):
+    """
+    Returns the result of ``factory()`` called earlier with the same ``key_objects``,
+    or calls it and saves the result.
+    ``key_objects`` must describe all the parameters the result depends on,
+    including the Reikna ``Thread`` for compiled computations.
+    """
+    if not _enabled:
+        return factory()
+
+    refs = []
+    key = _make_key(key_objects, refs)
+    if key in _cache:
+        # Moving the entry to the end of the LRU order
+        entry = _cache.pop(key)
+    else:
+        entry = (factory(), refs)
+        while len(_cache) > 0 and len(_cache) >= _max_size:
+            _cache.popitem(last=False)
+    _cache[key] = entry
+    return entry[0]
+
+
+def compile_cached(thread, computation_cls, *args, **kwds):
+    """
+    Returns the compiled computation ``computation_cls(*args, **kwds)``,
+    reusing the one compiled earlier with the same parameters, if available.
+    """
+    return cached(
+        lambda: computation_cls(*args, **kwds).compile(thread),
+        thread, computation_cls, args, kwds)
+
+
+def compile_computation(thread, computation):
+    """
+    Returns ``computation.compile(thread)``, reusing the result for the same
+    ``computation`` object (e.g. the one returned by :py:func:`cached`).
+    """
+    return cached(lambda: computation.compile(thread), thread, computation)
+
+
+def stable_hash(*objects):
+    """
+    Returns a hexadecimal digest describing the contents of ``objects``,
+    which is the same in different processes (and can be used as a key for files on disk),
+    or ``None`` if some of the objects cannot be described by their contents.
+    """
+    refs = []
+    key = _make_key(objects, refs)
+    if len(refs) > 0:
+        return None
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def clear_cache():
+    """
+    Removes all the objects from the cache.
+    """
+    _cache.clear()
+
+
+def set_cache_size(size):
+    """
+    Sets the maximum number of objects in the cache (256 by default).
+    If the cache holds more objects, the least recently used ones are discarded.
+    """
+    global _max_size
+    _max_size = size
+    while len(_cache) > _max_size:
+        _cache.popitem(last=False)
+
+
+def set_cache_enabled(enabled):
+    """
+    Enables or disables the cache (it is enabled by default).
+    """
+    global _enabled
+    _enabled = enabled
+
+
+def _device_description(thread):
+    device = thread._device
+    if thread.api.get_id() == cluda.ocl_id():
+        return (
+            'ocl', device.platform.name, device.platform.version,
+            device.name, device.driver_version)
+    else:
+        import pycuda.driver as cuda
+        return (
+            'cuda', device.name(), device.compute_capability(), cuda.get_driver_version())
+
+
+def _compile_ocl(thread, src, options, binary_path):
+    import pyopencl as cl
+
+    if os.path.exists(binary_path):
+        with open(binary_path, 'rb') as f:
+            binary = f.read()
+        try:
+            return cl.Program(thread._context, [thread._device], [binary]).build(options=options)
+        except cl.Error:
+            # The binary is damaged or was made by a different compiler,
+            # building from the source and replacing it.
+            pass
+
+    program = cl.Program(thread._context, src).build(options=options)
+    binaries = program.get_info(cl.program_info.BINARIES)
+    return program, binaries[0]
+
+
+def _compile_cuda(thread, src, options, binary_path):
+    import pycuda.driver as cuda
+    from pycuda.compiler import compile as compile_cubin
+
+    if os.path.exists(binary_path):
+        with open(binary_path, 'rb') as f:
+            binary = f.read()
+        try:
+            return cuda.module_from_buffer(binary)
+        except cuda.Error:
+            pass
+
+    binary = compile_cubin(src, no_extern_c=True, options=options)
+    return cuda.module_from_buffer(binary), binary
+
+
+def _write_binary(path, binary):
+    # Writing to a uniquely named temporary file first,
+    # so that several processes filling the same cache do not corrupt each other's files.
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(binary)
+    os.rename(temp_path, path)
+
+
+def enable_binary_cache(thread, path=None):
+    """
+    Makes ``thread`` save the binaries of the programs it compiles in the directory ``path``
+    (``~/.cache/beclab`` by default) and load them instead of compiling
+    the same source for the same device again, in this or any other process.
+    A binary is keyed on the rendered source, the compilation options
+    and the device (including the driver version).
+    Combined with :py:func:`~beclab.warm_up`, this allows one to compile the kernels
+    for a configuration once, before launching many short simulations.
+    """
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.cache', 'beclab')
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    device_key = repr(_device_description(thread))
+    is_ocl = (thread.api.get_id() == cluda.ocl_id())
+
+    def compile_program(src, fast_math=False):
+        if is_ocl:
+            options = "-cl-mad-enable -cl-fast-relaxed-math" if fast_math else ""
+        else:
+            options = ['-use_fast_math'] if fast_math else []
+
+        key = hashlib.sha1(
+            repr((device_key, options, src)).encode('utf-8')).hexdigest()
+        binary_path = os.path.join(path, key + ('.bin' if is_ocl else '.cubin'))
+
+        compile_func = _compile_ocl if is_ocl else _compile_cuda
+        result = compile_func(thread, src, options, binary_path)
+        if isinstance(result, tuple):
+            program, binary = result
+            _write_binary(binary_path, binary)
+        else:
+            program = result
+        return program
+
+    # Replacing the compilation method of this particular thread
+    # (which is used by Reikna for all the kernels, see ``Thread._create_program``).
+    thread._compile = compile_program
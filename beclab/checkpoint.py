@@ -0,0 +1,251 @@
+import os
+import tempfile
+
+import numpy
+
+from beclab.cache import stable_hash
+
+
+def _concatenate_results(results):
+    """
+    Joins the results of consecutive integration segments along the time axis.
+    If a segment starts with a sample taken at the end time of the previous one,
+    it is skipped.
+    Fields that were not collected (``None``, for example, the values of a sampler
+    created with ``no_values=True``) stay ``None``.
+    """
+    joined = {}
+    for name in results[0]:
+        field_names = set()
+        for result in results:
+            field_names.update(result[name])
+
+        fields = {}
+        for field in sorted(field_names):
+            if any(result[name].get(field) is None for result in results):
+                fields[field] = None
+                continue
+
+            parts = []
+            last_time = None
+            for result in results:
+                times = numpy.asarray(result[name]['time'])
+                start = 1 if last_time is not None and times[0] == last_time else 0
+                parts.append(numpy.asarray(result[name][field])[start:])
+                last_time = times[-1]
+            fields[field] = numpy.concatenate(parts)
+        joined[name] = fields
+    return joined
+
+
+def _pack_result(result):
+    arrays = {}
+    for name in result:
+        for field in result[name]:
+            if result[name][field] is None:
+                continue
+            key = 'result/{name}/{field}'.format(name=name, field=field)
+            arrays[key] = numpy.asarray(result[name][field])
+    return arrays
+
+
+def _unpack_result(arrays):
+    result = {}
+    for key in arrays:
+        if not key.startswith('result/'):
+            continue
+        _, name, field = key.split('/')
+        result.setdefault(name, {})[field] = arrays[key]
+    return result
+
+
+def _write(path, arrays):
+    # Writing to a temporary file first, so that an interruption during the saving
+    # does not destroy the previous version of the file.
+    # The name of the temporary file is unique, so that several processes
+    # writing the same checkpoint do not corrupt each other's files.
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez_compressed(f, **arrays)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _read(path):
+    with numpy.load(path) as data:
+        return dict(data)
+
+
+class CheckpointedIntegrator:
+    """
+    Wraps an :py:class:`~beclab.Integrator` object, splitting the integration
+    into segments of several samples and writing a checkpoint after each segment.
+    The checkpoint file contains the wavefunction data, the current time,
+    the number of the last finished segment, the states of the beam splitter RNGs
+    and, for a stochastic integrator, the counters of its noise generator
+    (see :py:meth:`~beclab.Integrator.get_noise_state`).
+    The sampler results and the step sizes of each segment are written
+    to a separate file ``path + '.segment<number>'`` once,
+    so the amount of data written per segment does not grow with the integration time.
+    When the integration is finished, the checkpoint and the segment files are removed.
+
+    If the integration is interrupted, calling the same method with the same arguments
+    and ``resume=True`` continues it from the last checkpoint.
+    The segments are integrated with the same steps as the uninterrupted integration
+    would be, so the joined result is the same bit for bit
+    (see :py:meth:`adaptive_step` for the adaptive step integration).
+
+    :param integrator: an :py:class:`~beclab.Integrator` object.
+    :param path: the path of the checkpoint file.
+    :param beam_splitters: a list of :py:class:`~beclab.BeamSplitter` objects
+        used in samplers, filters or between integrations,
+        whose RNG states are saved in checkpoints.
+    """
+
+    def __init__(self, integrator, path, beam_splitters=None):
+        self._integrator = integrator
+        self._path = path
+        self._beam_splitters = [] if beam_splitters is None else beam_splitters
+
+    def _segment_path(self, segment):
+        return self._path + '.segment' + str(segment)
+
+    def _save(self, wfs, arguments, segment, t, steps, result):
+        segment_arrays = _pack_result(result)
+        segment_arrays['steps'] = numpy.array(steps).reshape(-1, 3)
+        _write(self._segment_path(segment), segment_arrays)
+
+        arrays = {}
+        arrays['data'] = wfs.data.get()
+        arrays['arguments'] = numpy.array(stable_hash(arguments))
+        arrays['segment'] = numpy.array(segment)
+        arrays['t'] = numpy.array(t)
+        for i, bs in enumerate(self._beam_splitters):
+            name, keys, pos, has_gauss, cached_gaussian = bs.get_state()
+            arrays['beam_splitter/{i}/keys'.format(i=i)] = keys
+            arrays['beam_splitter/{i}/other'.format(i=i)] = numpy.array(
+                [pos, has_gauss, cached_gaussian])
+        for i, counters in enumerate(self._integrator.get_noise_state()):
+            arrays['noise/{i}'.format(i=i)] = counters
+        _write(self._path, arrays)
+
+    def _load(self, wfs, arguments):
+        arrays = _read(self._path)
+
+        if str(arrays['arguments']) != stable_hash(arguments):
+            raise ValueError(
+                "The checkpoint was created for a different set of integration parameters")
+
+        wfs.fill_with(arrays['data'])
+        for i, bs in enumerate(self._beam_splitters):
+            pos, has_gauss, cached_gaussian = arrays['beam_splitter/{i}/other'.format(i=i)]
+            bs.set_state((
+                'MT19937', arrays['beam_splitter/{i}/keys'.format(i=i)],
+                int(pos), int(has_gauss), float(cached_gaussian)))
+        noise_keys = sorted(
+            (key for key in arrays if key.startswith('noise/')),
+            key=lambda key: int(key.split('/')[1]))
+        self._integrator.set_noise_state([arrays[key] for key in noise_keys])
+
+        last_segment = int(arrays['segment'])
+        results = [
+            _unpack_result(_read(self._segment_path(segment)))
+            for segment in range(last_segment + 1)]
+
+        return last_segment, results
+
+    def _run(self, method, wfs, segments, arguments, resume, kwds):
+        first_segment = 0
+        results = []
+        if resume and os.path.exists(self._path):
+            last_segment, results = self._load(wfs, arguments)
+            first_segment = last_segment + 1
+        elif os.path.exists(self._path):
+            # The segment files are overwritten by this integration,
+            # so the old checkpoint must not be resumed from.
+            os.remove(self._path)
+
+        infos = []
+        for segment in range(first_segment, len(segments)):
+            t_start, args, segment_kwds = segments[segment]
+            result, info = method(wfs, t_start, *args, **dict(kwds, **segment_kwds))
+            results.append(result)
+            infos.append(info)
+            self._save(wfs, arguments, segment, info.steps[-1][1], info.steps, result)
+
+        joined = _concatenate_results(results)
+
+        # The integration is finished, the checkpoint is not needed anymore.
+        _remove(self._path)
+        for segment in range(len(segments)):
+            _remove(self._segment_path(segment))
+
+        return joined, infos
+
+    def fixed_step(self, wfs, t_start, t_end, steps, samples=1,
+            checkpoint_samples=1, resume=False, **kwds):
+        """
+        Integrates with :py:meth:`~beclab.Integrator.fixed_step`,
+        writing a checkpoint every ``checkpoint_samples`` samples
+        (``samples`` must be a multiple of it).
+        If ``resume`` is ``True`` and the checkpoint file exists,
+        the integration continues from the last checkpoint.
+        Returns a tuple ``(result, infos)``, where ``result`` is the joined result
+        and ``infos`` is a list of ``reiknacontrib.integrator.IntegrationInfo`` objects
+        for the segments integrated during this call.
+
+        The time step is the same as in the integration without checkpoints,
+        and the results are the same bit for bit if the step and the sampling times
+        are exactly representable
+        (otherwise the start times of the segments may differ in the last bits).
+        """
+        assert samples % checkpoint_samples == 0
+        assert steps % samples == 0
+
+        segments_num = samples // checkpoint_samples
+        segment_time = (t_end - t_start) / segments_num
+        segment_steps = steps // segments_num
+        segments = [
+            (t_start + i * segment_time,
+                (t_start + (i + 1) * segment_time, segment_steps),
+                dict(samples=checkpoint_samples))
+            for i in range(segments_num)]
+
+        arguments = ('fixed_step', t_start, t_end, steps, samples, checkpoint_samples)
+        return self._run(self._integrator.fixed_step, wfs, segments, arguments, resume, kwds)
+
+    def adaptive_step(self, wfs, t_start, t_sample, t_end,
+            checkpoint_samples=1, resume=False, **kwds):
+        """
+        Same as :py:meth:`fixed_step`, but integrates with
+        :py:meth:`~beclab.Integrator.adaptive_step`.
+        ``t_end - t_start`` must be a multiple of ``t_sample * checkpoint_samples``.
+
+        The integrator estimates the step size anew at the start of each segment,
+        so the result may differ from the one of a single
+        :py:meth:`~beclab.Integrator.adaptive_step` call.
+        Since a resumed integration restarts at the same segment boundary,
+        it is the same bit for bit as an uninterrupted checkpointed integration
+        with the same ``checkpoint_samples``.
+        """
+        segment_time = t_sample * checkpoint_samples
+        segments_num = int(round((t_end - t_start) / segment_time))
+        segments = [
+            (t_start + i * segment_time, (t_sample,),
+                dict(t_end=t_start + (i + 1) * segment_time))
+            for i in range(segments_num)]
+
+        arguments = ('adaptive_step', t_start, t_sample, t_end, checkpoint_samples)
+        return self._run(self._integrator.adaptive_step, wfs, segments, arguments, resume, kwds)
@@ -1,23 +1,35 @@
 import numpy
 
 from reikna.cluda import dtypes, functions
-from reikna.core import Parameter, Annotation
-from reikna.algorithms import PureParallel
+from reikna.core import Computation, Parameter, Annotation, Type, Transformation
+from reikna.algorithms import PureParallel, Reduce, predicate_sum
+from reikna.transformations import mul_const
+from reikna.helpers import product
 
-from beclab.meters import DensityIntegralMeter
+from beclab.meters import _ReduceNorm, predicate_struct_sum
+from beclab.wavefunction import REPR_WIGNER
+from beclab.packing import get_packed_meta, get_packing_axis, PACK_TRAJECTORIES
+from beclab.cache import compile_cached
 from reiknacontrib.integrator import Filter
 
 
-def get_multiply(wfs_meta):
+def get_multiply(wfs_meta, per_trajectory=False):
+    """
+    Returns a computation multiplying each component by a coefficient
+    (separate for each trajectory, if ``per_trajectory`` is ``True``).
+    """
 
-    real_dtype = dtypes.real_for(wfs_meta.dtype)
+    real_dtype = wfs_meta.accumulation_dtype
+    if per_trajectory:
+        coeffs_shape = (wfs_meta.trajectories, wfs_meta.components)
+    else:
+        coeffs_shape = (wfs_meta.components,)
 
     return PureParallel(
         [
             Parameter('output', Annotation(wfs_meta.data, 'o')),
-            Parameter('input', Annotation(wfs_meta.data, 'i'))]
-            + [Parameter('coeff' + str(i), Annotation(real_dtype))
-                for i in range(wfs_meta.components)],
+            Parameter('input', Annotation(wfs_meta.data, 'i')),
+            Parameter('coeffs', Annotation(Type(real_dtype, coeffs_shape), 'i'))],
         """
         <%
             trajectory = idxs[0]
@@ -25,15 +37,100 @@ def get_multiply(wfs_meta):
         %>
         %for comp in range(components):
         ${output.ctype} psi_${comp} = ${input.load_idx}(${trajectory}, ${comp}, ${coords});
+        %if per_trajectory:
+        ${coeffs.ctype} coeff_${comp} = ${coeffs.load_idx}(${trajectory}, ${comp});
+        %else:
+        ${coeffs.ctype} coeff_${comp} = ${coeffs.load_idx}(${comp});
+        %endif
         ${output.store_idx}(
             ${trajectory}, ${comp}, ${coords},
-            ${mul}(psi_${comp}, ${locals()['coeff' + str(comp)]}));
+            ${mul}(psi_${comp}, coeff_${comp}));
         %endfor
         """,
         guiding_array=(wfs_meta.shape[0],) + wfs_meta.shape[2:],
         render_kwds=dict(
             components=wfs_meta.components,
-            mul=functions.mul(wfs_meta.dtype, real_dtype)))
+            per_trajectory=per_trajectory,
+            mul=functions.mul(wfs_meta.dtype, real_dtype, out_dtype=wfs_meta.dtype)))
+
+
+def get_coefficients_trf(populations_arr):
+    """
+    Returns a transformation calculating renormalization coefficients
+    ``sqrt(target_N / N)`` (or ``0`` if ``N == 0``) from the populations,
+    with the target populations taken from the ``targets`` parameter.
+    """
+    return Transformation(
+        [
+            Parameter('coeffs', Annotation(populations_arr, 'o')),
+            Parameter('populations', Annotation(populations_arr, 'i')),
+            Parameter('targets', Annotation(populations_arr, 'i'))],
+        """
+        ${populations.ctype} N = ${populations.load_same};
+        ${populations.ctype} target_N = ${targets.load_same};
+        ${coeffs.store_same}(N > 0 ? sqrt(target_N / N) : 0);
+        """)
+
+
+def get_targets_type(wfs_meta, per_trajectory=False):
+    """
+    Returns the array type of the target populations for :py:class:`NormalizationFilter`:
+    ``(trajectories, components)`` if ``per_trajectory`` is ``True``,
+    and ``(components,)`` otherwise.
+    """
+    if per_trajectory:
+        shape = (wfs_meta.trajectories, wfs_meta.components)
+    else:
+        shape = (wfs_meta.components,)
+    return Type(wfs_meta.accumulation_dtype, shape)
+
+
+class _Normalize(Computation):
+    """
+    Renormalizes the wavefunction so that the populations averaged over trajectories
+    are equal to the target ones.
+    If ``per_trajectory`` is ``True``, every trajectory is renormalized
+    to its own target populations instead.
+    The target populations are passed as an array,
+    and the populations and the coefficients are calculated and kept on the device.
+    """
+
+    def __init__(self, wfs_meta, per_trajectory=False):
+
+        if wfs_meta.representation == REPR_WIGNER:
+            modifier = -wfs_meta.modes / wfs_meta.grid.V / 2
+        else:
+            modifier = 0
+
+        spatial_axes = list(range(2, len(wfs_meta.shape)))
+        if per_trajectory:
+            self._populations = _ReduceNorm(
+                wfs_meta, axes=spatial_axes, scale=wfs_meta.grid.dV, modifier=modifier)
+        else:
+            # Populations averaged over trajectories
+            self._populations = _ReduceNorm(
+                wfs_meta, axes=[0] + spatial_axes,
+                scale=wfs_meta.grid.dV / wfs_meta.trajectories, modifier=modifier)
+
+        coeffs_trf = get_coefficients_trf(self._populations.parameter.result)
+        self._populations.parameter.result.connect(
+            coeffs_trf, coeffs_trf.populations,
+            coeffs=coeffs_trf.coeffs, targets=coeffs_trf.targets)
+
+        self._multiply = get_multiply(wfs_meta, per_trajectory=per_trajectory)
+
+        Computation.__init__(self, [
+            Parameter('output', Annotation(wfs_meta.data, 'o')),
+            Parameter('input', Annotation(wfs_meta.data, 'i')),
+            Parameter('targets', Annotation(get_targets_type(wfs_meta, per_trajectory), 'i'))])
+
+    def _build_plan(self, plan_factory, device_params, output, input_, targets):
+        plan = plan_factory()
+        coeffs = plan.temp_array_like(self._populations.parameter.coeffs)
+        plan.computation_call(
+            self._populations, coeffs=coeffs, wfs_data=input_, targets=targets)
+        plan.computation_call(self._multiply, output, input_, coeffs)
+        return plan
 
 
 class NormalizationFilter(Filter):
@@ -41,19 +138,306 @@ class NormalizationFilter(Filter):
     Bases: ``reiknacontrib.integrator.Filter``
 
     Renormalizes the wavefunction to the target population.
+    The renormalization is performed entirely on the device,
+    so it does not require synchronization with the host.
+    The target populations are kept in a device array,
+    so filters with different targets share the same compiled computation.
 
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
-    :param target_Ns: a tuple of target populations for each component.
+    :param target_Ns: a tuple of target populations for each component
+        (the populations averaged over trajectories are renormalized),
+        or an array with the shape ``(trajectories, components)``
+        with the target populations for each trajectory.
     """
 
     def __init__(self, wfs_meta, target_Ns):
-        self._population = DensityIntegralMeter(wfs_meta)
-        self._target_Ns = target_Ns
-        self._multiply = get_multiply(wfs_meta).compile(wfs_meta.thread)
+        self._thread = wfs_meta.thread
+        self._normalize = compile_cached(
+            wfs_meta.thread, _Normalize, wfs_meta,
+            per_trajectory=(numpy.ndim(target_Ns) == 2))
+        self._targets = self._thread.empty_like(self._normalize.parameter.targets)
+        self.set_targets(target_Ns)
+
+    def set_targets(self, target_Ns):
+        """
+        Sets new target populations
+        (of the same shape as the ones passed to the constructor).
+        """
+        target_Ns = numpy.asarray(target_Ns, self._targets.dtype)
+        assert target_Ns.shape == self._targets.shape
+        self._thread.to_device(target_Ns, dest=self._targets)
+
+    def __call__(self, wfs_data, t):
+        self._normalize(wfs_data, wfs_data, self._targets)
+
+
+def get_packed_norms_dtype(real_dtype):
+    """
+    Returns the struct dtype holding the squares of the two real fields of a packed element.
+    """
+    return dtypes.align(numpy.dtype([('first', real_dtype), ('second', real_dtype)]))
+
+
+def get_packed_norm_trf(packed_arr, norms_arr):
+    """
+    Returns a transformation calculating the squares of the two real fields
+    stored in a packed element (see :py:mod:`beclab.packing`).
+    """
+    real_dtype = norms_arr.dtype.fields['first'][0]
+    return Transformation(
+        [
+            Parameter('output', Annotation(norms_arr, 'o')),
+            Parameter('input', Annotation(packed_arr, 'i'))],
+        """
+        const ${input.ctype} packed = ${input.load_same};
+        const ${r_ctype} first = packed.x;
+        const ${r_ctype} second = packed.y;
+        ${output.ctype} norms;
+        norms.first = first * first;
+        norms.second = second * second;
+        ${output.store_same}(norms);
+        """,
+        render_kwds=dict(r_ctype=dtypes.ctype(real_dtype)))
+
+
+def get_packed_coefficients(wfs_meta, norms_arr, per_trajectory=False):
+    """
+    Returns a computation calculating renormalization coefficients
+    for the fields of ``wfs_meta`` (same as :py:func:`get_coefficients_trf`)
+    from the populations of the packed elements.
+    """
+    axis = get_packing_axis(wfs_meta)
+    targets_type = get_targets_type(wfs_meta, per_trajectory)
+    real_dtype = targets_type.dtype
+    return PureParallel(
+        [
+            Parameter('coeffs', Annotation(targets_type, 'o')),
+            Parameter('norms', Annotation(norms_arr, 'i')),
+            Parameter('targets', Annotation(targets_type, 'i'))],
+        """
+        <%
+            r_ctype = dtypes.ctype(r_dtype)
+            if per_trajectory:
+                t, c = idxs
+            else:
+                c, = idxs
+        %>
+        %if by_trajectories and per_trajectory:
+        const ${norms.ctype} norms = ${norms.load_idx}(${t} / 2, ${c});
+        const ${r_ctype} N = ${t} % 2 == 0 ? norms.first : norms.second;
+        %elif by_trajectories:
+        const ${norms.ctype} norms = ${norms.load_idx}(${c});
+        const ${r_ctype} N = norms.first + norms.second;
+        %elif per_trajectory:
+        const ${norms.ctype} norms = ${norms.load_idx}(${t}, ${c} / 2);
+        const ${r_ctype} N = ${c} % 2 == 0 ? norms.first : norms.second;
+        %else:
+        const ${norms.ctype} norms = ${norms.load_idx}(${c} / 2);
+        const ${r_ctype} N = ${c} % 2 == 0 ? norms.first : norms.second;
+        %endif
+        const ${r_ctype} scaled_N = N * ${dtypes.c_constant(scale, r_dtype)};
+        const ${r_ctype} target_N = ${targets.load_same};
+        ${coeffs.store_same}(scaled_N > 0 ? sqrt(target_N / scaled_N) : 0);
+        """,
+        guiding_array='coeffs',
+        render_kwds=dict(
+            by_trajectories=(axis == PACK_TRAJECTORIES),
+            per_trajectory=per_trajectory,
+            r_dtype=real_dtype,
+            scale=wfs_meta.grid.dV / (1 if per_trajectory else wfs_meta.trajectories)))
+
+
+def get_packed_multiply(wfs_meta, per_trajectory=False):
+    """
+    Returns a computation multiplying each of the real fields of ``wfs_meta``
+    in the packed storage by a coefficient.
+    """
+    axis = get_packing_axis(wfs_meta)
+    packed_meta = get_packed_meta(wfs_meta)
+    real_dtype = dtypes.real_for(packed_meta.dtype)
+    coeffs_type = get_targets_type(wfs_meta, per_trajectory)
+
+    def coeff_idx(t, c):
+        return "{t}, {c}".format(t=t, c=c) if per_trajectory else c
+
+    return PureParallel(
+        [
+            Parameter('output', Annotation(packed_meta.data, 'o')),
+            Parameter('input', Annotation(packed_meta.data, 'i')),
+            Parameter('coeffs', Annotation(coeffs_type, 'i'))],
+        """
+        <%
+            r_ctype = dtypes.ctype(r_dtype)
+            pt = idxs[0]
+            pc = idxs[1]
+            if by_trajectories:
+                first = coeff_idx("2 * " + pt, pc)
+                second = coeff_idx("2 * " + pt + " + 1", pc)
+                has_second = "2 * " + pt + " + 1 < " + str(trajectories)
+            else:
+                first = coeff_idx(pt, "2 * " + pc)
+                second = coeff_idx(pt, "2 * " + pc + " + 1")
+                has_second = "2 * " + pc + " + 1 < " + str(components)
+        %>
+        const ${input.ctype} packed = ${input.load_same};
+        const ${r_ctype} first = packed.x * (${r_ctype})${coeffs.load_idx}(${first});
+        const ${r_ctype} second = (${has_second}) ?
+            packed.y * (${r_ctype})${coeffs.load_idx}(${second}) : 0;
+        ${output.store_same}(COMPLEX_CTR(${output.ctype})(first, second));
+        """,
+        guiding_array='output',
+        render_kwds=dict(
+            by_trajectories=(axis == PACK_TRAJECTORIES),
+            trajectories=wfs_meta.trajectories,
+            components=wfs_meta.components,
+            coeff_idx=coeff_idx,
+            r_dtype=real_dtype))
+
+
+class _NormalizePacked(Computation):
+    """
+    Renormalizes the real fields in the packed storage so that the populations
+    averaged over trajectories (or the populations of every trajectory,
+    if ``per_trajectory`` is ``True``) are equal to the target ones.
+    The squares of both fields of a packed element are reduced together,
+    so the reduction goes over the packed shape and costs half as much as for the complex state.
+    """
+
+    def __init__(self, wfs_meta, per_trajectory=False):
+
+        packed_meta = get_packed_meta(wfs_meta)
+        norms_dtype = get_packed_norms_dtype(wfs_meta.accumulation_dtype)
+
+        spatial_axes = list(range(2, len(packed_meta.shape)))
+        if per_trajectory:
+            reduce_axes = spatial_axes
+        else:
+            reduce_axes = [0] + spatial_axes
+
+        norms_arr = Type(norms_dtype, packed_meta.shape)
+        self._reduce = Reduce(norms_arr, predicate_struct_sum(norms_dtype), axes=reduce_axes)
+        norm_trf = get_packed_norm_trf(packed_meta.data, norms_arr)
+        self._reduce.parameter.input.connect(norm_trf, norm_trf.output, packed_data=norm_trf.input)
+
+        self._coefficients = get_packed_coefficients(
+            wfs_meta, self._reduce.parameter.output, per_trajectory=per_trajectory)
+        self._multiply = get_packed_multiply(wfs_meta, per_trajectory=per_trajectory)
+
+        Computation.__init__(self, [
+            Parameter('output', Annotation(packed_meta.data, 'o')),
+            Parameter('input', Annotation(packed_meta.data, 'i')),
+            Parameter('targets', Annotation(get_targets_type(wfs_meta, per_trajectory), 'i'))])
+
+    def _build_plan(self, plan_factory, device_params, output, input_, targets):
+        plan = plan_factory()
+        norms = plan.temp_array_like(self._reduce.parameter.output)
+        coeffs = plan.temp_array_like(self._coefficients.parameter.coeffs)
+        plan.computation_call(self._reduce, norms, input_)
+        plan.computation_call(self._coefficients, coeffs, norms, targets)
+        plan.computation_call(self._multiply, output, input_, coeffs)
+        return plan
+
+
+class PackedNormalizationFilter(Filter):
+    """
+    Bases: ``reiknacontrib.integrator.Filter``
+
+    Renormalizes the real fields stored in packed form (see :py:mod:`beclab.packing`)
+    to the target population.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object
+        describing the unpacked wavefunction.
+    :param target_Ns: a tuple of target populations for each component
+        (the populations averaged over trajectories are renormalized),
+        or an array with the shape ``(trajectories, components)``
+        with the target populations for each trajectory.
+    """
+
+    def __init__(self, wfs_meta, target_Ns):
+        self._normalize = compile_cached(
+            wfs_meta.thread, _NormalizePacked, wfs_meta,
+            per_trajectory=(numpy.ndim(target_Ns) == 2))
+        self._targets = wfs_meta.thread.to_device(
+            numpy.asarray(target_Ns, self._normalize.parameter.targets.dtype))
+
+    def __call__(self, wfs_data, t):
+        self._normalize(wfs_data, wfs_data, self._targets)
+
+
+def get_freeze(wfs_meta):
+    """
+    Returns a computation replacing the trajectories marked in ``frozen``
+    with the corresponding trajectories of ``snapshot``.
+    """
+    return PureParallel(
+        [
+            Parameter('output', Annotation(wfs_meta.data, 'o')),
+            Parameter('input', Annotation(wfs_meta.data, 'i')),
+            Parameter('snapshot', Annotation(wfs_meta.data, 'i')),
+            Parameter('frozen', Annotation(Type(numpy.int32, wfs_meta.trajectories), 'i'))],
+        """
+        ${output.store_same}(
+            ${frozen.load_idx}(${idxs[0]}) ? ${snapshot.load_same} : ${input.load_same});
+        """,
+        guiding_array='output')
+
+
+class FreezeFilter(Filter):
+    """
+    Bases: ``reiknacontrib.integrator.Filter``
+
+    Keeps the chosen trajectories unchanged during the integration
+    by restoring their values saved at the moment of freezing.
+    Used to stop the propagation of converged states in a batch
+    (see :py:class:`~beclab.samplers.ConvergenceSampler`).
+    Should be the last one in the list of filters.
+
+    Only the newly frozen trajectories are copied on each freeze.
+    Note that the stepper still propagates the frozen trajectories
+    (the drift, the FFTs and the other filters are applied to the whole array,
+    and the values are restored after each step),
+    so the cost of a step does not decrease as the trajectories are frozen.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+
+    .. py:attribute:: frozen
+
+        A boolean numpy array with the shape ``(trajectories,)``
+        marking the frozen trajectories.
+    """
+
+    def __init__(self, wfs_meta):
+        self._thread = wfs_meta.thread
+        self._freeze = compile_cached(wfs_meta.thread, get_freeze, wfs_meta)
+        self._snapshot = self._thread.empty_like(wfs_meta.data)
+        self._frozen_device = self._thread.empty_like(self._freeze.parameter.frozen)
+        self.frozen = numpy.zeros(wfs_meta.trajectories, numpy.bool_)
+
+    def freeze(self, wfs_data, trajectories):
+        """
+        Freezes the trajectories with the given indices in their current state.
+        """
+        new_frozen = self.frozen.copy()
+        new_frozen[list(trajectories)] = True
+        if (new_frozen == self.frozen).all():
+            return
+
+        # Copying the contiguous runs of newly frozen trajectories
+        # (the trajectory is the first dimension of the array).
+        newly_frozen = new_frozen & ~self.frozen
+        traj_size = product(wfs_data.shape[1:])
+        indices = numpy.flatnonzero(newly_frozen)
+        run_starts = indices[numpy.concatenate([[True], numpy.diff(indices) > 1])]
+        run_ends = indices[numpy.concatenate([numpy.diff(indices) > 1, [True]])] + 1
+        for start, end in zip(run_starts, run_ends):
+            self._thread.copy_array(
+                wfs_data, dest=self._snapshot,
+                src_offset=start * traj_size, dest_offset=start * traj_size,
+                size=(end - start) * traj_size)
+
+        self.frozen = new_frozen
+        self._thread.to_device(self.frozen.astype(numpy.int32), dest=self._frozen_device)
 
     def __call__(self, wfs_data, t):
-        Ns = self._population(wfs_data).mean(0)
-        coeffs = [
-            numpy.sqrt(target_N / N) if N > 0 else 0
-            for target_N, N in zip(self._target_Ns, Ns)]
-        self._multiply(wfs_data, wfs_data, *coeffs)
+        if self.frozen.any():
+            self._freeze(wfs_data, wfs_data, self._snapshot, self._frozen_device)
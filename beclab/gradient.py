@@ -0,0 +1,450 @@
+import logging
+
+import numpy
+
+from reikna.cluda import dtypes, functions
+from reikna.core import Computation, Parameter, Annotation, Type, Transformation
+from reikna.transformations import mul_const
+from reikna.algorithms import Reduce, predicate_sum, PureParallel
+from reikna.fft import FFT
+from reiknacontrib.integrator import get_ksquared, RK46NLStepper
+
+from beclab.meters import HamiltonianMeter, get_kinetic_operator_trf
+from beclab.filters import NormalizationFilter
+from beclab.wavefunction import WavefunctionSet
+from beclab.bec import ImaginaryTimeGroundState
+from beclab.cache import compile_cached
+
+
+_logger = logging.getLogger(__name__)
+
+
+def get_gradient_trf(wfs_meta, system, mus_arr):
+    r"""
+    Returns a transformation calculating :math:`H \Psi_j - \mu_j \Psi_j`,
+    given :math:`\Psi_j` and the result of the kinetic part of :math:`H` applied to it.
+    The Hamiltonian is taken at ``t = 0``, like for the other ground state calculations.
+    """
+
+    real_dtype = wfs_meta.accumulation_dtype
+    if system.potential is not None:
+        potential = system.potential.get_module(
+            wfs_meta.dtype, wfs_meta.grid, system.components)
+    else:
+        potential = None
+
+    interactions = system.get_interactions(0)
+
+    return Transformation(
+        [
+            Parameter('gradient', Annotation(wfs_meta.data, 'o')),
+            Parameter('data', Annotation(wfs_meta.data, 'i')),
+            Parameter('kdata', Annotation(wfs_meta.data, 'i')),
+            Parameter('mus', Annotation(mus_arr, 'i'))],
+        """
+        <%
+            s_ctype = dtypes.ctype(s_dtype)
+            r_ctype = dtypes.ctype(r_dtype)
+            r_const = lambda x: dtypes.c_constant(x, r_dtype)
+
+            trajectory = idxs[0]
+            component = idxs[1]
+            coords = ", ".join(idxs[2:])
+        %>
+        %for comp in range(components):
+        const ${s_ctype} psi_${comp} = ${data.load_idx}(${trajectory}, ${comp}, ${coords});
+        const ${r_ctype} n_${comp} = ${norm}(psi_${comp});
+        %endfor
+
+        ${s_ctype} result = ${kdata.load_same};
+        %for comp in range(components):
+        if (${component} == ${comp})
+        {
+            %if potential is not None:
+            const ${r_ctype} V = ${potential}${comp}(${coords}, 0);
+            %else:
+            const ${r_ctype} V = 0;
+            %endif
+
+            const ${r_ctype} U =
+                0
+                %for other_comp in range(components):
+                + (${r_const(interactions[comp, other_comp])}) * n_${other_comp}
+                %endfor
+                ;
+
+            const ${r_ctype} mu = ${mus.load_idx}(${trajectory}, ${comp});
+            result = result + ${mul_sr}(psi_${comp}, V + U - mu);
+        }
+        %endfor
+
+        ${gradient.store_same}(result);
+        """,
+        render_kwds=dict(
+            components=wfs_meta.components,
+            potential=potential,
+            interactions=interactions,
+            s_dtype=wfs_meta.dtype,
+            r_dtype=real_dtype,
+            mul_sr=functions.mul(wfs_meta.dtype, real_dtype, out_dtype=wfs_meta.dtype),
+            norm=functions.norm(wfs_meta.dtype)))
+
+
+def get_preconditioner_trf(state_arr, ksquared_arr, shifts_arr, coeff):
+    r"""
+    Returns a transformation multiplying the Fourier components of the input
+    by :math:`m / (\alpha_j + \mathrm{coeff} k^2)`,
+    where :math:`\alpha_j` are taken from ``shifts``,
+    and :math:`m` is the cutoff mask.
+    """
+    real_dtype = dtypes.real_for(state_arr.dtype)
+    return Transformation(
+        [
+            Parameter('output', Annotation(state_arr, 'o')),
+            Parameter('input', Annotation(state_arr, 'i')),
+            Parameter('ksquared', Annotation(ksquared_arr, 'i')),
+            Parameter('mask', Annotation(ksquared_arr, 'i')),
+            Parameter('shifts', Annotation(shifts_arr, 'i'))],
+        """
+        ${ksquared.ctype} ksquared = ${ksquared.load_idx}(${', '.join(idxs[2:])});
+        ${mask.ctype} mask = ${mask.load_idx}(${', '.join(idxs[2:])});
+        ${ksquared.ctype} shift = ${shifts.load_idx}(${idxs[0]}, ${idxs[1]});
+        ${output.store_same}(${mul}(
+            ${input.load_same}, mask / (shift + ksquared * (${coeff}))));
+        """,
+        render_kwds=dict(
+            coeff=dtypes.c_constant(coeff, real_dtype),
+            mul=functions.mul(state_arr.dtype, real_dtype, out_dtype=state_arr.dtype)))
+
+
+class _PreconditionedGradient(Computation):
+    r"""
+    Calculates the gradient :math:`r_j = H \Psi_j - \mu_j \Psi_j` of the energy functional
+    and the preconditioned gradient :math:`(\alpha_j + T)^{-1} r_j`,
+    where :math:`T` is the kinetic energy operator (applied in the momentum space).
+    """
+
+    def __init__(self, wfs_meta, system):
+
+        real_dtype = wfs_meta.accumulation_dtype
+        coeffs_arr = Type(real_dtype, (wfs_meta.trajectories, wfs_meta.components))
+        axes = range(2, len(wfs_meta.shape))
+
+        self._ksquared = get_ksquared(wfs_meta.grid.shape, wfs_meta.grid.box).astype(
+            dtypes.real_for(wfs_meta.dtype))
+        if wfs_meta.cutoff is not None:
+            self._mask = wfs_meta.cutoff.get_mask(wfs_meta.grid).astype(self._ksquared.dtype)
+        else:
+            self._mask = numpy.ones_like(self._ksquared)
+
+        kinetic_trf = get_kinetic_operator_trf(
+            wfs_meta.data, self._ksquared, -system.kinetic_coeff)
+        self._fft = FFT(wfs_meta.data, axes=axes)
+        self._fft_with_kinetic = FFT(wfs_meta.data, axes=axes)
+        self._fft_with_kinetic.parameter.output.connect(
+            kinetic_trf, kinetic_trf.input,
+            output_prime=kinetic_trf.output, ksquared=kinetic_trf.ksquared)
+
+        gradient_trf = get_gradient_trf(wfs_meta, system, coeffs_arr)
+        self._gradient = PureParallel.from_trf(gradient_trf, guiding_array='gradient')
+
+        preconditioner_trf = get_preconditioner_trf(
+            wfs_meta.data, self._ksquared, coeffs_arr, -system.kinetic_coeff)
+        self._fft_with_preconditioner = FFT(wfs_meta.data, axes=axes)
+        self._fft_with_preconditioner.parameter.output.connect(
+            preconditioner_trf, preconditioner_trf.input,
+            output_prime=preconditioner_trf.output,
+            ksquared=preconditioner_trf.ksquared, mask=preconditioner_trf.mask,
+            shifts=preconditioner_trf.shifts)
+
+        Computation.__init__(self, [
+            Parameter('gradient', Annotation(wfs_meta.data, 'o')),
+            Parameter('direction', Annotation(wfs_meta.data, 'o')),
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i')),
+            Parameter('mus', Annotation(coeffs_arr, 'i')),
+            Parameter('shifts', Annotation(coeffs_arr, 'i'))])
+
+    def _build_plan(self, plan_factory, device_params, gradient, direction, wfs_data, mus, shifts):
+        plan = plan_factory()
+        kdata = plan.temp_array_like(wfs_data)
+        ksquared_device = plan.persistent_array(self._ksquared)
+        mask_device = plan.persistent_array(self._mask)
+
+        plan.computation_call(self._fft_with_kinetic, kdata, ksquared_device, wfs_data)
+        plan.computation_call(self._fft, kdata, kdata, inverse=True)
+        plan.computation_call(self._gradient, gradient, wfs_data, kdata, mus)
+
+        plan.computation_call(
+            self._fft_with_preconditioner,
+            output_prime=direction, ksquared=ksquared_device, mask=mask_device, shifts=shifts,
+            input=gradient)
+        plan.computation_call(self._fft, direction, direction, inverse=True)
+        return plan
+
+
+def get_dot_trf(wfs_meta):
+    real_dtype = wfs_meta.accumulation_dtype
+    return Transformation(
+        [
+            Parameter('output', Annotation(Type(real_dtype, wfs_meta.shape), 'o')),
+            Parameter('a', Annotation(wfs_meta.data, 'i')),
+            Parameter('b', Annotation(wfs_meta.data, 'i'))],
+        """
+        ${a.ctype} a = ${a.load_same};
+        ${b.ctype} b = ${b.load_same};
+        ${output.store_same}((${output.ctype})(a.x * b.x + a.y * b.y));
+        """)
+
+
+class _Dot(Computation):
+    """
+    Calculates the real parts of the inner products of two wavefunctions
+    for each trajectory and component.
+    """
+
+    def __init__(self, wfs_meta):
+        real_dtype = wfs_meta.accumulation_dtype
+
+        dot_trf = get_dot_trf(wfs_meta)
+        self._reduce = Reduce(
+            dot_trf.output, predicate_sum(real_dtype), axes=list(range(2, len(wfs_meta.shape))))
+        scale = mul_const(self._reduce.parameter.output, dtypes.cast(real_dtype)(wfs_meta.grid.dV))
+        self._reduce.parameter.output.connect(scale, scale.input, result=scale.output)
+        self._reduce.parameter.input.connect(dot_trf, dot_trf.output, a=dot_trf.a, b=dot_trf.b)
+
+        Computation.__init__(self, [
+            Parameter('result', Annotation(self._reduce.parameter.result, 'o')),
+            Parameter('a', Annotation(wfs_meta.data, 'i')),
+            Parameter('b', Annotation(wfs_meta.data, 'i'))])
+
+    def _build_plan(self, plan_factory, device_params, result, a, b):
+        plan = plan_factory()
+        plan.computation_call(self._reduce, result, a, b)
+        return plan
+
+
+def get_combine(wfs_meta):
+    """
+    Returns a computation calculating ``output = a * x + b * y``
+    with the coefficients ``a`` and ``b`` set for each trajectory and component.
+    """
+    real_dtype = wfs_meta.accumulation_dtype
+    coeffs_arr = Type(real_dtype, (wfs_meta.trajectories, wfs_meta.components))
+
+    return PureParallel(
+        [
+            Parameter('output', Annotation(wfs_meta.data, 'o')),
+            Parameter('x', Annotation(wfs_meta.data, 'i')),
+            Parameter('y', Annotation(wfs_meta.data, 'i')),
+            Parameter('a', Annotation(coeffs_arr, 'i')),
+            Parameter('b', Annotation(coeffs_arr, 'i'))],
+        """
+        ${output.store_same}(
+            ${mul}(${x.load_same}, ${a.load_idx}(${idxs[0]}, ${idxs[1]}))
+            + ${mul}(${y.load_same}, ${b.load_idx}(${idxs[0]}, ${idxs[1]})));
+        """,
+        guiding_array='output',
+        render_kwds=dict(
+            mul=functions.mul(wfs_meta.dtype, real_dtype, out_dtype=wfs_meta.dtype)))
+
+
+class GradientGroundState:
+    r"""
+    Ground state generator minimizing the energy functional
+    under the constraints on the populations of the components
+    with the preconditioned nonlinear conjugate gradient method.
+    The gradient :math:`r_j = H \Psi_j - \mu_j \Psi_j` is preconditioned by
+    :math:`(\alpha_j + T)^{-1}` (applied in the momentum space),
+    where :math:`T` is the kinetic energy operator
+    and :math:`\alpha_j` is the chemical potential of the component,
+    and the search directions are combined according to the Polak-Ribiere rule.
+    The step size is halved (resetting the conjugate directions)
+    whenever a step does not decrease the energy, and increased otherwise.
+    Takes much fewer iterations than the imaginary time propagation
+    for elongated traps, where the latter is limited by the stiff kinetic term.
+    The minimized state is then used as the initial state of
+    :py:class:`~beclab.ImaginaryTimeGroundState` with the same convergence parameters,
+    which, starting from a converged state, stops after a few samples;
+    thus the returned values and the convergence criteria are the same as for it.
+
+    The parameters are the same as for :py:class:`~beclab.ImaginaryTimeGroundState`,
+    except for:
+
+    :param verbose: whether to log the energy and the residual
+        after every iteration (to the ``beclab.gradient`` logger with the ``INFO`` level),
+        and to display the information about the final imaginary time propagation.
+    :param max_iterations: the maximum number of iterations.
+    :param step: the initial step size
+        (``1`` roughly corresponds to a step of the inverse iteration).
+
+    .. py:attribute:: wfs_meta
+
+        A :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object representing
+        the generated states.
+    """
+
+    def __init__(self, thr, dtype, grid, system, stepper_cls=RK46NLStepper,
+            cutoff=None, verbose=True, accumulation_dtype=None,
+            max_iterations=10000, step=0.5):
+
+        if grid.dimensions not in (1, 3):
+            raise NotImplementedError()
+
+        self.thr = thr
+        self.dtype = dtype
+        self.grid = grid
+        self.system = system
+
+        self._imaginary_time = ImaginaryTimeGroundState(
+            thr, dtype, grid, system, stepper_cls=stepper_cls, cutoff=cutoff,
+            verbose=verbose, accumulation_dtype=accumulation_dtype)
+        self.tf_gen = self._imaginary_time.tf_gen
+        self.wfs_meta = self.tf_gen.wfs_meta
+
+        self._verbose = verbose
+        self._max_iterations = max_iterations
+        self._step = step
+
+        self._meter = HamiltonianMeter(self.wfs_meta, system, residual=True)
+        self._gradient = compile_cached(thr, _PreconditionedGradient, self.wfs_meta, system)
+        self._dot = compile_cached(thr, _Dot, self.wfs_meta)
+        self._combine = compile_cached(thr, get_combine, self.wfs_meta)
+
+        self._real_dtype = self.wfs_meta.accumulation_dtype
+        self._coeffs = thr.empty_like(self._gradient.parameter.mus)
+        self._coeffs2 = thr.empty_like(self._gradient.parameter.mus)
+        self._dot_result = thr.empty_like(self._dot.parameter.result)
+
+    def _dot_product(self, a, b):
+        self._dot(self._dot_result, a, b)
+        return self._dot_result.get()
+
+    def _lincomb(self, output, x, y, a, b):
+        shape = self._coeffs.shape
+        self.thr.to_device(
+            numpy.broadcast_to(a, shape).astype(self._real_dtype), dest=self._coeffs)
+        self.thr.to_device(
+            numpy.broadcast_to(b, shape).astype(self._real_dtype), dest=self._coeffs2)
+        self._combine(output, x, y, self._coeffs, self._coeffs2)
+
+    def _project(self, vec, psi_data, Ns):
+        # Removing the component along psi (the tangent space of the norm constraint).
+        dot = self._dot_product(psi_data, vec)
+        coeffs = numpy.where(Ns > 0, dot / numpy.where(Ns > 0, Ns, 1), 0)
+        self._lincomb(vec, vec, psi_data, 1, -coeffs)
+
+    def __call__(self, Ns, E_diff=1e-9, E_conv=1e-9, sample_time=1e-3,
+            samplers=None, return_info=False, residual_limit=None):
+        """
+        Gererate a ground state with given populations.
+        The iterations continue until the relative difference in energy
+        between two successive iterations is less than ``E_diff``
+        (and the relative residual is less than ``residual_limit``, if it is given),
+        or until the energy stops decreasing.
+        The resulting state is passed as ``initial_state`` to
+        :py:meth:`ImaginaryTimeGroundState.__call__ <beclab.ImaginaryTimeGroundState.__call__>`
+        along with the rest of the parameters,
+        which have the same meaning, and its return values are returned.
+        The ``info`` object (if ``return_info`` is ``True``) has two additional attributes:
+        ``gradient_iterations`` (the number of the gradient iterations)
+        and ``gradient_converged`` (whether the iterations reached the convergence criteria
+        before the energy stopped decreasing; if that happened,
+        the flag is set only if ``residual_limit`` is given and the residual is below it).
+        """
+
+        assert len(Ns) == len(self.system.components)
+        Ns_arr = numpy.array(Ns, numpy.float64)[None, :]
+
+        psi = self.tf_gen(Ns)
+        trial = WavefunctionSet.for_meta(self.wfs_meta)
+        normalize = NormalizationFilter(self.wfs_meta, Ns)
+        normalize(psi.data, 0)
+
+        gradient = self.thr.empty_like(psi.data)
+        direction = self.thr.empty_like(psi.data)
+        prev_direction = self.thr.empty_like(psi.data)
+        search = self.thr.empty_like(psi.data)
+        mus_device = self.thr.empty_like(self._gradient.parameter.mus)
+        shifts_device = self.thr.empty_like(self._gradient.parameter.shifts)
+
+        E, mus, residual = self._meter(psi.data)
+        step = self._step
+        min_step = self._step * 1e-8
+        prev_rd = None
+        converged = False
+
+        for iteration in range(self._max_iterations):
+
+            # Preconditioned gradient, projected on the tangent space of the constraints
+            abs_mus = numpy.abs(mus)
+            shifts = numpy.maximum(abs_mus, abs_mus.max() * 1e-2)
+            self.thr.to_device(mus.astype(self._real_dtype), dest=mus_device)
+            self.thr.to_device(shifts.astype(self._real_dtype), dest=shifts_device)
+            self._gradient(gradient, direction, psi.data, mus_device, shifts_device)
+            self._project(direction, psi.data, Ns_arr)
+
+            # Polak-Ribiere conjugate direction
+            rd = self._dot_product(gradient, direction)
+            if prev_rd is not None:
+                prev_dot = self._dot_product(gradient, prev_direction)
+                beta = numpy.where(
+                    prev_rd > 0, (rd - prev_dot) / numpy.where(prev_rd > 0, prev_rd, 1), 0)
+                beta = numpy.maximum(beta, 0)
+                self._lincomb(search, direction, search, -1, beta)
+                self._project(search, psi.data, Ns_arr)
+                if self._dot_product(gradient, search).sum() >= 0:
+                    # Not a descent direction
+                    self._lincomb(search, direction, direction, -1, 0)
+            else:
+                self._lincomb(search, direction, direction, -1, 0)
+            self.thr.copy_array(direction, dest=prev_direction)
+            prev_rd = rd
+
+            # Trying the step, halving it until the energy decreases
+            while True:
+                self._lincomb(trial.data, psi.data, search, 1, step)
+                normalize(trial.data, 0)
+                new_E, new_mus, new_residual = self._meter(trial.data)
+                accepted = (new_E.sum() <= E.sum())
+                if accepted or step < min_step:
+                    break
+                step /= 2
+                # Restarting from the steepest descent
+                self._lincomb(search, direction, direction, -1, 0)
+                prev_rd = None
+
+            if not accepted:
+                # The energy cannot be decreased within the numerical precision;
+                # without a residual limit there is no way to tell if this is the minimum.
+                converged = (residual_limit is not None and residual.max() < residual_limit)
+                break
+
+            psi, trial = trial, psi
+            # The energy is zero if all the target populations are zero.
+            E_change = numpy.where(
+                new_E != 0, numpy.abs((new_E - E) / numpy.where(new_E != 0, new_E, 1)),
+                numpy.abs(new_E - E)).max()
+            E, mus, residual = new_E, new_mus, new_residual
+            step = min(step * 1.5, 1.)
+
+            if self._verbose:
+                _logger.info(
+                    "Iteration %d: E = %g, residual = %g, step = %g",
+                    iteration, E.sum(), residual.max(), step)
+
+            if E_change < E_diff and (residual_limit is None or residual.max() < residual_limit):
+                converged = True
+                break
+
+        result = self._imaginary_time(
+            Ns, E_diff=E_diff, E_conv=E_conv, sample_time=sample_time,
+            samplers=samplers, return_info=return_info, residual_limit=residual_limit,
+            initial_state=psi)
+
+        if return_info:
+            psi, result, info = result
+            info.gradient_iterations = iteration + 1
+            info.gradient_converged = converged
+            return psi, result, info
+        else:
+            return result
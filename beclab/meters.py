@@ -1,23 +1,89 @@
-from reikna.cluda import dtypes, functions
+import threading
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+import numpy
+
+import reikna.cluda as cluda
+from reikna.cluda import dtypes, functions, Snippet
 from reikna.core import Computation, Parameter, Annotation, Type, Transformation
 from reikna.transformations import mul_const, norm_const, add_const
-from reikna.algorithms import Reduce, predicate_sum, PureParallel
+from reikna.algorithms import Reduce, Predicate, predicate_sum, PureParallel
 from reikna.fft import FFT
 from reikna.helpers import product
 
 import beclab.constants as const
-from beclab.wavefunction import REPR_CLASSICAL, REPR_WIGNER
+from beclab.wavefunction import REPR_CLASSICAL, REPR_WIGNER, get_wigner_corrections
+from beclab.cache import cached, compile_cached, compile_computation
+from beclab.beam_splitter import get_splitter_trf
+from beclab.parameters import get_interactions_type
+from beclab.modules import get_interaction_ramp_modules
+from beclab.packing import get_unpack_trf
 from reiknacontrib.integrator import get_ksquared
 
 
+def connect_rotation(parameter, wfs_meta, rotated_components):
+    """
+    Connects the transformation of a beam splitter mixing the pair of components
+    ``rotated_components`` (see :py:meth:`beclab.BeamSplitter.get_transformation`)
+    to the ``parameter`` of a computation,
+    exposing its ``wfs_data``, ``thetas`` and ``phis`` parameters.
+    """
+    rotation = get_splitter_trf(wfs_meta.data, *rotated_components)
+    parameter.connect(
+        rotation, rotation.output,
+        wfs_data=rotation.input, thetas=rotation.thetas, phis=rotation.phis)
+
+
+def get_rotation_args(beam_splitter, theta, t):
+    """
+    Returns the list of additional arguments for a meter computation
+    with a connected beam splitter transformation.
+    """
+    if beam_splitter is None:
+        return []
+    else:
+        return list(beam_splitter.get_angles(t, theta))
+
+
+def rotation_parameters(wfs_meta, rotated_components):
+    if rotated_components is None:
+        return []
+
+    real_dtype = dtypes.real_for(wfs_meta.dtype)
+    angles_arr = Type(real_dtype, wfs_meta.trajectories)
+    return [
+        Parameter('thetas', Annotation(angles_arr, 'i')),
+        Parameter('phis', Annotation(angles_arr, 'i'))]
+
+
+def get_norm_trf(state_arr, real_dtype):
+    """
+    Returns a transformation calculating ``abs(psi) ** 2``
+    and storing it in an array of ``real_dtype``.
+    """
+    return Transformation(
+        [
+            Parameter('output', Annotation(Type(real_dtype, state_arr.shape), 'o')),
+            Parameter('input', Annotation(state_arr, 'i'))],
+        """
+        ${output.store_same}((${output.ctype})${norm}(${input.load_same}));
+        """,
+        render_kwds=dict(norm=functions.norm(state_arr.dtype)))
+
+
 class _ReduceNorm(Computation):
     """
     Calculates (abs(psi) ** 2 + modifier).sum(axes) * scale.
+    If ``rotated_components`` is given, a beam splitter mixing this pair of components
+    is applied to psi beforehand.
     """
 
-    def __init__(self, wfs_meta, axes=None, modifier=0, scale=1):
+    def __init__(self, wfs_meta, axes=None, modifier=0, scale=1, rotated_components=None):
 
-        real_dtype = dtypes.real_for(wfs_meta.dtype)
+        real_dtype = wfs_meta.accumulation_dtype
 
         real_arr = Type(real_dtype, wfs_meta.shape)
         self._reduce = Reduce(real_arr, predicate_sum(real_dtype), axes=axes)
@@ -25,33 +91,42 @@ class _ReduceNorm(Computation):
         result_arr = self._reduce.parameter.output
         reduce_size = self._reduce.parameter.input.size // self._reduce.parameter.output.size
 
-        norm_trf = norm_const(wfs_meta.data, 2)
-        self._reduce.parameter.input.connect(norm_trf, norm_trf.output, wfs_data=norm_trf.input)
+        norm_trf = get_norm_trf(wfs_meta.data, real_dtype)
+        if rotated_components is None:
+            self._reduce.parameter.input.connect(
+                norm_trf, norm_trf.output, wfs_data=norm_trf.input)
+        else:
+            self._reduce.parameter.input.connect(
+                norm_trf, norm_trf.output, rotated_data=norm_trf.input)
+            connect_rotation(self._reduce.parameter.rotated_data, wfs_meta, rotated_components)
 
         scale_trf = mul_const(result_arr, dtypes.cast(real_dtype)(scale))
         self._reduce.parameter.output.connect(scale_trf, scale_trf.input, scaled=scale_trf.output)
 
         if modifier != 0:
             scaled_modifier = modifier * reduce_size * scale
-            add_trf = add_const(result_arr, scaled_modifier)
+            add_trf = add_const(result_arr, dtypes.cast(real_dtype)(scaled_modifier))
             self._reduce.parameter.scaled.connect(add_trf, add_trf.input, result=add_trf.output)
 
         Computation.__init__(self, [
             Parameter('result', Annotation(result_arr, 'o')),
-            Parameter('wfs_data', Annotation(wfs_meta.data, 'i'))])
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i'))]
+            + rotation_parameters(wfs_meta, rotated_components))
 
-    def _build_plan(self, plan_factory, device_params, populations, wfs_data):
+    def _build_plan(self, plan_factory, device_params, populations, wfs_data, *angles):
         plan = plan_factory()
-        plan.computation_call(self._reduce, populations, wfs_data)
+        plan.computation_call(self._reduce, populations, wfs_data, *angles)
         return plan
 
 
 class _SliceNorm(Computation):
     """
     Calculates (abs(psi) ** 2 + modifier)[..axes..].
+    If ``rotated_components`` is given, a beam splitter mixing this pair of components
+    is applied to psi beforehand.
     """
 
-    def __init__(self, wfs_meta, fixed_axes={}, modifier=0):
+    def __init__(self, wfs_meta, fixed_axes={}, modifier=0, rotated_components=None):
 
         sliced_shape = tuple(
             dim for axis, dim in enumerate(wfs_meta.shape) if axis not in fixed_axes)
@@ -85,13 +160,17 @@ class _SliceNorm(Computation):
             self._slice_comp.parameter.normed_output.connect(
                 add_trf, add_trf.input, result=add_trf.output)
 
+        if rotated_components is not None:
+            connect_rotation(self._slice_comp.parameter.input, wfs_meta, rotated_components)
+
         Computation.__init__(self, [
             Parameter('result', Annotation(result_arr, 'o')),
-            Parameter('wfs_data', Annotation(wfs_meta.data, 'i'))])
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i'))]
+            + rotation_parameters(wfs_meta, rotated_components))
 
-    def _build_plan(self, plan_factory, device_params, result, wfs_data):
+    def _build_plan(self, plan_factory, device_params, result, wfs_data, *angles):
         plan = plan_factory()
-        plan.computation_call(self._slice_comp, result, wfs_data)
+        plan.computation_call(self._slice_comp, result, wfs_data, *angles)
         return plan
 
 
@@ -111,10 +190,26 @@ class DensityIntegralMeter:
 
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
     :param axes: indices of axes to integrate over (integrates over all axes if not given).
+    :param beam_splitter: a :py:class:`~beclab.BeamSplitter` object.
+        If given, it will be applied to the wavefunction on the fly during the measurement
+        (the original wavefunction is not modified).
+    :param theta: a rotation angle to pass to the beam splitter.
+
+    .. py:attribute:: computation
+
+        The uncompiled Reikna computation with the signature ``(result, wfs_data)``
+        (followed by ``thetas`` and ``phis`` if ``beam_splitter`` is given).
     """
 
-    def __init__(self, wfs_meta, axes=None):
+    def __init__(self, wfs_meta, axes=None, beam_splitter=None, theta=0):
         thread = wfs_meta.thread
+        self._beam_splitter = beam_splitter
+        self._theta = theta
+
+        if beam_splitter is not None:
+            rotated_components = beam_splitter.components
+        else:
+            rotated_components = None
 
         if wfs_meta.representation == REPR_WIGNER:
             modifier = -wfs_meta.modes / wfs_meta.grid.V / 2
@@ -129,16 +224,28 @@ class DensityIntegralMeter:
 
         # shifting to accommodate the trajectory and the component axes
         axes = [axis + 2 for axis in axes]
-        self._meter = _ReduceNorm(
-            wfs_meta, axes=axes, scale=scale, modifier=modifier).compile(thread)
+        self.computation = cached(
+            lambda: _ReduceNorm(
+                wfs_meta, axes=axes, scale=scale, modifier=modifier,
+                rotated_components=rotated_components),
+            _ReduceNorm, wfs_meta, axes, scale, modifier, rotated_components)
+        self._meter = compile_computation(thread, self.computation)
         self._out = thread.empty_like(self._meter.parameter.result)
 
-    def __call__(self, wfs_data):
+    def get_arguments(self, t=0):
+        """
+        Returns the list of arguments of :py:attr:`computation` following ``wfs_data``
+        for the measurement at time ``t``.
+        """
+        return get_rotation_args(self._beam_splitter, self._theta, t)
+
+    def __call__(self, wfs_data, t=0):
         """
         Returns a numpy array with the shape ``(trajectories, components, size)``
         with the projected density.
+        ``t`` is the time of the measurement (affects the phase of the beam splitter, if any).
         """
-        self._meter(self._out, wfs_data)
+        self._meter(self._out, wfs_data, *self.get_arguments(t))
         return self._out.get()
 
 
@@ -149,10 +256,26 @@ class DensitySliceMeter:
 
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
     :param fixed_axes: a dictionary ``{axis: value}`` of fixed indices for the slice.
+    :param beam_splitter: a :py:class:`~beclab.BeamSplitter` object.
+        If given, it will be applied to the wavefunction on the fly during the measurement
+        (the original wavefunction is not modified).
+    :param theta: a rotation angle to pass to the beam splitter.
+
+    .. py:attribute:: computation
+
+        The uncompiled Reikna computation with the signature ``(result, wfs_data)``
+        (followed by ``thetas`` and ``phis`` if ``beam_splitter`` is given).
     """
 
-    def __init__(self, wfs_meta, fixed_axes={}):
+    def __init__(self, wfs_meta, fixed_axes={}, beam_splitter=None, theta=0):
         thread = wfs_meta.thread
+        self._beam_splitter = beam_splitter
+        self._theta = theta
+
+        if beam_splitter is not None:
+            rotated_components = beam_splitter.components
+        else:
+            rotated_components = None
 
         if wfs_meta.representation == REPR_WIGNER:
             modifier = -wfs_meta.modes / wfs_meta.grid.V / 2
@@ -161,34 +284,721 @@ class DensitySliceMeter:
 
         fixed_axes = {axis+2:value for axis, value in fixed_axes.items()}
 
-        self._meter = _SliceNorm(
-            wfs_meta, fixed_axes=fixed_axes, modifier=modifier).compile(thread)
+        self.computation = cached(
+            lambda: _SliceNorm(
+                wfs_meta, fixed_axes=fixed_axes, modifier=modifier,
+                rotated_components=rotated_components),
+            _SliceNorm, wfs_meta, fixed_axes, modifier, rotated_components)
+        self._meter = compile_computation(thread, self.computation)
         self._out = thread.empty_like(self._meter.parameter.result)
 
-    def __call__(self, wfs_data):
+    def get_arguments(self, t=0):
+        """
+        Returns the list of arguments of :py:attr:`computation` following ``wfs_data``
+        for the measurement at time ``t``.
+        """
+        return get_rotation_args(self._beam_splitter, self._theta, t)
+
+    def __call__(self, wfs_data, t=0):
         """
         Returns a numpy array with the shape ``(trajectories, components, size)``
         with the projected density.
+        ``t`` is the time of the measurement (affects the phase of the beam splitter, if any).
+        """
+        self._meter(self._out, wfs_data, *self.get_arguments(t))
+        return self._out.get()
+
+
+def get_overlap_trf(wfs_meta, comp1, comp2):
+    complex_dtype = dtypes.complex_for(wfs_meta.accumulation_dtype)
+    overlap_arr = Type(complex_dtype, (wfs_meta.shape[0],) + wfs_meta.shape[2:])
+    return Transformation(
+        [
+            Parameter('overlap', Annotation(overlap_arr, 'o')),
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i'))],
+        """
+        <%
+            trajectory = idxs[0]
+            coords = ", ".join(idxs[1:])
+        %>
+        ${overlap.ctype} psi_1 = ${cast}(
+            ${wfs_data.load_idx}(${trajectory}, ${comp1}, ${coords}));
+        ${overlap.ctype} psi_2 = ${cast}(
+            ${wfs_data.load_idx}(${trajectory}, ${comp2}, ${coords}));
+        ${overlap.store_same}(${mul}(${conj}(psi_1), psi_2));
+        """,
+        render_kwds=dict(
+            comp1=comp1,
+            comp2=comp2,
+            cast=functions.cast(complex_dtype, wfs_meta.dtype),
+            mul=functions.mul(complex_dtype, complex_dtype),
+            conj=functions.conj(complex_dtype)))
+
+
+class _ReduceOverlap(Computation):
+    """
+    Calculates (conj(psi[comp1]) * psi[comp2]).sum(spatial axes) * scale.
+    """
+
+    def __init__(self, wfs_meta, comp1, comp2, scale=1):
+
+        real_dtype = wfs_meta.accumulation_dtype
+        complex_dtype = dtypes.complex_for(real_dtype)
+
+        overlap_arr = Type(complex_dtype, (wfs_meta.shape[0],) + wfs_meta.shape[2:])
+        self._reduce = Reduce(
+            overlap_arr, predicate_sum(complex_dtype),
+            axes=list(range(1, len(overlap_arr.shape))))
+
+        result_arr = self._reduce.parameter.output
+
+        overlap_trf = get_overlap_trf(wfs_meta, comp1, comp2)
+        self._reduce.parameter.input.connect(
+            overlap_trf, overlap_trf.overlap, wfs_data=overlap_trf.wfs_data)
+
+        scale_trf = mul_const(result_arr, dtypes.cast(real_dtype)(scale))
+        self._reduce.parameter.output.connect(scale_trf, scale_trf.input, result=scale_trf.output)
+
+        Computation.__init__(self, [
+            Parameter('result', Annotation(result_arr, 'o')),
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i'))])
+
+    def _build_plan(self, plan_factory, device_params, result, wfs_data):
+        plan = plan_factory()
+        plan.computation_call(self._reduce, result, wfs_data)
+        return plan
+
+
+class OverlapMeter:
+    r"""
+    Measures the overlap of two components
+    :math:`I_{jk} = \int \Psi_j^* \Psi_k d\mathbf{x}` for each trajectory.
+    The reduction is performed on the device, so only ``trajectories`` complex numbers
+    are transferred to the host.
+
+    .. note::
+
+        For :math:`j \ne k` the symmetric ordering does not introduce any correction terms,
+        so the same expression is used for all representations.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param comp1: the number of the first (conjugated) component :math:`j`.
+    :param comp2: the number of the second component :math:`k`.
+
+    .. py:attribute:: computation
+
+        The uncompiled Reikna computation with the signature ``(result, wfs_data)``.
+    """
+
+    def __init__(self, wfs_meta, comp1=0, comp2=1):
+        thread = wfs_meta.thread
+        self.computation = cached(
+            lambda: _ReduceOverlap(wfs_meta, comp1, comp2, scale=wfs_meta.grid.dV),
+            _ReduceOverlap, wfs_meta, comp1, comp2)
+        self._meter = compile_computation(thread, self.computation)
+        self._out = thread.empty_like(self._meter.parameter.result)
+
+    def get_arguments(self, t=0):
+        """
+        Returns the list of arguments of :py:attr:`computation` following ``wfs_data``
+        (empty for this meter).
+        """
+        return []
+
+    def __call__(self, wfs_data):
+        """
+        Returns a numpy array with the shape ``(trajectories,)`` with the overlap values.
         """
         self._meter(self._out, wfs_data)
         return self._out.get()
 
 
-def get_energy_trf(wfs_meta, system):
+def get_visibility_dtype(real_dtype):
+    """
+    Returns the struct dtype of a single element of the visibility reduction.
+    """
+    return dtypes.align(numpy.dtype([
+        ('N1', real_dtype), ('N2', real_dtype), ('I_re', real_dtype), ('I_im', real_dtype)]))
+
+
+def predicate_struct_sum(dtype):
+    """
+    Returns a ``Predicate`` object which sums all the fields of its struct arguments.
+    """
+    return Predicate(
+        Snippet.create(
+            lambda v1, v2: """
+            ${ctype} result;
+            %for field in fields:
+            result.${field} = ${v1}.${field} + ${v2}.${field};
+            %endfor
+            return result;
+            """,
+            render_kwds=dict(ctype=dtypes.ctype_module(dtype), fields=dtype.names)),
+        numpy.zeros(1, dtype)[0])
 
-    real_dtype = dtypes.real_for(wfs_meta.dtype)
-    if system.potential is not None:
+
+def get_visibility_trf(wfs_meta, vis_arr, comp1, comp2, modifier=0, scale=1):
+    real_dtype = wfs_meta.accumulation_dtype
+    complex_dtype = dtypes.complex_for(real_dtype)
+    return Transformation(
+        [
+            Parameter('output', Annotation(vis_arr, 'o')),
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i'))],
+        """
+        <%
+            trajectory = idxs[0]
+            coords = ", ".join(idxs[1:])
+        %>
+        ${c_ctype} psi_1 = ${cast}(${wfs_data.load_idx}(${trajectory}, ${comp1}, ${coords}));
+        ${c_ctype} psi_2 = ${cast}(${wfs_data.load_idx}(${trajectory}, ${comp2}, ${coords}));
+        ${c_ctype} overlap = ${mul}(${conj}(psi_1), psi_2);
+
+        ${output.ctype} result;
+        result.N1 = (${norm}(psi_1) + (${r_const(modifier)})) * (${r_const(scale)});
+        result.N2 = (${norm}(psi_2) + (${r_const(modifier)})) * (${r_const(scale)});
+        result.I_re = overlap.x * (${r_const(scale)});
+        result.I_im = overlap.y * (${r_const(scale)});
+        ${output.store_same}(result);
+        """,
+        render_kwds=dict(
+            comp1=comp1,
+            comp2=comp2,
+            modifier=modifier,
+            scale=scale,
+            r_const=lambda x: dtypes.c_constant(x, real_dtype),
+            c_ctype=dtypes.ctype(complex_dtype),
+            cast=functions.cast(complex_dtype, wfs_meta.dtype),
+            mul=functions.mul(complex_dtype, complex_dtype),
+            conj=functions.conj(complex_dtype),
+            norm=functions.norm(complex_dtype)))
+
+
+class _ReduceVisibility(Computation):
+    """
+    Calculates populations of ``comp1`` and ``comp2`` (with the given modifier)
+    and their overlap in a single reduction over spatial axes.
+    """
+
+    def __init__(self, wfs_meta, comp1, comp2, modifier=0, scale=1):
+
+        real_dtype = wfs_meta.accumulation_dtype
+        vis_dtype = get_visibility_dtype(real_dtype)
+
+        vis_arr = Type(vis_dtype, (wfs_meta.shape[0],) + wfs_meta.shape[2:])
+        self._reduce = Reduce(
+            vis_arr, predicate_struct_sum(vis_dtype),
+            axes=list(range(1, len(vis_arr.shape))))
+
+        vis_trf = get_visibility_trf(
+            wfs_meta, vis_arr, comp1, comp2, modifier=modifier, scale=scale)
+        self._reduce.parameter.input.connect(
+            vis_trf, vis_trf.output, wfs_data=vis_trf.wfs_data)
+
+        Computation.__init__(self, [
+            Parameter('result', Annotation(self._reduce.parameter.output, 'o')),
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i'))])
+
+    def _build_plan(self, plan_factory, device_params, result, wfs_data):
+        plan = plan_factory()
+        plan.computation_call(self._reduce, result, wfs_data)
+        return plan
+
+
+class VisibilityMeter:
+    r"""
+    Measures the populations :math:`N_j`, :math:`N_k` of two components
+    and their overlap :math:`I_{jk} = \int \Psi_j^* \Psi_k d\mathbf{x}`
+    in a single pass over the wavefunction
+    (the Wigner correction for populations is applied in the same pass).
+    The visibility can be then calculated as :math:`2 \vert I_{jk} \vert / (N_j + N_k)`.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param comp1: the number of the first (conjugated) component :math:`j`.
+    :param comp2: the number of the second component :math:`k`.
+    """
+
+    def __init__(self, wfs_meta, comp1=0, comp2=1):
+        thread = wfs_meta.thread
+
+        if wfs_meta.representation == REPR_WIGNER:
+            modifier = -wfs_meta.modes / wfs_meta.grid.V / 2
+        else:
+            modifier = 0
+
+        self._meter = compile_cached(
+            thread, _ReduceVisibility, wfs_meta, comp1, comp2,
+            modifier=modifier, scale=wfs_meta.grid.dV)
+        self._out = thread.empty_like(self._meter.parameter.result)
+
+    def __call__(self, wfs_data):
+        """
+        Returns a tuple ``(Ns, Is)``, where ``Ns`` is a real numpy array
+        with the shape ``(trajectories, 2)`` containing the populations,
+        and ``Is`` is a complex numpy array with the shape ``(trajectories,)``
+        containing the overlaps.
+        """
+        self._meter(self._out, wfs_data)
+        result = self._out.get()
+        Ns = numpy.vstack([result['N1'], result['N2']]).T
+        Is = result['I_re'] + 1j * result['I_im']
+        return Ns, Is
+
+
+def get_pack(packed_arr, arrs):
+    """
+    Returns a computation that flattens the arrays from the list ``arrs``
+    into a single real array ``packed_arr``, one after another
+    (complex values are stored as pairs of real numbers).
+    """
+    layout = []
+    offset = 0
+    for arr in arrs:
+        width = 2 if dtypes.is_complex(arr.dtype) else 1
+        strides = [product(arr.shape[axis+1:]) for axis in range(len(arr.shape))]
+        index_exprs = ", ".join(
+            "(flat / " + str(stride) + ") % " + str(dim)
+            for stride, dim in zip(strides, arr.shape))
+        offset += width * product(arr.shape)
+        layout.append((offset, width, index_exprs))
+
+    # The template refers to the inputs by their parameter names.
+    input_names = ['input' + str(i) for i in range(len(arrs))]
+
+    return PureParallel(
+        [Parameter('packed', Annotation(packed_arr, 'o'))]
+            + [Parameter(name, Annotation(arr, 'i')) for name, arr in zip(input_names, arrs)],
+        """
+        <%
+            idx = idxs[0]
+            start = 0
+            inputs = [""" + ", ".join(input_names) + """]
+        %>
+        %for i, (arr, (end, width, index_exprs)) in enumerate(zip(inputs, layout)):
+        ${"if" if i == 0 else "else if"} (${idx} < ${end})
+        {
+            const VSIZE_T flat = (${idx} - ${start}) / ${width};
+            const ${arr.ctype} val = ${arr.load_idx}(${index_exprs});
+            %if width == 2:
+            ${packed.store_idx}(${idx}, (${idx} - ${start}) % 2 == 0 ? val.x : val.y);
+            %else:
+            ${packed.store_idx}(${idx}, val);
+            %endif
+        }
+        <%
+            start = end
+        %>
+        %endfor
+        """,
+        render_kwds=dict(layout=layout))
+
+
+class _MeterGroup(Computation):
+    """
+    Calls several meter computations and packs their results into a single array.
+    """
+
+    def __init__(self, wfs_meta, computations):
+
+        self._computations = computations
+        self._result_types = [comp.parameter[0] for comp in computations]
+
+        # The packed array must be able to hold the results of every meter
+        # without losing precision.
+        packed_dtype = dtypes.result_type(
+            wfs_meta.accumulation_dtype,
+            *[dtypes.real_for(arr.dtype) if dtypes.is_complex(arr.dtype) else arr.dtype
+                for arr in self._result_types])
+
+        packed_size = sum(
+            (2 if dtypes.is_complex(arr.dtype) else 1) * product(arr.shape)
+            for arr in self._result_types)
+        packed_arr = Type(packed_dtype, packed_size)
+        self._pack = get_pack(packed_arr, self._result_types)
+
+        # The parameters of the meters following ``wfs_data``
+        # (e.g. beam splitter angles), suffixed with the number of the meter.
+        self._extra_params = [
+            list(comp.signature.parameters.values())[2:] for comp in computations]
+        extra_params = [
+            Parameter(param.name + str(i), param.annotation)
+            for i, params in enumerate(self._extra_params) for param in params]
+
+        Computation.__init__(self, [
+            Parameter('packed', Annotation(packed_arr, 'o')),
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i'))]
+            + extra_params)
+
+    def _build_plan(self, plan_factory, device_params, packed, wfs_data, *args):
+        plan = plan_factory()
+        args = list(args)
+        results = []
+        for comp, params, result_type in zip(
+                self._computations, self._extra_params, self._result_types):
+            result = plan.temp_array_like(result_type)
+            comp_args = args[:len(params)]
+            args = args[len(params):]
+            plan.computation_call(comp, result, wfs_data, *comp_args)
+            results.append(result)
+        plan.computation_call(self._pack, packed, *results)
+        return plan
+
+
+class MeterGroup:
+    """
+    Combines several meters into one computation
+    which writes all the results into a single packed array,
+    so that they can be obtained with a single device-to-host transfer.
+    The kernels of the meters are still launched separately
+    (each of them reading the wavefunction),
+    so the saving is in the number of transfers and synchronizations with the host.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param meters: a list of meter objects having the ``computation`` attribute
+        and the ``get_arguments()`` method
+        (:py:class:`DensityIntegralMeter`, :py:class:`DensitySliceMeter`,
+        :py:class:`OverlapMeter` or :py:class:`EnergyMeter`).
+    """
+
+    def __init__(self, wfs_meta, meters):
+        thread = wfs_meta.thread
+
+        self._meters = meters
+        self._meter = compile_cached(
+            thread, _MeterGroup, wfs_meta, [meter.computation for meter in meters])
+        self._out = thread.empty_like(self._meter.parameter.packed)
+
+        self._layout = []
+        offset = 0
+        for meter in meters:
+            result_type = meter.computation.parameter[0]
+            size = product(result_type.shape)
+            if dtypes.is_complex(result_type.dtype):
+                self._layout.append((offset, 2 * size, result_type.dtype, result_type.shape))
+                offset += 2 * size
+            else:
+                self._layout.append((offset, size, None, result_type.shape))
+                offset += size
+
+    def __call__(self, wfs_data, t=0):
+        """
+        Returns a list of numpy arrays with the results of the meters
+        (in the same order as the ``meters`` list given to the constructor).
+        ``t`` is the time of the measurement (affects the phase of the beam splitters, if any).
+        """
+        args = []
+        for meter in self._meters:
+            args += meter.get_arguments(t)
+
+        self._meter(self._out, wfs_data, *args)
+        packed = self._out.get()
+
+        results = []
+        for offset, size, complex_dtype, shape in self._layout:
+            result = packed[offset:offset+size]
+            if complex_dtype is not None:
+                result = result.view(complex_dtype)
+            results.append(result.reshape(shape))
+        return results
+
+
+def get_keep_trajectories(values_arr, keep_trajectories):
+    kept_arr = Type(values_arr.dtype, (keep_trajectories,) + values_arr.shape[1:])
+    return PureParallel(
+        [
+            Parameter('output', Annotation(kept_arr, 'o')),
+            Parameter('input', Annotation(values_arr, 'i'))],
+        """
+        ${output.store_idx}(${idxs.all()}, ${input.load_idx}(${idxs.all()}));
+        """)
+
+
+class _EnsembleStatistics(Computation):
+    """
+    Calls the meter computation and calculates the mean and the mean square of its result
+    over the trajectory axis.
+    Optionally, copies the per-trajectory results for the first ``keep_trajectories``
+    trajectories.
+    """
+
+    def __init__(self, computation, keep_trajectories=0):
+
+        self._computation = computation
+        self._keep_trajectories = keep_trajectories
+
+        values_arr = computation.parameter[0]
+        self._values_arr = values_arr
+        real_dtype = dtypes.real_for(values_arr.dtype)
+        inv_trajectories = dtypes.cast(real_dtype)(1. / values_arr.shape[0])
+
+        self._mean = Reduce(values_arr, predicate_sum(values_arr.dtype), axes=[0])
+        scale = mul_const(self._mean.parameter.output, inv_trajectories)
+        self._mean.parameter.output.connect(scale, scale.input, mean=scale.output)
+
+        self._mean_sq = Reduce(
+            Type(real_dtype, values_arr.shape), predicate_sum(real_dtype), axes=[0])
+        norm_trf = norm_const(values_arr, 2)
+        self._mean_sq.parameter.input.connect(norm_trf, norm_trf.output, values=norm_trf.input)
+        scale_sq = mul_const(self._mean_sq.parameter.output, inv_trajectories)
+        self._mean_sq.parameter.output.connect(scale_sq, scale_sq.input, mean_sq=scale_sq.output)
+
+        params = [
+            Parameter('mean', Annotation(self._mean.parameter.mean, 'o')),
+            Parameter('mean_sq', Annotation(self._mean_sq.parameter.mean_sq, 'o'))]
+
+        if keep_trajectories > 0:
+            self._keep = get_keep_trajectories(values_arr, keep_trajectories)
+            params.append(Parameter('kept', Annotation(self._keep.parameter.output, 'o')))
+
+        # Meter parameters (``wfs_data`` and, possibly, beam splitter angles)
+        params += list(computation.signature.parameters.values())[1:]
+
+        Computation.__init__(self, params)
+
+    def _build_plan(self, plan_factory, device_params, mean, mean_sq, *args):
+        plan = plan_factory()
+
+        if self._keep_trajectories > 0:
+            kept = args[0]
+            args = args[1:]
+
+        values = plan.temp_array_like(self._values_arr)
+        plan.computation_call(self._computation, values, *args)
+        plan.computation_call(self._mean, mean, values)
+        plan.computation_call(self._mean_sq, mean_sq, values)
+
+        if self._keep_trajectories > 0:
+            plan.computation_call(self._keep, kept, values)
+
+        return plan
+
+
+class EnsembleStatisticsMeter:
+    """
+    Wraps a meter, calculating the mean and the standard error of its results
+    over trajectories on the device.
+    Only the mean, the mean square
+    and (optionally) the results for the first ``keep_trajectories`` trajectories
+    are transferred to the host,
+    so the transfer size does not depend on the number of trajectories.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param meter: a meter object having the ``computation`` attribute
+        and the ``get_arguments()`` method
+        (:py:class:`DensityIntegralMeter`, :py:class:`DensitySliceMeter`,
+        :py:class:`OverlapMeter` or :py:class:`EnergyMeter`).
+    :param keep_trajectories: the number of first trajectories
+        for which per-trajectory results will be returned as well.
+    """
+
+    def __init__(self, wfs_meta, meter, keep_trajectories=0):
+        thread = wfs_meta.thread
+
+        self._trajectories = wfs_meta.trajectories
+        self._source = meter
+        self._keep_trajectories = keep_trajectories
+
+        self._meter = compile_cached(
+            thread, _EnsembleStatistics,
+            meter.computation, keep_trajectories=keep_trajectories)
+        self._mean = thread.empty_like(self._meter.parameter.mean)
+        self._mean_sq = thread.empty_like(self._meter.parameter.mean_sq)
+        if keep_trajectories > 0:
+            self._kept = thread.empty_like(self._meter.parameter.kept)
+            outputs = [self._mean, self._mean_sq, self._kept]
+        else:
+            outputs = [self._mean, self._mean_sq]
+        self._outputs = outputs
+
+    def __call__(self, wfs_data, t=0):
+        """
+        Returns a tuple ``(mean, stderr, values)``, where ``values``
+        is an array with the results for the first ``keep_trajectories`` trajectories
+        (or ``None`` if ``keep_trajectories == 0``).
+        ``t`` is the time of the measurement (affects the phase of the beam splitter, if any).
+        """
+        self._meter(*(self._outputs + [wfs_data] + self._source.get_arguments(t)))
+
+        mean = self._mean.get()
+        mean_sq = self._mean_sq.get()
+        stderr = numpy.sqrt((mean_sq - numpy.abs(mean) ** 2).clip(0) / self._trajectories)
+        values = self._kept.get() if self._keep_trajectories > 0 else None
+        return mean, stderr, values
+
+
+class AsyncMeter:
+    """
+    Wraps a meter making the measurements non-blocking.
+    The meter writes its results into one of several rotating device buffers,
+    which are downloaded into preallocated host arrays without synchronizing
+    the device queue with the host at every measurement.
+    The call blocks only if all the buffers are still waiting to be downloaded.
+
+    With the OpenCL backend the downloads are enqueued in the same queue as the measurements
+    (so they are ordered with respect to them), and a background thread only waits for
+    their completion events; it does not issue any commands to the device.
+    With other backends the download is performed synchronously during the call.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param meter: a meter object having the ``computation`` attribute
+        and the ``get_arguments()`` method
+        (:py:class:`DensityIntegralMeter`, :py:class:`DensitySliceMeter`,
+        :py:class:`OverlapMeter` or :py:class:`EnergyMeter`).
+    :param buffers: the number of device buffers for results.
+    :param callback: if given, it will be called from the background thread
+        as ``callback(t, value)`` for every downloaded result
+        (instead of storing it to be returned by :py:meth:`collect`).
+    """
+
+    def __init__(self, wfs_meta, meter, buffers=2, callback=None):
+        thread = wfs_meta.thread
+
+        self._thread = thread
+        self._source = meter
+        self._callback = callback
+        self._opencl = (thread.api.get_id() == cluda.ocl_id())
+
+        self._meter = compile_computation(thread, meter.computation)
+        result = self._meter.parameter[0]
+        self._outs = [thread.empty_like(result) for i in range(buffers)]
+        self._hosts = [numpy.empty(result.shape, result.dtype) for i in range(buffers)]
+
+        self._free = queue.Queue()
+        for i in range(buffers):
+            self._free.put(i)
+        self._pending = queue.Queue()
+        self._results = []
+        self._error = None
+        self._worker = None
+
+    def _start(self):
+        self._worker = threading.Thread(target=self._wait_for_downloads)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _wait_for_downloads(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                self._pending.task_done()
+                break
+
+            buf_num, t, event = item
+            try:
+                if event is not None:
+                    event.wait()
+                value = self._hosts[buf_num].copy()
+                if self._callback is None:
+                    self._results.append((t, value))
+                else:
+                    self._callback(t, value)
+            except Exception as e:
+                self._error = e
+
+            self._free.put(buf_num)
+            self._pending.task_done()
+
+    def _enqueue_download(self, buf_num):
+        out = self._outs[buf_num]
+        if self._opencl:
+            import pyopencl as cl
+            return cl.enqueue_copy(out.queue, self._hosts[buf_num], out.data, is_blocking=False)
+        else:
+            self._thread.from_device(out, dest=self._hosts[buf_num])
+            return None
+
+    def __call__(self, wfs_data, t=0):
+        """
+        Enqueues a measurement of ``wfs_data`` at time ``t``
+        (affects the phase of the beam splitter, if any).
+        """
+        if self._worker is None:
+            self._start()
+
+        buf_num = self._free.get()
+        self._meter(self._outs[buf_num], wfs_data, *self._source.get_arguments(t))
+        event = self._enqueue_download(buf_num)
+        self._pending.put((buf_num, t, event))
+
+    def collect(self):
+        """
+        Waits for all the pending downloads to finish and returns a list of tuples
+        ``(t, value)`` for all the measurements made since the previous call.
+        """
+        self._pending.join()
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+        results = self._results
+        self._results = []
+        return results
+
+    def release(self):
+        """
+        Waits for all the pending downloads to finish and stops the background thread.
+        The results that were not collected are discarded.
+        The meter can still be used afterwards (the thread is restarted on the next call).
+        """
+        if self._worker is not None:
+            self._pending.put(None)
+            self._worker.join()
+            self._worker = None
+        self._results = []
+        self._error = None
+
+
+def get_energy_trf(wfs_meta, system, runtime_interactions=False):
+    """
+    Returns a transformation calculating the potential and interaction energy density
+    for each trajectory at the time given by the ``t`` parameter
+    (which is passed to the potential and the interaction ramps of the system).
+    If ``runtime_interactions`` is ``True``, the interaction coefficients are taken
+    from the ``interactions`` parameter of the transformation
+    (see :py:class:`~beclab.parameters.SystemParameters`) instead of being compiled in.
+    If the potential of the system is tabulated, its values are taken
+    from the ``potential_values`` parameter (see :py:func:`get_potential_arr`).
+    """
+
+    real_dtype = wfs_meta.accumulation_dtype
+    interaction_ramps = get_interaction_ramp_modules(
+        real_dtype, wfs_meta.components, system.interaction_ramps)
+    tabulated = system.potential is not None and system.potential.tabulated
+    if system.potential is not None and not tabulated:
         potential = system.potential.get_module(
             wfs_meta.dtype, wfs_meta.grid, system.components)
     else:
         potential = None
 
+    if wfs_meta.representation == REPR_WIGNER:
+        delta, corrections = get_wigner_corrections(wfs_meta, len(system.components))
+        # Constant terms of the symmetrically ordered
+        # Psi_j^+ Psi_k^+ Psi_k Psi_j and Psi_j^+ V_j Psi_j.
+        interaction_constants = -corrections * delta / 2
+        potential_correction = -delta / 2
+    else:
+        corrections = numpy.zeros_like(system.interactions)
+        interaction_constants = numpy.zeros_like(system.interactions)
+        potential_correction = 0
+
+    if runtime_interactions:
+        parameter_params = [
+            Parameter('interactions', Annotation(get_interactions_type(wfs_meta), 'i'))]
+    else:
+        parameter_params = []
+
+    if tabulated:
+        parameter_params.append(
+            Parameter('potential_values', Annotation(get_potential_arr(wfs_meta), 'i')))
+
     return Transformation(
         [
             Parameter('energy', Annotation(
                 Type(real_dtype, (wfs_meta.shape[0],) + wfs_meta.shape[2:]), 'o')),
             Parameter('data', Annotation(wfs_meta.data, 'i')),
-            Parameter('kdata', Annotation(wfs_meta.data, 'i'))],
+            Parameter('t', Annotation(real_dtype))]
+            + parameter_params,
         """
         <%
             s_ctype = dtypes.ctype(s_dtype)
@@ -199,13 +1009,16 @@ def get_energy_trf(wfs_meta, system):
             coords = ", ".join(idxs[1:])
         %>
         %for comp in range(components):
-        ${kdata.ctype} data_${comp} = ${data.load_idx}(${trajectory}, ${comp}, ${coords});
-        ${kdata.ctype} kdata_${comp} = ${kdata.load_idx}(${trajectory}, ${comp}, ${coords});
+        ${data.ctype} data_${comp} = ${data.load_idx}(${trajectory}, ${comp}, ${coords});
         %endfor
 
-        %if potential is not None:
+        %if tabulated:
+        %for comp in range(components):
+        const ${r_ctype} V_${comp} = ${potential_values.load_idx}(${comp}, ${coords});
+        %endfor
+        %elif potential is not None:
         %for comp in range(components):
-        const ${r_ctype} V_${comp} = ${potential}${comp}(${coords}, 0);
+        const ${r_ctype} V_${comp} = ${potential}${comp}(${coords}, ${t});
         %endfor
         %endif
 
@@ -214,16 +1027,33 @@ def get_energy_trf(wfs_meta, system):
         %endfor
 
         ${r_ctype} E =
+            0
             %for comp in range(components):
-            + (${r_const(system.kinetic_coeff)})
-                * (${mul_ss}(data_${comp}, kdata_${comp})).x
-            + V_${comp} * n_${comp}
+            %if potential is not None or tabulated:
+            + V_${comp} * (n_${comp} + (${r_const(potential_correction)}))
+            %endif
                 %for other_comp in range(components):
                 <%
-                    sqrt_g = numpy.sqrt(system.interactions[comp, other_comp])
+                    correction = corrections[comp, other_comp]
+                    constant = interaction_constants[comp, other_comp]
+                    g_ramp = interaction_ramps[comp * components + other_comp]
                 %>
-                + (${r_const(system.interactions[comp, other_comp])})
-                    * n_${comp} * n_${other_comp} / 2
+                + (
+                    %if runtime_interactions:
+                    ${interactions.load_idx}(${trajectory}, ${comp}, ${other_comp})
+                    %elif g_ramp is not None:
+                    ${g_ramp}(${t})
+                    %else:
+                    ${r_const(system.interactions[comp, other_comp])}
+                    %endif
+                    ) / 2
+                    * (
+                        n_${comp} * n_${other_comp}
+                        %if correction != 0:
+                        + (${r_const(correction)}) * (n_${comp} + n_${other_comp})
+                        + (${r_const(constant)})
+                        %endif
+                        )
                 %endfor
             %endfor
             ;
@@ -234,71 +1064,147 @@ def get_energy_trf(wfs_meta, system):
             dimensions=wfs_meta.grid.dimensions,
             components=wfs_meta.components,
             potential=potential,
+            tabulated=tabulated,
             system=system,
+            interaction_ramps=interaction_ramps,
+            corrections=corrections,
+            interaction_constants=interaction_constants,
+            potential_correction=potential_correction,
+            runtime_interactions=runtime_interactions,
             HBAR=const.HBAR,
             s_dtype=wfs_meta.dtype,
             r_dtype=real_dtype,
-            mul_ss=functions.mul(wfs_meta.dtype, wfs_meta.dtype),
             norm=functions.norm(wfs_meta.dtype),
             ))
 
 
-def get_ksquared_trf(state_arr, ksquared_arr):
+def get_potential_arr(wfs_meta):
+    """
+    Returns the array type for the values of a tabulated potential.
+    """
+    return Type(wfs_meta.accumulation_dtype, (wfs_meta.components,) + wfs_meta.grid.shape)
+
+
+def get_kinetic_trf(state_arr, ksquared_arr):
+    real_dtype = dtypes.normalize_type(ksquared_arr.dtype)
     return Transformation(
         [
-            Parameter('output', Annotation(state_arr, 'o')),
+            Parameter('output', Annotation(Type(real_dtype, state_arr.shape), 'o')),
             Parameter('input', Annotation(state_arr, 'i')),
             Parameter('ksquared', Annotation(ksquared_arr, 'i'))],
         """
         ${ksquared.ctype} ksquared = ${ksquared.load_idx}(${', '.join(idxs[2:])});
-        ${output.store_same}(${mul}(${input.load_same}, -ksquared));
+        ${output.store_same}(${norm}(${input.load_same}) * ksquared);
         """,
-        render_kwds=dict(
-            mul=functions.mul(
-                state_arr.dtype, ksquared_arr.dtype, out_dtype=state_arr.dtype)))
+        render_kwds=dict(norm=functions.norm(state_arr.dtype)))
 
 
-class _EnergyMeter(Computation):
+def get_add_trf(arr_t):
+    return Transformation(
+        [
+            Parameter('output', Annotation(arr_t, 'o')),
+            Parameter('input', Annotation(arr_t, 'i')),
+            Parameter('term', Annotation(arr_t, 'i'))],
+        """
+        ${output.store_same}(${input.load_same} + ${term.load_same});
+        """)
 
-    def __init__(self, wfs_meta, system):
 
-        # FIXME: generalize for Wigner?
-        assert wfs_meta.representation == REPR_CLASSICAL
+class _EnergyMeter(Computation):
+    """
+    Calculates the energy of each trajectory.
+    The kinetic term is calculated in the momentum space using Parseval's theorem
+    (requiring only one forward FFT), and the rest is calculated in the coordinate space.
+    """
+
+    def __init__(self, wfs_meta, system, runtime_interactions=False):
 
-        real_dtype = dtypes.real_for(wfs_meta.dtype)
+        real_dtype = wfs_meta.accumulation_dtype
         energy_arr = Type(real_dtype, (wfs_meta.trajectories,))
+        self._runtime_interactions = runtime_interactions
+        if runtime_interactions:
+            parameter_params = [
+                Parameter('interactions', Annotation(get_interactions_type(wfs_meta), 'i'))]
+        else:
+            parameter_params = []
         Computation.__init__(self, [
             Parameter('energy', Annotation(energy_arr, 'o')),
-            Parameter('wfs_data', Annotation(wfs_meta.data, 'i'))])
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i')),
+            Parameter('t', Annotation(real_dtype))]
+            + parameter_params)
 
+        # Kinetic term: -kinetic_coeff * dV / N * sum(k^2 * abs(FFT[psi]) ** 2)
         self._ksquared = get_ksquared(wfs_meta.grid.shape, wfs_meta.grid.box).astype(real_dtype)
-        ksquared_trf = get_ksquared_trf(wfs_meta.data, self._ksquared)
-
+        kinetic_trf = get_kinetic_trf(wfs_meta.data, self._ksquared)
         self._fft = FFT(wfs_meta.data, axes=range(2, len(wfs_meta.shape)))
-        self._fft_with_kprop = FFT(wfs_meta.data, axes=range(2, len(wfs_meta.shape)))
-        self._fft_with_kprop.parameter.output.connect(
-            ksquared_trf, ksquared_trf.input,
-            output_prime=ksquared_trf.output, ksquared=ksquared_trf.ksquared)
+        self._fft.parameter.output.connect(
+            kinetic_trf, kinetic_trf.input,
+            kinetic_density=kinetic_trf.output, ksquared=kinetic_trf.ksquared)
+
+        self._kinetic_density_arr = Type(real_dtype, wfs_meta.shape)
+        self._kinetic_reduce = Reduce(
+            self._kinetic_density_arr, predicate_sum(real_dtype),
+            axes=list(range(1, len(wfs_meta.shape))))
+        kinetic_scale = mul_const(
+            self._kinetic_reduce.parameter.output,
+            dtypes.cast(real_dtype)(-system.kinetic_coeff * wfs_meta.grid.dV / wfs_meta.grid.size))
+        self._kinetic_reduce.parameter.output.connect(
+            kinetic_scale, kinetic_scale.input, kinetic_energy=kinetic_scale.output)
 
+        if wfs_meta.representation == REPR_WIGNER:
+            # The symmetric ordering of the kinetic term gives a constant contribution
+            # of half the kinetic energy of every active mode.
+            if wfs_meta.cutoff is not None:
+                mask = wfs_meta.cutoff.get_mask(wfs_meta.grid)
+            else:
+                mask = 1
+            kinetic_correction = (
+                system.kinetic_coeff * (self._ksquared * mask).sum() / 2 * wfs_meta.components)
+            add_trf = add_const(energy_arr, dtypes.cast(real_dtype)(kinetic_correction))
+            self._kinetic_reduce.parameter.kinetic_energy.connect(
+                add_trf, add_trf.input, corrected_kinetic_energy=add_trf.output)
+
+        # Potential and interaction terms
         real_arr = Type(real_dtype, (wfs_meta.shape[0],) + wfs_meta.shape[2:])
         self._reduce = Reduce(
             real_arr, predicate_sum(real_dtype),
             axes=list(range(1, len(wfs_meta.shape) - 1)))
 
         scale = mul_const(real_arr, dtypes.cast(real_dtype)(wfs_meta.grid.dV))
-        self._reduce.parameter.input.connect(scale, scale.output, energy=scale.input)
+        self._reduce.parameter.input.connect(scale, scale.output, energy_density=scale.input)
+
+        energy = get_energy_trf(wfs_meta, system, runtime_interactions=runtime_interactions)
+        energy_kwds = dict(wfs_data=energy.data, t=energy.t)
+        if runtime_interactions:
+            energy_kwds['interactions'] = energy.interactions
+        if system.potential is not None and system.potential.tabulated:
+            # Uploaded to the device once, when the computation is compiled.
+            self._potential = system.potential.get_array(
+                wfs_meta.grid, system.components).astype(real_dtype)
+            energy_kwds['potential_values'] = energy.potential_values
+        else:
+            self._potential = None
+        self._reduce.parameter.energy_density.connect(energy, energy.energy, **energy_kwds)
 
-        energy = get_energy_trf(wfs_meta, system)
-        self._reduce.parameter.energy.connect(energy, energy.energy,
-            data=energy.data, kdata=energy.kdata)
+        add_kinetic = get_add_trf(energy_arr)
+        self._reduce.parameter.output.connect(
+            add_kinetic, add_kinetic.input,
+            energy=add_kinetic.output, kinetic_energy=add_kinetic.term)
 
-    def _build_plan(self, plan_factory, device_params, energy, wfs_data):
+    def _build_plan(self, plan_factory, device_params, energy, wfs_data, t, *parameters):
         plan = plan_factory()
-        kdata = plan.temp_array_like(wfs_data)
+        kinetic_density = plan.temp_array_like(self._kinetic_density_arr)
+        kinetic_energy = plan.temp_array_like(energy)
         ksquared_device = plan.persistent_array(self._ksquared)
-        plan.computation_call(self._fft_with_kprop, kdata, ksquared_device, wfs_data)
-        plan.computation_call(self._fft, kdata, kdata, inverse=True)
-        plan.computation_call(self._reduce, energy, wfs_data, kdata)
+        plan.computation_call(self._fft, kinetic_density, ksquared_device, wfs_data)
+        plan.computation_call(self._kinetic_reduce, kinetic_energy, kinetic_density)
+
+        kwds = dict(energy=energy, kinetic_energy=kinetic_energy, wfs_data=wfs_data, t=t)
+        if self._runtime_interactions:
+            kwds['interactions'] = parameters[0]
+        if self._potential is not None:
+            kwds['potential_values'] = plan.persistent_array(self._potential)
+        plan.computation_call(self._reduce, **kwds)
         return plan
 
 
@@ -313,15 +1219,437 @@ class EnergyMeter:
                 + \sum_{k=1}^C \frac{g_{jk}}{2} \vert \Psi_k \vert^2
             \right) \Psi_j d\mathbf{x}.
 
+    For the Wigner representation the corrections arising from the symmetric ordering
+    of the corresponding operators are taken into account,
+    so the energy is calculated for each trajectory entirely on the device.
+
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
     :param system: the :py:class:`~beclab.System` object the wavefunction corresponds to.
+    :param parameters: a :py:class:`~beclab.parameters.SystemParameters` object.
+        If given, the interaction coefficients are read from it on every call
+        instead of being taken from ``system``
+        (cannot be used for a system with interaction ramps).
+
+    .. py:attribute:: computation
+
+        The uncompiled Reikna computation with the signature ``(energy, wfs_data, t)``
+        (followed by ``interactions`` if ``parameters`` is given).
     """
 
-    def __init__(self, wfs_meta, system):
+    def __init__(self, wfs_meta, system, parameters=None):
         thread = wfs_meta.thread
-        self._meter = _EnergyMeter(wfs_meta, system).compile(thread)
+        runtime_interactions = (parameters is not None)
+        if runtime_interactions and len(system.interaction_ramps) > 0:
+            raise ValueError(
+                "Runtime interaction coefficients cannot be used with interaction ramps")
+        # The key does not include ``parameters``, since only the shape of its buffer
+        # (defined by ``wfs_meta``) affects the computation.
+        self.computation = cached(
+            lambda: _EnergyMeter(wfs_meta, system, runtime_interactions=runtime_interactions),
+            _EnergyMeter, wfs_meta, system, runtime_interactions)
+        self._meter = compile_computation(thread, self.computation)
         self._out = thread.empty_like(self._meter.parameter.energy)
+        self._parameters = parameters
+        self._real_dtype = wfs_meta.accumulation_dtype
 
-    def __call__(self, wfs_data):
-        self._meter(self._out, wfs_data)
+    def get_arguments(self, t=0):
+        """
+        Returns the list of arguments of :py:attr:`computation` following ``wfs_data``
+        for the measurement at time ``t``
+        (followed by the current interaction coefficients if ``parameters`` is given).
+        """
+        args = [dtypes.cast(self._real_dtype)(t)]
+        if self._parameters is not None:
+            args.append(self._parameters.interactions)
+        return args
+
+    def __call__(self, wfs_data, t=0):
+        """
+        Returns a numpy array with the shape ``(trajectories,)`` with the energies.
+        ``t`` is the time of the measurement
+        (affects the time-dependent potential and interaction ramps, if any).
+        """
+        self._meter(self._out, wfs_data, *self.get_arguments(t))
         return self._out.get()
+
+
+def get_hamiltonian_terms_trf(wfs_meta, system):
+    r"""
+    Returns a transformation calculating, for each component :math:`j`,
+    the energy density :math:`(V_j + \sum_k g_{jk} n_k / 2) n_j`,
+    the chemical potential density :math:`(V_j + \sum_k g_{jk} n_k) n_j`
+    and the density :math:`n_j` (in this order along the second axis of the output)
+    at the time given by the ``t`` parameter.
+    """
+
+    real_dtype = wfs_meta.accumulation_dtype
+    interaction_ramps = get_interaction_ramp_modules(
+        real_dtype, wfs_meta.components, system.interaction_ramps)
+    if system.potential is not None:
+        potential = system.potential.get_module(
+            wfs_meta.dtype, wfs_meta.grid, system.components)
+    else:
+        potential = None
+
+    terms_arr = Type(
+        real_dtype, (wfs_meta.trajectories, 3, wfs_meta.components) + wfs_meta.grid.shape)
+
+    return Transformation(
+        [
+            Parameter('terms', Annotation(terms_arr, 'o')),
+            Parameter('data', Annotation(wfs_meta.data, 'i')),
+            Parameter('t', Annotation(real_dtype))],
+        """
+        <%
+            r_ctype = dtypes.ctype(r_dtype)
+            r_const = lambda x: dtypes.c_constant(x, r_dtype)
+
+            trajectory = idxs[0]
+            term = idxs[1]
+            component = idxs[2]
+            coords = ", ".join(idxs[3:])
+        %>
+        %for comp in range(components):
+        const ${r_ctype} n_${comp} = ${norm}(
+            ${data.load_idx}(${trajectory}, ${comp}, ${coords}));
+        %endfor
+
+        ${r_ctype} result = 0;
+        %for comp in range(components):
+        if (${component} == ${comp})
+        {
+            %if potential is not None:
+            const ${r_ctype} V = ${potential}${comp}(${coords}, ${t});
+            %else:
+            const ${r_ctype} V = 0;
+            %endif
+
+            const ${r_ctype} U =
+                0
+                %for other_comp in range(components):
+                <%
+                    g_ramp = interaction_ramps[comp * components + other_comp]
+                %>
+                %if g_ramp is not None:
+                + ${g_ramp}(${t}) * n_${other_comp}
+                %else:
+                + (${r_const(system.interactions[comp, other_comp])}) * n_${other_comp}
+                %endif
+                %endfor
+                ;
+
+            if (${term} == 0)
+                result = (V + U / 2) * n_${comp};
+            else if (${term} == 1)
+                result = (V + U) * n_${comp};
+            else
+                result = n_${comp};
+        }
+        %endfor
+
+        ${terms.store_same}(result);
+        """,
+        render_kwds=dict(
+            components=wfs_meta.components,
+            potential=potential,
+            system=system,
+            interaction_ramps=interaction_ramps,
+            r_dtype=real_dtype,
+            norm=functions.norm(wfs_meta.dtype)))
+
+
+def get_residual_trf(wfs_meta, system, mus_arr):
+    r"""
+    Returns a transformation calculating :math:`\vert H \Psi_j - \mu_j \Psi_j \vert^2`,
+    given :math:`\Psi_j` and the result of the kinetic part of :math:`H` applied to it,
+    with :math:`H` taken at the time given by the ``t`` parameter.
+    """
+
+    real_dtype = wfs_meta.accumulation_dtype
+    interaction_ramps = get_interaction_ramp_modules(
+        real_dtype, wfs_meta.components, system.interaction_ramps)
+    if system.potential is not None:
+        potential = system.potential.get_module(
+            wfs_meta.dtype, wfs_meta.grid, system.components)
+    else:
+        potential = None
+
+    return Transformation(
+        [
+            Parameter('residual', Annotation(Type(real_dtype, wfs_meta.shape), 'o')),
+            Parameter('data', Annotation(wfs_meta.data, 'i')),
+            Parameter('kdata', Annotation(wfs_meta.data, 'i')),
+            Parameter('mus', Annotation(mus_arr, 'i')),
+            Parameter('t', Annotation(real_dtype))],
+        """
+        <%
+            s_ctype = dtypes.ctype(s_dtype)
+            r_ctype = dtypes.ctype(r_dtype)
+            r_const = lambda x: dtypes.c_constant(x, r_dtype)
+
+            trajectory = idxs[0]
+            component = idxs[1]
+            coords = ", ".join(idxs[2:])
+        %>
+        %for comp in range(components):
+        const ${s_ctype} psi_${comp} = ${data.load_idx}(${trajectory}, ${comp}, ${coords});
+        const ${r_ctype} n_${comp} = ${norm}(psi_${comp});
+        %endfor
+
+        ${s_ctype} result = ${kdata.load_same};
+        %for comp in range(components):
+        if (${component} == ${comp})
+        {
+            %if potential is not None:
+            const ${r_ctype} V = ${potential}${comp}(${coords}, ${t});
+            %else:
+            const ${r_ctype} V = 0;
+            %endif
+
+            const ${r_ctype} U =
+                0
+                %for other_comp in range(components):
+                <%
+                    g_ramp = interaction_ramps[comp * components + other_comp]
+                %>
+                %if g_ramp is not None:
+                + ${g_ramp}(${t}) * n_${other_comp}
+                %else:
+                + (${r_const(system.interactions[comp, other_comp])}) * n_${other_comp}
+                %endif
+                %endfor
+                ;
+
+            const ${r_ctype} mu = ${mus.load_idx}(${trajectory}, ${comp});
+            result = result + ${mul_sr}(psi_${comp}, V + U - mu);
+        }
+        %endfor
+
+        ${residual.store_same}(${norm}(result));
+        """,
+        render_kwds=dict(
+            components=wfs_meta.components,
+            potential=potential,
+            system=system,
+            interaction_ramps=interaction_ramps,
+            s_dtype=wfs_meta.dtype,
+            r_dtype=real_dtype,
+            mul_sr=functions.mul(wfs_meta.dtype, real_dtype, out_dtype=wfs_meta.dtype),
+            norm=functions.norm(wfs_meta.dtype)))
+
+
+def get_kinetic_operator_trf(state_arr, ksquared_arr, coeff):
+    real_dtype = dtypes.real_for(state_arr.dtype)
+    return Transformation(
+        [
+            Parameter('output', Annotation(state_arr, 'o')),
+            Parameter('input', Annotation(state_arr, 'i')),
+            Parameter('ksquared', Annotation(ksquared_arr, 'i'))],
+        """
+        ${ksquared.ctype} ksquared = ${ksquared.load_idx}(${', '.join(idxs[2:])});
+        ${output.store_same}(${mul}(${input.load_same}, ksquared * (${coeff})));
+        """,
+        render_kwds=dict(
+            coeff=dtypes.c_constant(coeff, real_dtype),
+            mul=functions.mul(state_arr.dtype, real_dtype, out_dtype=state_arr.dtype)))
+
+
+class _HamiltonianTerms(Computation):
+    """
+    Calculates per-component kinetic energies (using Parseval's theorem),
+    and the reduced results of :py:func:`get_hamiltonian_terms_trf`.
+    """
+
+    def __init__(self, wfs_meta, system):
+
+        real_dtype = wfs_meta.accumulation_dtype
+
+        self._ksquared = get_ksquared(wfs_meta.grid.shape, wfs_meta.grid.box).astype(real_dtype)
+        kinetic_trf = get_kinetic_trf(wfs_meta.data, self._ksquared)
+        self._fft = FFT(wfs_meta.data, axes=range(2, len(wfs_meta.shape)))
+        self._fft.parameter.output.connect(
+            kinetic_trf, kinetic_trf.input,
+            kinetic_density=kinetic_trf.output, ksquared=kinetic_trf.ksquared)
+
+        self._kinetic_density_arr = Type(real_dtype, wfs_meta.shape)
+        self._kinetic_reduce = Reduce(
+            self._kinetic_density_arr, predicate_sum(real_dtype),
+            axes=list(range(2, len(wfs_meta.shape))))
+        kinetic_scale = mul_const(
+            self._kinetic_reduce.parameter.output,
+            dtypes.cast(real_dtype)(-system.kinetic_coeff * wfs_meta.grid.dV / wfs_meta.grid.size))
+        self._kinetic_reduce.parameter.output.connect(
+            kinetic_scale, kinetic_scale.input, kinetic=kinetic_scale.output)
+
+        terms_trf = get_hamiltonian_terms_trf(wfs_meta, system)
+        self._reduce = Reduce(
+            terms_trf.terms, predicate_sum(real_dtype),
+            axes=list(range(3, len(terms_trf.terms.shape))))
+        scale = mul_const(self._reduce.parameter.output, dtypes.cast(real_dtype)(wfs_meta.grid.dV))
+        self._reduce.parameter.output.connect(scale, scale.input, terms=scale.output)
+        self._reduce.parameter.input.connect(
+            terms_trf, terms_trf.terms, wfs_data=terms_trf.data, t=terms_trf.t)
+
+        Computation.__init__(self, [
+            Parameter('kinetic', Annotation(self._kinetic_reduce.parameter.kinetic, 'o')),
+            Parameter('terms', Annotation(self._reduce.parameter.terms, 'o')),
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i')),
+            Parameter('t', Annotation(real_dtype))])
+
+    def _build_plan(self, plan_factory, device_params, kinetic, terms, wfs_data, t):
+        plan = plan_factory()
+        kinetic_density = plan.temp_array_like(self._kinetic_density_arr)
+        ksquared_device = plan.persistent_array(self._ksquared)
+        plan.computation_call(self._fft, kinetic_density, ksquared_device, wfs_data)
+        plan.computation_call(self._kinetic_reduce, kinetic, kinetic_density)
+        plan.computation_call(self._reduce, terms=terms, wfs_data=wfs_data, t=t)
+        return plan
+
+
+class _Residual(Computation):
+    r"""
+    Calculates the squared norm of :math:`H \Psi_j - \mu_j \Psi_j` for each trajectory.
+    """
+
+    def __init__(self, wfs_meta, system):
+
+        real_dtype = wfs_meta.accumulation_dtype
+        mus_arr = Type(real_dtype, (wfs_meta.trajectories, wfs_meta.components))
+        residual_arr = Type(real_dtype, (wfs_meta.trajectories,))
+
+        self._ksquared = get_ksquared(wfs_meta.grid.shape, wfs_meta.grid.box).astype(
+            dtypes.real_for(wfs_meta.dtype))
+        kinetic_trf = get_kinetic_operator_trf(
+            wfs_meta.data, self._ksquared, -system.kinetic_coeff)
+        self._fft = FFT(wfs_meta.data, axes=range(2, len(wfs_meta.shape)))
+        self._fft_with_kinetic = FFT(wfs_meta.data, axes=range(2, len(wfs_meta.shape)))
+        self._fft_with_kinetic.parameter.output.connect(
+            kinetic_trf, kinetic_trf.input,
+            output_prime=kinetic_trf.output, ksquared=kinetic_trf.ksquared)
+
+        residual_trf = get_residual_trf(wfs_meta, system, mus_arr)
+        self._reduce = Reduce(
+            residual_trf.residual, predicate_sum(real_dtype),
+            axes=list(range(1, len(wfs_meta.shape))))
+        scale = mul_const(residual_arr, dtypes.cast(real_dtype)(wfs_meta.grid.dV))
+        self._reduce.parameter.output.connect(scale, scale.input, residual=scale.output)
+        self._reduce.parameter.input.connect(
+            residual_trf, residual_trf.residual,
+            wfs_data=residual_trf.data, kdata=residual_trf.kdata, mus=residual_trf.mus,
+            t=residual_trf.t)
+
+        Computation.__init__(self, [
+            Parameter('residual', Annotation(residual_arr, 'o')),
+            Parameter('wfs_data', Annotation(wfs_meta.data, 'i')),
+            Parameter('mus', Annotation(mus_arr, 'i')),
+            Parameter('t', Annotation(real_dtype))])
+
+    def _build_plan(self, plan_factory, device_params, residual, wfs_data, mus, t):
+        plan = plan_factory()
+        kdata = plan.temp_array_like(wfs_data)
+        ksquared_device = plan.persistent_array(self._ksquared)
+        plan.computation_call(self._fft_with_kinetic, kdata, ksquared_device, wfs_data)
+        plan.computation_call(self._fft, kdata, kdata, inverse=True)
+        plan.computation_call(
+            self._reduce, residual=residual, wfs_data=wfs_data, kdata=kdata, mus=mus, t=t)
+        return plan
+
+
+def _get_packed(computation_cls, wfs_meta, system):
+    """
+    Returns ``computation_cls(wfs_meta, system)`` reading the wavefunction
+    from the packed storage of its real fields (see :py:mod:`beclab.packing`),
+    passed as the ``packed_data`` parameter instead of ``wfs_data``.
+    """
+    computation = computation_cls(wfs_meta, system)
+    unpack = get_unpack_trf(wfs_meta)
+    computation.parameter.wfs_data.connect(unpack, unpack.output, packed_data=unpack.input)
+    return computation
+
+
+class HamiltonianMeter:
+    r"""
+    Measures the energy (see :py:class:`EnergyMeter`) and the chemical potentials
+
+    .. math::
+
+        \mu_j = \frac{1}{N_j} \int \Psi_j^* \left(
+                - \frac{\nabla^2}{2 m} + V_j
+                + \sum_{k=1}^C g_{jk} \vert \Psi_k \vert^2
+            \right) \Psi_j d\mathbf{x}
+
+    of a BEC in a single pass.
+    Optionally, also measures the relative residual
+
+    .. math::
+
+        r = \sqrt{
+            \frac{\sum_j \int \vert H \Psi_j - \mu_j \Psi_j \vert^2 d\mathbf{x}}
+            {\sum_j \mu_j^2 N_j}},
+
+    which is zero for a stationary state.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object
+        (only the classical representation is supported).
+    :param system: the :py:class:`~beclab.System` object the wavefunction corresponds to.
+    :param residual: whether to measure the residual.
+    :param packed: if ``True``, the meter is called with real fields in the packed storage
+        (see :py:mod:`beclab.packing`) instead of a wavefunction described by ``wfs_meta``,
+        and reads them without unpacking into a separate array.
+    """
+
+    def __init__(self, wfs_meta, system, residual=False, packed=False):
+        if wfs_meta.representation != REPR_CLASSICAL:
+            raise NotImplementedError()
+
+        thread = wfs_meta.thread
+        if packed:
+            get_meter = lambda computation_cls: compile_cached(
+                thread, _get_packed, computation_cls, wfs_meta, system)
+            self._data_name = 'packed_data'
+        else:
+            get_meter = lambda computation_cls: compile_cached(
+                thread, computation_cls, wfs_meta, system)
+            self._data_name = 'wfs_data'
+
+        self._meter = get_meter(_HamiltonianTerms)
+        self._kinetic = thread.empty_like(self._meter.parameter.kinetic)
+        self._terms = thread.empty_like(self._meter.parameter.terms)
+
+        if residual:
+            self._residual_meter = get_meter(_Residual)
+            self._residual = thread.empty_like(self._residual_meter.parameter.residual)
+        else:
+            self._residual_meter = None
+
+        self._thread = thread
+        self._real_dtype = wfs_meta.accumulation_dtype
+
+    def __call__(self, wfs_data, t=0):
+        """
+        Returns a tuple ``(E, mus, r)`` of numpy arrays with the shapes
+        ``(trajectories,)``, ``(trajectories, components)`` and ``(trajectories,)``
+        containing the energy, the chemical potentials and the residual, respectively.
+        If the residual was not requested, ``r`` is ``None``.
+        ``t`` is the time of the measurement
+        (affects the time-dependent potential and interaction ramps, if any).
+        """
+        t = dtypes.cast(self._real_dtype)(t)
+        data_kwds = {self._data_name: wfs_data}
+        self._meter(kinetic=self._kinetic, terms=self._terms, t=t, **data_kwds)
+        kinetic = self._kinetic.get()
+        terms = self._terms.get()
+
+        energy_terms, mu_terms, Ns = terms[:,0], terms[:,1], terms[:,2]
+        E = (kinetic + energy_terms).sum(1)
+        mus = numpy.where(Ns > 0, (kinetic + mu_terms) / numpy.where(Ns > 0, Ns, 1), 0)
+
+        if self._residual_meter is None:
+            return E, mus, None
+
+        mus_device = self._thread.to_device(mus.astype(self._real_dtype))
+        self._residual_meter(residual=self._residual, mus=mus_device, t=t, **data_kwds)
+        residual = self._residual.get()
+        r = numpy.sqrt(residual / (mus ** 2 * Ns).sum(1))
+
+        return E, mus, r
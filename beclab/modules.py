@@ -9,15 +9,26 @@ from reiknacontrib.integrator import Drift, Diffusion
 
 def get_drift(state_dtype, dimensions, components, interactions=None, corrections=None,
         potential=None, losses=None, unitary_coefficient=1,
-        linear_terms=None):
+        linear_terms=None, interaction_ramps=None, loss_ramps=None):
     """
     interactions, array(comps, comps): two-body elastic interaction constants.
     losses, [(kappa, [l_1, ..., l_comps])]: inelastic interaction constants
         (l_i specifies the number of atoms of component i participating in the interaction).
         Coefficients are the "theorist's" ones.
+    interaction_ramps, {(j, k): Ramp}: time-dependent values of interaction constants,
+        replacing the corresponding elements of ``interactions``.
+    loss_ramps, {loss_num: Ramp}: time-dependent values of kappas,
+        replacing the ones in the corresponding elements of ``losses``.
     linear_terms: a list of modules each containing functions with suffixes 0..components-1
         that will be passed psi_0,..,t and their return values added to the equation
         of the corresponding component.
+
+    Each density ``norm(psi_j)`` is calculated once per generated function
+    and shared between the interaction and loss terms of its component.
+    Since ``Drift`` requires a separate function for each component,
+    the densities are not shared between components, so for ``C`` components
+    up to ``C**2`` of them are evaluated per grid point
+    (unless the device compiler merges them after inlining).
     """
     if losses is None:
         losses = []
@@ -31,6 +42,26 @@ def get_drift(state_dtype, dimensions, components, interactions=None, correction
     if corrections is None:
         corrections = numpy.zeros_like(interactions)
 
+    interaction_ramps = get_interaction_ramp_modules(real_dtype, components, interaction_ramps)
+    loss_ramps = get_loss_ramp_modules(real_dtype, losses, loss_ramps)
+
+    # Collect all components for which we will need norm(psi_j)
+    # when calculating the derivative of each component.
+    norms = []
+    for comp in range(components):
+        comp_norms = set(
+            other_comp for other_comp in range(components)
+            if interactions[comp, other_comp] != 0
+                or interaction_ramps[comp * components + other_comp] is not None)
+        for loss_num, (kappa, ls) in enumerate(losses):
+            if (kappa > 0 or loss_ramps[loss_num] is not None) and ls[comp] > 0:
+                if ls[comp] > 1:
+                    comp_norms.add(comp)
+                for other_comp in range(components):
+                    if other_comp != comp and ls[other_comp] > 0:
+                        comp_norms.add(other_comp)
+        norms.append(sorted(comp_norms))
+
     return Drift(
         Module.create(
             """
@@ -49,6 +80,10 @@ def get_drift(state_dtype, dimensions, components, interactions=None, correction
                 %endfor
                 ${r_ctype} t)
             {
+                %for norm_comp in norms[comp]:
+                const ${r_ctype} n_${norm_comp} = ${norm}(psi_${norm_comp});
+                %endfor
+
                 // Potential
                 %if potential is not None:
                 const ${r_ctype} V = ${potential}${comp}(
@@ -67,39 +102,32 @@ def get_drift(state_dtype, dimensions, components, interactions=None, correction
                     %for other_comp in range(components):
                     <%
                         g = interactions[comp, other_comp]
+                        g_ramp = interaction_ramps[comp * components + other_comp]
                         correction = corrections[comp, other_comp]
                     %>
-                    %if g != 0:
-                    + (${r_const(g)})
-                        * (${norm}(psi_${other_comp}) + (${r_const(correction)}))
+                    %if g_ramp is not None:
+                    + ${g_ramp}(t) * (n_${other_comp} + (${r_const(correction)}))
+                    %elif g != 0:
+                    + (${r_const(g)}) * (n_${other_comp} + (${r_const(correction)}))
                     %endif
                     %endfor
                     ;
 
                 // Losses
-                <%
-                    # Walk through the losses and collect all components
-                    # for which we will need norm(psi_j).
-                    norms = set()
-                    for kappa, ls in losses:
-                        if kappa > 0 and ls[comp] > 0:
-                            if ls[comp] > 1:
-                                norms.add(comp)
-                            for other_comp in range(components):
-                                if other_comp != comp and ls[other_comp] > 0:
-                                    norms.add(other_comp)
-                %>
-                %for norm_comp in sorted(norms):
-                const ${r_ctype} n_${norm_comp} = ${norm}(psi_${norm_comp});
-                %endfor
-
                 const ${s_ctype} L =
                     ${dtypes.c_constant(0, s_dtype)}
-                    %for kappa, ls in losses:
-                    %if kappa > 0 and ls[comp] > 0:
+                    %for loss_num, (kappa, ls) in enumerate(losses):
+                    <%
+                        kappa_ramp = loss_ramps[loss_num]
+                    %>
+                    %if (kappa > 0 or kappa_ramp is not None) and ls[comp] > 0:
                     - ${mul_sr}(
                         psi_${comp},
+                        %if kappa_ramp is not None:
+                        (${kappa_ramp}(t) * ${r_const(ls[comp])})
+                        %else:
                         (${r_const(kappa * ls[comp])})
+                        %endif
                             %for other_comp in range(components):
                                 <%
                                     pwr = ls[other_comp]
@@ -137,6 +165,7 @@ def get_drift(state_dtype, dimensions, components, interactions=None, correction
             }
             %endfor
             """,
+
             render_kwds=dict(
                 unitary_coefficient=unitary_coefficient,
                 dimensions=dimensions,
@@ -147,6 +176,9 @@ def get_drift(state_dtype, dimensions, components, interactions=None, correction
                 interactions=interactions,
                 corrections=corrections,
                 losses=losses,
+                interaction_ramps=interaction_ramps,
+                loss_ramps=loss_ramps,
+                norms=norms,
                 mul_ss=functions.mul(state_dtype, state_dtype),
                 mul_sr=functions.mul(state_dtype, real_dtype),
                 norm=functions.norm(state_dtype),
@@ -155,7 +187,146 @@ def get_drift(state_dtype, dimensions, components, interactions=None, correction
         state_dtype, components=interactions.shape[0])
 
 
-def get_diffusion(state_dtype, dimensions, components, losses=None):
+def get_packed_real_drift(state_dtype, dimensions, components, interactions=None,
+        potential=None, unitary_coefficient=1, by_trajectories=False):
+    """
+    Returns the drift for real fields stored in packed form (see :py:mod:`beclab.packing`).
+    If ``by_trajectories`` is ``False``, the fields ``2 * p`` and ``2 * p + 1``
+    are stored as the real and the imaginary parts of the component ``p``;
+    for an odd number of components the imaginary part of the last packed component
+    is not used, and its drift is zero.
+    If ``by_trajectories`` is ``True``, the real and the imaginary parts of every component
+    are the fields of two different trajectories, which evolve independently.
+    Only the potential and the elastic interactions are supported,
+    and ``unitary_coefficient`` must be real,
+    so that the fields stay real and are calculated in real arithmetic.
+    interactions, array(comps, comps): two-body elastic interaction constants.
+    """
+    real_dtype = dtypes.real_for(state_dtype)
+    if by_trajectories:
+        packed = components
+        # The fields of each trajectory: (packed component, part) for every component
+        fields = [[(comp, part) for comp in range(components)] for part in ('x', 'y')]
+    else:
+        packed = (components + 1) // 2
+        fields = [[(comp // 2, 'x' if comp % 2 == 0 else 'y') for comp in range(components)]]
+
+    if interactions is None:
+        interactions = numpy.zeros((components, components))
+
+    return Drift(
+        Module.create(
+            """
+            <%
+                s_ctype = dtypes.ctype(s_dtype)
+                r_ctype = dtypes.ctype(r_dtype)
+                r_const = lambda x: dtypes.c_constant(x, r_dtype)
+            %>
+            %for p in range(packed):
+            INLINE WITHIN_KERNEL ${s_ctype} ${prefix}${p}(
+                %for dim in range(dimensions):
+                const int idx_${dim},
+                %endfor
+                %for other_p in range(packed):
+                const ${s_ctype} psi_${other_p},
+                %endfor
+                ${r_ctype} t)
+            {
+                ${r_ctype} d_x = 0;
+                ${r_ctype} d_y = 0;
+
+                %for traj_fields in fields:
+                %for comp, (packed_comp, part) in enumerate(traj_fields):
+                %if packed_comp == p:
+                {
+                    %for other_comp in range(components):
+                    %if interactions[comp, other_comp] != 0:
+                    <%
+                        other_packed, other_part = traj_fields[other_comp]
+                    %>
+                    const ${r_ctype} f_${other_comp} = psi_${other_packed}.${other_part};
+                    %endif
+                    %endfor
+
+                    // Potential
+                    %if potential is not None:
+                    const ${r_ctype} V = ${potential}${comp}(
+                        %for dim in range(dimensions):
+                        idx_${dim},
+                        %endfor
+                        t
+                        );
+                    %else:
+                    const ${r_ctype} V = 0;
+                    %endif
+
+                    // Elastic interactions
+                    const ${r_ctype} U =
+                        0
+                        %for other_comp in range(components):
+                        %if interactions[comp, other_comp] != 0:
+                        + (${r_const(interactions[comp, other_comp])})
+                            * f_${other_comp} * f_${other_comp}
+                        %endif
+                        %endfor
+                        ;
+
+                    d_${part} = (${r_const(unitary_coefficient)})
+                        * psi_${p}.${part} * (V + U);
+                }
+                %endif
+                %endfor
+                %endfor
+
+                return COMPLEX_CTR(${s_ctype})(d_x, d_y);
+            }
+            %endfor
+            """,
+            render_kwds=dict(
+                unitary_coefficient=numpy.real(unitary_coefficient),
+                dimensions=dimensions,
+                components=components,
+                packed=packed,
+                fields=fields,
+                potential=potential,
+                s_dtype=state_dtype,
+                r_dtype=real_dtype,
+                interactions=interactions)),
+        state_dtype, components=packed)
+
+
+def get_interaction_ramp_modules(real_dtype, components, interaction_ramps):
+    """
+    Returns a flat list with ``components ** 2`` elements
+    (the element ``j * components + k`` corresponding to ``U_jk``)
+    containing the ramp modules or ``None`` for time-independent constants.
+    A ramp given for ``(j, k)`` is also used for ``(k, j)``, unless specified separately.
+    """
+    modules = [None] * components ** 2
+    if interaction_ramps is None:
+        return modules
+
+    for (comp1, comp2), ramp in interaction_ramps.items():
+        module = ramp.get_module(real_dtype)
+        modules[comp1 * components + comp2] = module
+        if (comp2, comp1) not in interaction_ramps:
+            modules[comp2 * components + comp1] = module
+    return modules
+
+
+def get_loss_ramp_modules(real_dtype, losses, loss_ramps):
+    """
+    Returns a list with the ramp modules for kappas of each element of ``losses``,
+    or ``None`` for time-independent ones.
+    """
+    if loss_ramps is None:
+        loss_ramps = {}
+    return [
+        loss_ramps[loss_num].get_module(real_dtype) if loss_num in loss_ramps else None
+        for loss_num in range(len(losses))]
+
+
+def get_diffusion(state_dtype, dimensions, components, losses=None, loss_ramps=None):
 
     # Preparing multi-argument multiplications here, since they are modules
     # and cannot be instantiated inside a template.
@@ -165,6 +336,8 @@ def get_diffusion(state_dtype, dimensions, components, losses=None):
     if losses is None:
         losses = []
 
+    loss_ramps = get_loss_ramp_modules(real_dtype, losses, loss_ramps)
+
     for _, ls in losses:
         if sum(ls) > 1:
             muls.append(
@@ -187,6 +360,7 @@ def get_diffusion(state_dtype, dimensions, components, losses=None):
             <%
                 kappa, ls = losses[noise_source]
                 mul = muls[noise_source]
+                kappa_ramp = loss_ramps[noise_source]
                 coeff = numpy.sqrt(kappa)
             %>
             INLINE WITHIN_KERNEL ${s_ctype} ${prefix}${comp}_${noise_source}(
@@ -201,9 +375,15 @@ def get_diffusion(state_dtype, dimensions, components, losses=None):
                 %if ls[comp] == 0:
                 return COMPLEX_CTR(${s_ctype})(0, 0);
                 %else:
+                    %if kappa_ramp is not None:
+                    const ${r_ctype} coeff = sqrt(${kappa_ramp}(t));
+                    %else:
+                    const ${r_ctype} coeff = ${r_const(coeff)};
+                    %endif
+
                     %if sum(ls) > 1:
                     return ${conj}(${mul}(
-                        (${r_const(coeff * ls[comp])})
+                        coeff * ${r_const(ls[comp])}
                         %for other_comp in range(components):
                             <%
                                 pwr = ls[other_comp]
@@ -216,7 +396,7 @@ def get_diffusion(state_dtype, dimensions, components, losses=None):
                         %endfor
                         ));
                     %else:
-                    return COMPLEX_CTR(${s_ctype})(${r_const(coeff)}, 0);
+                    return COMPLEX_CTR(${s_ctype})(coeff, 0);
                     %endif
                 %endif
             }
@@ -226,6 +406,7 @@ def get_diffusion(state_dtype, dimensions, components, losses=None):
             render_kwds=dict(
                 s_dtype=state_dtype,
                 losses=losses,
+                loss_ramps=loss_ramps,
                 dimensions=dimensions,
                 components=components,
                 noise_sources=len(losses),
@@ -0,0 +1,214 @@
+"""
+Storage of real-valued wavefunctions in complex containers of half the size.
+
+Two real fields are stored as the real and the imaginary parts of a single complex one.
+Since the Fourier transform of a real field is Hermitian,
+multiplying the transform of the packed field by a real function of ``k ** 2``
+(the kinetic propagator in imaginary time, or a cutoff mask)
+keeps both parts real and does not mix them,
+so a packed state can be propagated by the regular steppers.
+
+The fields can be paired along one of the two axes (see :py:func:`get_packing_axis`):
+
+* :py:data:`PACK_COMPONENTS`: the components ``2 * p`` and ``2 * p + 1``
+  of every trajectory are stored in the packed component ``p``,
+  so the packed state has ``(C + 1) // 2`` components;
+* :py:data:`PACK_TRAJECTORIES`: the trajectories ``2 * p`` and ``2 * p + 1``
+  are stored in the packed trajectory ``p``,
+  so the packed state has ``(T + 1) // 2`` trajectories.
+
+The axis giving fewer packed fields is chosen, and the stepper memory
+and the number of FFTs are reduced by the same factor.
+They are halved if the number of fields along the chosen axis is even;
+if it is odd, the imaginary part of the last packed element is unused.
+A single state (``T == 1``) with a single component (``C == 1``)
+is not reduced at all, since there is nothing to pair it with.
+"""
+
+import numpy
+
+from reikna.core import Parameter, Annotation, Transformation
+from reikna.algorithms import PureParallel
+
+from beclab.wavefunction import WavefunctionSetMetadata
+
+
+PACK_COMPONENTS = 'components'
+"""The fields of neighboring components are paired."""
+
+PACK_TRAJECTORIES = 'trajectories'
+"""The fields of neighboring trajectories are paired."""
+
+
+def packed_size(size):
+    """
+    Returns the number of complex elements storing ``size`` real fields.
+    """
+    return (size + 1) // 2
+
+
+def packed_components(components):
+    """
+    Returns the number of packed components storing ``components`` real fields.
+    """
+    return packed_size(components)
+
+
+def get_packing_axis(wfs_meta):
+    """
+    Returns the axis along which the fields of ``wfs_meta`` are paired
+    (:py:data:`PACK_COMPONENTS` or :py:data:`PACK_TRAJECTORIES`),
+    choosing the one that gives fewer packed fields
+    (the components, if they are the same).
+    """
+    trajectories = wfs_meta.trajectories
+    components = wfs_meta.components
+    if packed_size(trajectories) * components < trajectories * packed_size(components):
+        return PACK_TRAJECTORIES
+    else:
+        return PACK_COMPONENTS
+
+
+def get_packed_meta(wfs_meta):
+    """
+    Returns a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object
+    for the packed storage of the real parts of the fields of ``wfs_meta``.
+    """
+    if get_packing_axis(wfs_meta) == PACK_TRAJECTORIES:
+        components = wfs_meta.components
+        trajectories = packed_size(wfs_meta.trajectories)
+    else:
+        components = packed_components(wfs_meta.components)
+        trajectories = wfs_meta.trajectories
+
+    return WavefunctionSetMetadata(
+        wfs_meta.thread, wfs_meta.dtype, wfs_meta.grid,
+        components=components,
+        trajectories=trajectories,
+        representation=wfs_meta.representation,
+        cutoff=wfs_meta.cutoff,
+        accumulation_dtype=wfs_meta.accumulation_dtype)
+
+
+def get_packed_trajectories(wfs_meta, trajectories):
+    """
+    Returns the indices of the packed trajectories storing only the given
+    trajectories of ``wfs_meta`` (for :py:data:`PACK_TRAJECTORIES`, a packed trajectory
+    is included only if both of the trajectories it stores are in the list).
+    """
+    trajectories = numpy.asarray(trajectories, numpy.int64)
+    if get_packing_axis(wfs_meta) == PACK_COMPONENTS:
+        return trajectories
+
+    mask = numpy.zeros(wfs_meta.trajectories + 1, numpy.bool_)
+    mask[trajectories] = True
+    # The imaginary part of the last packed trajectory may be unused
+    mask[wfs_meta.trajectories] = True
+    packed_mask = mask[0:-1:2] & mask[1::2]
+    return numpy.flatnonzero(packed_mask)
+
+
+def _get_render_kwds(wfs_meta):
+    by_trajectories = (get_packing_axis(wfs_meta) == PACK_TRAJECTORIES)
+
+    # C expressions for the indices of the two fields stored in the packed element
+    # with the indices ``pt`` (trajectory) and ``pc`` (component).
+    def field_idx(pt, pc, part):
+        if by_trajectories:
+            return "2 * ({pt}) + {part}, {pc}".format(pt=pt, pc=pc, part=part)
+        else:
+            return "{pt}, 2 * ({pc}) + {part}".format(pt=pt, pc=pc, part=part)
+
+    def has_second(pt, pc):
+        if by_trajectories:
+            return "(2 * ({pt}) + 1 < {size})".format(pt=pt, size=wfs_meta.trajectories)
+        else:
+            return "(2 * ({pc}) + 1 < {size})".format(pc=pc, size=wfs_meta.components)
+
+    return dict(by_trajectories=by_trajectories, field_idx=field_idx, has_second=has_second)
+
+
+def get_pack(wfs_meta):
+    """
+    Returns a computation packing the real parts of the fields of a wavefunction
+    (the imaginary parts are discarded).
+    """
+    packed_meta = get_packed_meta(wfs_meta)
+    return PureParallel(
+        [
+            Parameter('output', Annotation(packed_meta.data, 'o')),
+            Parameter('input', Annotation(wfs_meta.data, 'i'))],
+        """
+        <%
+            pt = idxs[0]
+            pc = idxs[1]
+            coords = ', '.join(idxs[2:])
+        %>
+        const ${input.ctype} first = ${input.load_idx}(${field_idx(pt, pc, 0)}, ${coords});
+        ${output.ctype} packed = COMPLEX_CTR(${output.ctype})(first.x, 0);
+        if (${has_second(pt, pc)})
+        {
+            const ${input.ctype} second = ${input.load_idx}(
+                ${field_idx(pt, pc, 1)}, ${coords});
+            packed.y = second.x;
+        }
+        ${output.store_same}(packed);
+        """,
+        guiding_array='output',
+        render_kwds=_get_render_kwds(wfs_meta))
+
+
+def get_unpack(wfs_meta):
+    """
+    Returns a computation filling the fields of a wavefunction
+    with the real fields from the packed storage.
+    """
+    packed_meta = get_packed_meta(wfs_meta)
+    return PureParallel(
+        [
+            Parameter('output', Annotation(wfs_meta.data, 'o')),
+            Parameter('input', Annotation(packed_meta.data, 'i'))],
+        """
+        <%
+            pt = idxs[0]
+            pc = idxs[1]
+            coords = ', '.join(idxs[2:])
+        %>
+        const ${input.ctype} packed = ${input.load_same};
+        ${output.store_idx}(
+            ${field_idx(pt, pc, 0)}, ${coords}, COMPLEX_CTR(${output.ctype})(packed.x, 0));
+        if (${has_second(pt, pc)})
+        {
+            ${output.store_idx}(
+                ${field_idx(pt, pc, 1)}, ${coords}, COMPLEX_CTR(${output.ctype})(packed.y, 0));
+        }
+        """,
+        guiding_array='input',
+        render_kwds=_get_render_kwds(wfs_meta))
+
+
+def get_unpack_trf(wfs_meta):
+    """
+    Returns a transformation reading the fields of a wavefunction
+    from their packed storage,
+    so that computations written for ``wfs_meta`` can be applied to the packed state
+    without unpacking it into a separate array.
+    """
+    packed_meta = get_packed_meta(wfs_meta)
+    return Transformation(
+        [
+            Parameter('output', Annotation(wfs_meta.data, 'o')),
+            Parameter('input', Annotation(packed_meta.data, 'i'))],
+        """
+        %if by_trajectories:
+        const ${input.ctype} packed = ${input.load_idx}(
+            ${idxs[0]} / 2, ${', '.join(idxs[1:])});
+        const int part = ${idxs[0]} % 2;
+        %else:
+        const ${input.ctype} packed = ${input.load_idx}(
+            ${idxs[0]}, ${idxs[1]} / 2, ${', '.join(idxs[2:])});
+        const int part = ${idxs[1]} % 2;
+        %endif
+        ${output.store_same}(COMPLEX_CTR(${output.ctype})(part == 0 ? packed.x : packed.y, 0));
+        """,
+        render_kwds=_get_render_kwds(wfs_meta))
@@ -0,0 +1,163 @@
+import multiprocessing
+
+import numpy
+
+import reikna.cluda as cluda
+from reiknacontrib.integrator import join_results
+
+from beclab.wavefunction import WavefunctionSet
+from beclab.bec import ChunkedIntegrator
+
+
+# Per-process state of a worker (created by _init_worker()).
+_worker = None
+
+
+class _Worker:
+
+    def __init__(self, device, api_id, system, grid, state, dtype, cutoff,
+            trajectories, batch_size, samplers, seed, integrator_kwds):
+
+        api = cluda.get_api(api_id)
+        if device is None:
+            self.thread = api.Thread.create()
+        else:
+            platform_idx, device_idx = device
+            self.thread = api.Thread(api.get_platforms()[platform_idx].get_devices()[device_idx])
+
+        initial = WavefunctionSet(
+            self.thread, dtype, grid, components=state.shape[0], cutoff=cutoff)
+        initial.fill_with(state.astype(dtype))
+
+        # Each batch is a chunk of the same ensemble, integrated by the chunk loop
+        # of ChunkedIntegrator; the noise only depends on the batch number.
+        self.integrator = ChunkedIntegrator(
+            initial, system, trajectories, batch_size,
+            samplers=samplers, seed=seed, cutoff=cutoff, **integrator_kwds)
+
+    def run(self, batch, method_name, args, kwds):
+        results, infos = self.integrator.integrate_chunks(method_name, [batch], *args, **kwds)
+        return results[0], infos[0]
+
+
+def _init_worker(counter, devices, worker_args):
+    global _worker
+
+    with counter.get_lock():
+        worker_idx = counter.value
+        counter.value += 1
+
+    device = None if devices is None else devices[worker_idx % len(devices)]
+    _worker = _Worker(device, *worker_args)
+
+
+def _run_batch(task):
+    return _worker.run(*task)
+
+
+def _get_context():
+    # Forked processes would inherit the GPGPU contexts of the parent.
+    try:
+        return multiprocessing.get_context('spawn')
+    except AttributeError: # Python 2
+        return multiprocessing
+
+
+class ParallelIntegrator:
+    """
+    Integrates a Wigner ensemble in batches of trajectories distributed
+    over a pool of worker processes, each one having its own Reikna ``Thread``
+    and integrating its batches with :py:meth:`~beclab.ChunkedIntegrator.integrate_chunks`.
+    The initial state of each batch is generated from the classical state
+    with vacuum noise that only depends on ``seed`` and the number of the batch,
+    so the results do not depend on the number of workers or the order of execution
+    (and are the same as the ones of :py:class:`~beclab.ChunkedIntegrator`
+    with ``chunk_size`` equal to ``batch_size``).
+    The results for all the batches are merged with
+    ``reiknacontrib.integrator.join_results``.
+
+    Since the objects are passed to worker processes,
+    ``system``, ``grid``, ``cutoff`` and ``samplers`` must be picklable.
+
+    :param system: a :py:class:`~beclab.System` object.
+    :param grid: a :py:class:`~beclab.grid.Grid` object.
+    :param state: a numpy array with the classical initial state
+        of the shape ``(components,) + grid.shape``
+        (for example, the data of a ground state).
+    :param trajectories: the total number of trajectories.
+    :param batch_size: the number of trajectories integrated by a worker at the same time
+        (must be a divisor of ``trajectories``).
+    :param samplers: a module-level function taking a
+        :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object for a batch
+        and returning a dictionary of samplers.
+    :param dtype: the dtype of the wavefunction.
+    :param cutoff: a :py:class:`~beclab.cutoff.Cutoff` object.
+    :param seed: the seed for the vacuum noise.
+    :param processes: the number of worker processes
+        (defaults to the number of ``devices``, or to 1 if they are not given).
+    :param devices: a list of tuples ``(platform_number, device_number)``;
+        worker processes are assigned to devices in a round-robin fashion.
+        If not given, each worker uses the default device.
+    :param api_id: the Reikna API identifier (``reikna.cluda.ocl_id()``
+        or ``reikna.cluda.cuda_id()``).
+    :param integrator_kwds: keyword arguments for the :py:class:`~beclab.Integrator`
+        constructor.
+    """
+
+    def __init__(self, system, grid, state, trajectories, batch_size,
+            samplers=None, dtype=numpy.complex128, cutoff=None, seed=None,
+            processes=None, devices=None, api_id=None, integrator_kwds=None):
+
+        if trajectories % batch_size != 0:
+            raise ValueError(
+                "The number of trajectories must be a multiple of the batch size")
+
+        if seed is None:
+            seed = numpy.random.randint(0, 2**32-1)
+        if processes is None:
+            processes = 1 if devices is None else len(devices)
+        if api_id is None:
+            api_id = cluda.ocl_id()
+        if integrator_kwds is None:
+            integrator_kwds = {}
+
+        self._batches = trajectories // batch_size
+        self._processes = processes
+        self._devices = devices
+        self._worker_args = (
+            api_id, system, grid, numpy.asarray(state), dtype, cutoff,
+            trajectories, batch_size, samplers, seed, integrator_kwds)
+
+    def _run(self, method_name, args, kwds):
+        context = _get_context()
+        counter = context.Value('i', 0)
+        pool = context.Pool(
+            self._processes, initializer=_init_worker,
+            initargs=(counter, self._devices, self._worker_args))
+        try:
+            outputs = pool.map(
+                _run_batch,
+                [(batch, method_name, args, kwds) for batch in range(self._batches)],
+                chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        results, infos = zip(*outputs)
+        return join_results(list(results)), list(infos)
+
+    def fixed_step(self, *args, **kwds):
+        """
+        Integrates all the batches with
+        :py:meth:`~beclab.Integrator.fixed_step` (the ``wfs`` argument is omitted)
+        and returns a tuple ``(result, infos)``, where ``result`` is the merged result
+        and ``infos`` is a list of ``reiknacontrib.integrator.IntegrationInfo`` objects
+        for each batch.
+        """
+        return self._run('fixed_step', args, kwds)
+
+    def adaptive_step(self, *args, **kwds):
+        """
+        Same as :py:meth:`fixed_step`, but uses :py:meth:`~beclab.Integrator.adaptive_step`.
+        """
+        return self._run('adaptive_step', args, kwds)
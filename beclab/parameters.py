@@ -0,0 +1,81 @@
+import numpy
+
+from reikna.core import Type
+
+
+def get_interactions_type(wfs_meta):
+    """
+    Returns the array type for the per-trajectory interaction coefficients
+    passed to kernels at runtime (see :py:class:`SystemParameters`).
+    """
+    return Type(
+        wfs_meta.accumulation_dtype,
+        (wfs_meta.trajectories, wfs_meta.components, wfs_meta.components))
+
+
+class SystemParameters:
+    """
+    A device buffer with per-trajectory values of the two-body interaction coefficients
+    of a :py:class:`~beclab.System`, passed to the energy measurement kernels as arguments
+    instead of being compiled in.
+    Changing the values does not require recompilation,
+    and different trajectories may use different values,
+    so the energy of an ensemble can be evaluated for a sweep over the coefficients
+    in a single batched launch.
+
+    Only :py:class:`~beclab.meters.EnergyMeter` and :py:class:`~beclab.samplers.EnergySampler`
+    accept these parameters
+    (including the ones wrapped in :py:class:`~beclab.meters.MeterGroup`,
+    :py:class:`~beclab.meters.EnsembleStatisticsMeter`
+    and :py:class:`~beclab.meters.AsyncMeter`).
+    The compiled kernels only depend on the shape of the buffer,
+    so all the objects created for the same wavefunction metadata share them.
+
+    The propagation is not covered: the drift and diffusion of :py:class:`~beclab.Integrator`
+    and the ground state generators have the interaction and loss coefficients,
+    the trap parameters and the linear terms of the system compiled in,
+    because the drift functions of ``reiknacontrib.integrator`` steppers
+    do not receive kernel arguments or trajectory indices.
+    An integrator for a system with different coefficients is a separate program
+    (see :py:func:`~beclab.cache.enable_binary_cache` for avoiding
+    its compilation in subsequent runs).
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param system: a :py:class:`~beclab.System` object with the initial values.
+
+    .. py:attribute:: interactions
+
+        A Reikna ``Array`` with the shape ``(trajectories, components, components)``
+        containing the interaction coefficients for each trajectory.
+
+    .. py:attribute:: interactions_type
+
+        A Reikna ``Type`` object with the metadata of :py:attr:`interactions`.
+    """
+
+    def __init__(self, wfs_meta, system):
+        self._thread = wfs_meta.thread
+        self._trajectories = wfs_meta.trajectories
+        self.interactions_type = get_interactions_type(wfs_meta)
+        self.interactions = self._thread.empty_like(self.interactions_type)
+        self.set_interactions(system.interactions)
+
+    def set_interactions(self, interactions):
+        """
+        Sets the interaction coefficients.
+        ``interactions`` is an array with the shape ``(components, components)``
+        (the same values for all trajectories)
+        or ``(trajectories, components, components)``.
+        """
+        interactions = numpy.asarray(interactions, self.interactions_type.dtype)
+        if interactions.ndim == 2:
+            interactions = numpy.tile(interactions, (self._trajectories, 1, 1))
+        assert interactions.shape == self.interactions_type.shape
+        self._thread.to_device(interactions, dest=self.interactions)
+
+    def get_interactions(self):
+        """
+        Returns a numpy array with the current interaction coefficients
+        for each trajectory.
+        """
+        return self.interactions.get()
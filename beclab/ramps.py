@@ -0,0 +1,127 @@
+import numpy
+
+import reikna.cluda.dtypes as dtypes
+from reikna.cluda import Module
+
+
+def _natural_spline_coeffs(times, values):
+    """
+    Returns the second derivatives of the natural cubic spline
+    going through the points ``(times, values)``.
+    """
+    n = len(times)
+    h = numpy.diff(times)
+
+    matrix = numpy.zeros((n, n))
+    rhs = numpy.zeros(n)
+    matrix[0, 0] = 1
+    matrix[-1, -1] = 1
+    for i in range(1, n - 1):
+        matrix[i, i - 1] = h[i - 1] / 6
+        matrix[i, i] = (h[i - 1] + h[i]) / 3
+        matrix[i, i + 1] = h[i] / 6
+        rhs[i] = (
+            (values[i + 1] - values[i]) / h[i] - (values[i] - values[i - 1]) / h[i - 1])
+
+    return numpy.linalg.solve(matrix, rhs)
+
+
+class Ramp:
+    """
+    A time schedule of a scalar coefficient defined by a table of values.
+    The table is compiled into the kernels as constants
+    and looked up by the current time inside the drift function,
+    so the whole schedule can be integrated in a single call.
+    Before the first and after the last time in the table the value stays constant.
+
+    :param times: an increasing sequence of times.
+    :param values: a sequence of values of the coefficient at ``times``.
+    :param kind: ``'linear'`` for a piecewise-linear interpolation,
+        or ``'cubic'`` for a natural cubic spline.
+    """
+
+    def __init__(self, times, values, kind='linear'):
+        times = numpy.asarray(times, numpy.float64)
+        values = numpy.asarray(values, numpy.float64)
+
+        if times.ndim != 1 or times.shape != values.shape:
+            raise ValueError("Times and values must be one-dimensional sequences of equal length")
+        if times.size < 2:
+            raise ValueError("A ramp must have at least two points")
+        if (numpy.diff(times) <= 0).any():
+            raise ValueError("Times must be strictly increasing")
+        if kind not in ('linear', 'cubic'):
+            raise ValueError("Unknown interpolation kind: " + repr(kind))
+
+        self.times = times
+        self.values = values
+        self.kind = kind
+
+        if kind == 'cubic' and times.size > 2:
+            self.second_derivatives = _natural_spline_coeffs(times, values)
+        else:
+            self.second_derivatives = numpy.zeros_like(values)
+
+    def __call__(self, t):
+        """
+        Returns the value of the coefficient at time ``t`` (a number or a numpy array).
+        """
+        t = numpy.clip(numpy.asarray(t, numpy.float64), self.times[0], self.times[-1])
+        i = numpy.clip(numpy.searchsorted(self.times, t, side='right') - 1, 0, self.times.size - 2)
+
+        h = self.times[i + 1] - self.times[i]
+        b = (t - self.times[i]) / h
+        a = 1 - b
+        return (
+            a * self.values[i] + b * self.values[i + 1]
+            + ((a ** 3 - a) * self.second_derivatives[i]
+                + (b ** 3 - b) * self.second_derivatives[i + 1]) * h ** 2 / 6)
+
+    def get_module(self, dtype):
+        """
+        Returns the module with the function
+
+        ::
+
+            INLINE WITHIN_KERNEL ${r_ctype} ${prefix}(${r_ctype} t)
+
+        returning the value of the coefficient at time ``t``,
+        where ``r_ctype`` corresponds to the real dtype ``dtype``.
+        """
+        h = numpy.diff(self.times)
+        return Module.create(
+            """
+            <%
+                r_ctype = dtypes.ctype(r_dtype)
+                r_const = lambda x: dtypes.c_constant(x, r_dtype)
+            %>
+            INLINE WITHIN_KERNEL ${r_ctype} ${prefix}(const ${r_ctype} t)
+            {
+                if (t <= ${r_const(times[0])})
+                    return ${r_const(values[0])};
+
+                %for i in range(1, len(times)):
+                if (t < ${r_const(times[i])})
+                {
+                    const ${r_ctype} b = (t - ${r_const(times[i - 1])}) * ${r_const(1 / h[i - 1])};
+                    const ${r_ctype} a = 1 - b;
+                    return
+                        a * ${r_const(values[i - 1])} + b * ${r_const(values[i])}
+                        %if cubic:
+                        + (a * a * a - a) * ${r_const(sds[i - 1] * h[i - 1] ** 2 / 6)}
+                        + (b * b * b - b) * ${r_const(sds[i] * h[i - 1] ** 2 / 6)}
+                        %endif
+                        ;
+                }
+                %endfor
+
+                return ${r_const(values[-1])};
+            }
+            """,
+            render_kwds=dict(
+                r_dtype=dtypes.normalize_type(dtype),
+                times=self.times,
+                values=self.values,
+                sds=self.second_derivatives,
+                h=h,
+                cubic=(self.kind == 'cubic')))
@@ -1,8 +1,11 @@
 import numpy
 
 from reiknacontrib.integrator import Sampler, StopIntegration
-from beclab.wavefunction import WavefunctionSet
-from beclab.meters import EnergyMeter, DensityIntegralMeter, DensitySliceMeter
+from beclab.meters import (
+    EnergyMeter, HamiltonianMeter, DensityIntegralMeter, DensitySliceMeter, OverlapMeter,
+    VisibilityMeter, MeterGroup, EnsembleStatisticsMeter, AsyncMeter)
+from beclab.packing import get_unpack, get_packed_trajectories
+from beclab.cache import compile_cached
 
 
 class PsiSampler(Sampler):
@@ -27,28 +30,23 @@ class PopulationSampler(Sampler):
 
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
     :param beam_splitter: a :py:class:`~beclab.BeamSplitter` object.
-        If given, it will be applied to the wavefunction before measuring populations.
+        If given, it will be applied to the wavefunction on the fly during the measurement
+        (the original wavefunction is not modified).
     :param theta: a rotation angle to pass to the beam splitter.
+
+    .. py:attribute:: meter
+
+        The :py:class:`~beclab.meters.DensityIntegralMeter` object used for the measurements.
     """
 
     def __init__(self, wfs_meta, beam_splitter=None, theta=0):
         Sampler.__init__(self)
-        self._theta = theta
-        self._pmeter = DensityIntegralMeter(wfs_meta, axes=list(range(wfs_meta.grid.dimensions)))
-
-        self._beam_splitter = beam_splitter
-        if beam_splitter is not None:
-            self._wfs_temp = WavefunctionSet.for_meta(wfs_meta)
+        self.meter = DensityIntegralMeter(
+            wfs_meta, axes=list(range(wfs_meta.grid.dimensions)),
+            beam_splitter=beam_splitter, theta=theta)
 
     def __call__(self, wfs_data, t):
-        if self._beam_splitter is not None:
-            self._wfs_temp.fill_with(wfs_data)
-            self._beam_splitter(self._wfs_temp.data, t, self._theta)
-            data = self._wfs_temp.data
-        else:
-            data = wfs_data
-
-        return self._pmeter(data)
+        return self.meter(wfs_data, t)
 
 
 class InteractionSampler(Sampler):
@@ -57,18 +55,23 @@ class InteractionSampler(Sampler):
 
     Collects the integral interaction :math:`I = \int \Psi_1^* \Psi_2 d\mathbf{x}`
     (both mean and per-component).
+    See :py:class:`beclab.meters.OverlapMeter` for details.
 
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param comp1: the number of the first (conjugated) component.
+    :param comp2: the number of the second component.
+
+    .. py:attribute:: meter
+
+        The :py:class:`~beclab.meters.OverlapMeter` object used for the measurements.
     """
 
-    def __init__(self, wfs_meta):
+    def __init__(self, wfs_meta, comp1=0, comp2=1):
         Sampler.__init__(self)
-        self._grid = wfs_meta.grid
+        self.meter = OverlapMeter(wfs_meta, comp1=comp1, comp2=comp2)
 
     def __call__(self, wfs_data, t):
-        psi = wfs_data.get()
-        dimensions = tuple(range(1, len(psi.shape) - 1))
-        return (psi[:,0].conj() * psi[:,1]).sum(dimensions) * self._grid.dV
+        return self.meter(wfs_data)
 
 
 class VisibilitySampler(Sampler):
@@ -77,18 +80,20 @@ class VisibilitySampler(Sampler):
 
     Collects the visibility :math:`V = 2 \int \Psi_1^* \Psi_2 d\mathbf{x} / (N_1 + N_2)`
     (both mean and per-component).
+    The populations and the overlap are measured in a single pass
+    (see :py:class:`beclab.meters.VisibilityMeter` for details).
 
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param comp1: the number of the first component.
+    :param comp2: the number of the second component.
     """
 
-    def __init__(self, wfs_meta):
+    def __init__(self, wfs_meta, comp1=0, comp2=1):
         Sampler.__init__(self)
-        self._psampler = PopulationSampler(wfs_meta)
-        self._isampler = InteractionSampler(wfs_meta)
+        self._vmeter = VisibilityMeter(wfs_meta, comp1=comp1, comp2=comp2)
 
     def __call__(self, wfs_data, t):
-        Ns = self._psampler(wfs_data, t)
-        Is = self._isampler(wfs_data, t)
+        Ns, Is = self._vmeter(wfs_data)
         return 2 * numpy.abs(Is) / Ns.sum(1)
 
 
@@ -101,30 +106,24 @@ class DensityIntegralSampler(Sampler):
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
     :param axes: indices of axes to integrate over (integrates over all axes if not given).
     :param beam_splitter: a :py:class:`~beclab.BeamSplitter` object.
-        If given, it will be applied to the wavefunction before measuring populations.
+        If given, it will be applied to the wavefunction on the fly during the measurement
+        (the original wavefunction is not modified).
     :param theta: a rotation angle to pass to the beam splitter.
     :param no_values: if ``True``, no per-trajectory values will be preserved.
+
+    .. py:attribute:: meter
+
+        The :py:class:`~beclab.meters.DensityIntegralMeter` object used for the measurements.
     """
 
     def __init__(self, wfs_meta, axes=None, beam_splitter=None, theta=0, no_values=False):
         Sampler.__init__(self, no_values=no_values)
 
-        self._dmeter = DensityIntegralMeter(wfs_meta, axes=axes)
-        self._theta = theta
-
-        self._beam_splitter = beam_splitter
-        if beam_splitter is not None:
-            self._wfs_temp = WavefunctionSet.for_meta(wfs_meta)
+        self.meter = DensityIntegralMeter(
+            wfs_meta, axes=axes, beam_splitter=beam_splitter, theta=theta)
 
     def __call__(self, wfs_data, t):
-        if self._beam_splitter is not None:
-            self._wfs_temp.fill_with(wfs_data)
-            self._beam_splitter(self._wfs_temp.data, t, self._theta)
-            data = self._wfs_temp.data
-        else:
-            data = wfs_data
-
-        return self._dmeter(data)
+        return self.meter(wfs_data, t)
 
 
 class DensitySliceSampler(Sampler):
@@ -136,30 +135,24 @@ class DensitySliceSampler(Sampler):
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
     :param fixed_axes: a dictionary ``{axis: value}`` of fixed indices for the slice.
     :param beam_splitter: a :py:class:`~beclab.BeamSplitter` object.
-        If given, it will be applied to the wavefunction before measuring populations.
+        If given, it will be applied to the wavefunction on the fly during the measurement
+        (the original wavefunction is not modified).
     :param theta: a rotation angle to pass to the beam splitter.
     :param no_values: if ``True``, no per-trajectory values will be preserved.
+
+    .. py:attribute:: meter
+
+        The :py:class:`~beclab.meters.DensitySliceMeter` object used for the measurements.
     """
 
     def __init__(self, wfs_meta, fixed_axes={}, beam_splitter=None, theta=0, no_values=False):
         Sampler.__init__(self, no_values=no_values)
 
-        self._dmeter = DensitySliceMeter(wfs_meta, fixed_axes=fixed_axes)
-        self._theta = theta
-
-        self._beam_splitter = beam_splitter
-        if beam_splitter is not None:
-            self._wfs_temp = WavefunctionSet.for_meta(wfs_meta)
+        self.meter = DensitySliceMeter(
+            wfs_meta, fixed_axes=fixed_axes, beam_splitter=beam_splitter, theta=theta)
 
     def __call__(self, wfs_data, t):
-        if self._beam_splitter is not None:
-            self._wfs_temp.fill_with(wfs_data)
-            self._beam_splitter(self._wfs_temp.data, t, self._theta)
-            data = self._wfs_temp.data
-        else:
-            data = wfs_data
-
-        return self._dmeter(data)
+        return self.meter(wfs_data, t)
 
 
 class EnergySampler(Sampler):
@@ -170,14 +163,20 @@ class EnergySampler(Sampler):
 
     :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
     :param system: the :py:class:`~beclab.System` object the wavefunction corresponds to.
+    :param parameters: a :py:class:`~beclab.parameters.SystemParameters` object
+        with runtime values of the system coefficients.
+
+    .. py:attribute:: meter
+
+        The :py:class:`~beclab.meters.EnergyMeter` object used for the measurements.
     """
 
-    def __init__(self, wfs_meta, system):
+    def __init__(self, wfs_meta, system, parameters=None):
         Sampler.__init__(self)
-        self._energy = EnergyMeter(wfs_meta, system)
+        self.meter = EnergyMeter(wfs_meta, system, parameters=parameters)
 
     def __call__(self, wfs_data, t):
-        return self._energy(wfs_data)
+        return self.meter(wfs_data, t)
 
 
 class StoppingEnergySampler(Sampler):
@@ -204,3 +203,357 @@ class StoppingEnergySampler(Sampler):
 
         self._previous_E = E
         return E
+
+
+def _relative_difference(E, previous_E):
+    # The energy of a trajectory with all the target populations equal to zero is zero,
+    # in which case the absolute difference is used.
+    nonzero = (E != 0)
+    return numpy.where(
+        nonzero, numpy.abs(E - previous_E) / numpy.where(nonzero, numpy.abs(E), 1),
+        numpy.abs(E - previous_E))
+
+
+class ConvergenceSampler(Sampler):
+    """
+    Bases: ``reiknacontrib.integrator.Sampler``
+
+    Collects the total energy of a BEC and the chemical potentials of its components
+    in a single measurement (see :py:class:`beclab.meters.HamiltonianMeter` for details),
+    and raises ``reiknacontrib.integrator.StopIntegration`` when the state has converged.
+    Since the collected value is the energy, the sampler can be used
+    both for the convergence estimation and as the stopping criterion.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param system: the :py:class:`~beclab.System` object the wavefunction corresponds to.
+    :param E_diff: the integration stops when the relative difference of the energy
+        of the newly collected sample and the previous one is less than this value.
+    :param residual_limit: if given, the integration stops instead when the relative residual
+        :math:`\Vert H \Psi - \mu \Psi \Vert` is less than this value.
+    :param freeze_filter: a :py:class:`~beclab.filters.FreezeFilter` object.
+        If given, the convergence of every trajectory is estimated separately,
+        the converged trajectories are frozen,
+        and the integration stops when all of them have converged.
+        Otherwise only the first trajectory is used for the estimation.
+    :param packed: if ``True``, the sampler is called with real fields in the packed storage
+        (see :py:class:`beclab.meters.HamiltonianMeter`);
+        ``freeze_filter`` must then be created for the packed metadata
+        (see :py:func:`~beclab.packing.get_packed_meta`).
+
+    .. py:attribute:: mus
+
+        A list of arrays of chemical potentials with the shape
+        ``(trajectories, components)``, one for each collected sample.
+
+    .. py:attribute:: residuals
+
+        A list of arrays of relative residuals with the shape ``(trajectories,)``,
+        one for each collected sample (empty if ``residual_limit`` is not given).
+    """
+
+    def __init__(self, wfs_meta, system, E_diff=1e-6, residual_limit=None, freeze_filter=None,
+            packed=False):
+        Sampler.__init__(self)
+        self._meter = HamiltonianMeter(
+            wfs_meta, system, residual=(residual_limit is not None), packed=packed)
+        self._previous_E = None
+        self._E_diff = E_diff
+        self._residual_limit = residual_limit
+        self._freeze_filter = freeze_filter
+        self._wfs_meta = wfs_meta
+        self._packed = packed
+        self.mus = []
+        self.residuals = []
+
+    def __call__(self, wfs_data, t):
+        E, mus, r = self._meter(wfs_data)
+        self.mus.append(mus)
+
+        if self._freeze_filter is not None:
+            if self._residual_limit is not None:
+                self.residuals.append(r)
+                converged = r < self._residual_limit
+            elif self._previous_E is not None:
+                converged = _relative_difference(E, self._previous_E) < self._E_diff
+            else:
+                converged = numpy.zeros(E.shape, numpy.bool_)
+
+            converged = numpy.flatnonzero(converged)
+            if self._packed:
+                # A packed trajectory can only be frozen when all of its fields have converged
+                converged = get_packed_trajectories(self._wfs_meta, converged)
+            self._freeze_filter.freeze(wfs_data, converged)
+            if self._freeze_filter.frozen.all():
+                raise StopIntegration(E)
+        elif self._residual_limit is not None:
+            self.residuals.append(r)
+            if r.max() < self._residual_limit:
+                raise StopIntegration(E)
+        elif self._previous_E is not None:
+            if _relative_difference(E[0], self._previous_E[0]) < self._E_diff:
+                raise StopIntegration(E)
+
+        self._previous_E = E
+        return E
+
+
+class EnsembleStatisticsSampler(Sampler):
+    """
+    Bases: ``reiknacontrib.integrator.Sampler``
+
+    Collects the mean and the standard error of the results of another sampler,
+    calculated on the device (see :py:class:`beclab.meters.EnsembleStatisticsMeter`).
+    The integration result contains the ``mean``, ``stderr`` and ``values`` fields,
+    same as for the other samplers, with ``values`` holding the results
+    for the first ``keep_trajectories`` trajectories (``None`` if it is zero).
+    During the integration each sample is collected as a single array
+    ``[mean, stderr, value_1, ..., value_K]``, which is split into the fields
+    by :py:meth:`finalize` (called by :py:class:`~beclab.Integrator`
+    at the end of the integration, see :py:func:`finalize_results`).
+    Since the mean is not available to the integrator,
+    such samplers cannot be used for the convergence estimation.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param sampler: one of :py:class:`PopulationSampler`, :py:class:`DensityIntegralSampler`,
+        :py:class:`DensitySliceSampler`, :py:class:`EnergySampler`
+        or :py:class:`InteractionSampler`.
+    :param keep_trajectories: the number of first trajectories
+        for which per-trajectory results will be preserved.
+    """
+
+    def __init__(self, wfs_meta, sampler, keep_trajectories=0):
+        Sampler.__init__(self, no_mean=True, no_stderr=True)
+        meter = getattr(sampler, 'meter', None)
+        if meter is None or not hasattr(meter, 'computation'):
+            raise ValueError("Statistics cannot be collected for the given sampler")
+        self._meter = EnsembleStatisticsMeter(
+            wfs_meta, meter, keep_trajectories=keep_trajectories)
+
+    def __call__(self, wfs_data, t):
+        mean, stderr, values = self._meter(wfs_data, t)
+        if values is None:
+            return numpy.array([mean, stderr])
+        else:
+            return numpy.concatenate([[mean, stderr], values])
+
+    def finalize(self, sample_result):
+        """
+        Returns the dictionary with the ``time``, ``mean``, ``stderr`` and ``values`` fields
+        for the samples collected by the integrator (``result[name]``).
+        """
+        return unpack_statistics(sample_result)
+
+
+def unpack_statistics(sample_result):
+    """
+    Converts the samples collected by :py:class:`EnsembleStatisticsSampler`
+    (that is, ``result[name]`` where ``result`` is returned by
+    ``reiknacontrib.integrator.Integrator``)
+    into a dictionary with the keys ``time``, ``mean``, ``stderr`` and ``values``,
+    same as for regular samplers
+    (``values`` is ``None`` if no per-trajectory results were kept).
+    """
+    values = numpy.asarray(sample_result['values'])
+    return dict(
+        time=sample_result['time'],
+        mean=values[:,0],
+        stderr=values[:,1].real,
+        values=values[:,2:] if values.shape[1] > 2 else None)
+
+
+def finalize_results(result, samplers):
+    """
+    Replaces the entries of ``result`` (returned by ``reiknacontrib.integrator.Integrator``)
+    for the samplers that collect their values in a non-standard way
+    (:py:class:`EnsembleStatisticsSampler` and :py:class:`AsyncSampler`)
+    with the regular ``time``, ``mean``, ``stderr`` and ``values`` fields.
+    Called by :py:class:`~beclab.Integrator` at the end of every integration.
+    """
+    if samplers is None:
+        return result
+    for name, sampler in samplers.items():
+        finalize = getattr(sampler, 'finalize', None)
+        if finalize is not None and name in result:
+            result[name] = finalize(result[name])
+    return result
+
+
+class AsyncSampler(Sampler):
+    """
+    Bases: ``reiknacontrib.integrator.Sampler``
+
+    Wraps another sampler making the sampling non-blocking
+    (see :py:class:`beclab.meters.AsyncMeter` for details),
+    so that the integration continues while the samples are being transferred to the host.
+    The integrator receives empty arrays during the integration;
+    :py:func:`finalize_results` (called by :py:class:`~beclab.Integrator` at the end of it)
+    replaces them with the actual collected results.
+    Since the results are not available to the integrator while it is running,
+    such samplers cannot be used for the convergence estimation.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param sampler: one of :py:class:`PopulationSampler`, :py:class:`DensityIntegralSampler`,
+        :py:class:`DensitySliceSampler`, :py:class:`EnergySampler`
+        or :py:class:`InteractionSampler`.
+    :param buffers: the number of device buffers for results.
+    """
+
+    def __init__(self, wfs_meta, sampler, buffers=2):
+        Sampler.__init__(self, no_mean=True, no_stderr=True)
+        meter = getattr(sampler, 'meter', None)
+        if meter is None or not hasattr(meter, 'computation'):
+            raise ValueError("The given sampler cannot be made asynchronous")
+        self._meter = AsyncMeter(wfs_meta, meter, buffers=buffers)
+
+    def __call__(self, wfs_data, t):
+        self._meter(wfs_data, t)
+        return numpy.empty(0)
+
+    def get_result(self):
+        """
+        Waits for all the pending transfers to finish and returns a dictionary
+        with the keys ``time``, ``mean``, ``stderr`` and ``values``
+        for the samples collected since the previous call.
+        """
+        samples = self._meter.collect()
+        ts = numpy.array([t for t, _ in samples])
+        values = numpy.array([value for _, value in samples])
+        trajectories = values.shape[1]
+        return dict(
+            time=ts,
+            mean=values.mean(1),
+            stderr=values.std(1) / numpy.sqrt(trajectories),
+            values=values)
+
+    def finalize(self, sample_result):
+        """
+        Returns the collected results (see :py:meth:`get_result`);
+        ``sample_result`` (the placeholders accumulated by the integrator) is ignored.
+        """
+        return self.get_result()
+
+    def release(self):
+        """
+        Discards the pending results and stops the background download thread.
+        """
+        self._meter.release()
+
+
+def release_samplers(samplers):
+    """
+    Calls ``release()`` for the samplers that have it (e.g. :py:class:`AsyncSampler`).
+    Used by :py:class:`~beclab.Integrator` when the integration raises an exception.
+    """
+    if samplers is None:
+        return
+    for sampler in samplers.values():
+        release = getattr(sampler, 'release', None)
+        if release is not None:
+            release()
+
+
+class _GroupedSampler(Sampler):
+    """
+    A proxy for a sampler from a :py:class:`SamplerGroup`.
+    Sampler options are taken from the original sampler.
+    """
+
+    def __init__(self, group, name, sampler):
+        Sampler.__init__(
+            self, no_mean=sampler.no_mean, no_stderr=sampler.no_stderr,
+            no_values=sampler.no_values)
+        self._group = group
+        self._name = name
+
+    def __call__(self, wfs_data, t):
+        return self._group._get_value(self._name, wfs_data, t)
+
+
+class SamplerGroup:
+    """
+    Combines several samplers into a single computation.
+    All the measurements are performed in one call,
+    the results are written into a single packed array
+    and transferred to the host at once.
+
+    The supported samplers are :py:class:`PopulationSampler`, :py:class:`DensityIntegralSampler`,
+    :py:class:`DensitySliceSampler`, :py:class:`EnergySampler`
+    and :py:class:`InteractionSampler`.
+
+    :param wfs_meta: a :py:class:`~beclab.wavefunction.WavefunctionSetMetadata` object.
+    :param samplers: a dictionary ``{name: sampler}``.
+
+    .. py:attribute:: samplers
+
+        A dictionary ``{name: sampler}`` with the same keys as the ``samplers`` parameter,
+        which can be passed to :py:meth:`beclab.Integrator.fixed_step` or
+        :py:meth:`beclab.Integrator.adaptive_step` (possibly merged with other samplers).
+    """
+
+    def __init__(self, wfs_meta, samplers):
+        self._names = list(samplers.keys())
+
+        meters = []
+        for name in self._names:
+            meter = getattr(samplers[name], 'meter', None)
+            if meter is None or not hasattr(meter, 'computation'):
+                raise ValueError("Sampler " + repr(name) + " cannot be a part of a group")
+            meters.append(meter)
+
+        self._meter = MeterGroup(wfs_meta, meters)
+        self._time = None
+        self._values = {}
+        self._served = set()
+
+        self.samplers = dict(
+            (name, _GroupedSampler(self, name, samplers[name])) for name in self._names)
+
+    def _get_value(self, name, wfs_data, t):
+        # The values measured at time ``t`` are shared by all the proxy samplers.
+        # A new measurement is made at a different time, or if a proxy is called again
+        # at the same time (e.g. when the adaptive step integrator repeats a sample
+        # with a different step), so the result does not depend on
+        # which proxies are actually called and in what order.
+        if t != self._time or name in self._served:
+            self._values = dict(zip(self._names, self(wfs_data, t)))
+            self._time = t
+            self._served = set()
+        self._served.add(name)
+        return self._values[name]
+
+    def __call__(self, wfs_data, t):
+        """
+        Returns a list of results of the samplers in the group.
+        """
+        return self._meter(wfs_data, t)
+
+
+class UnpackingSampler(Sampler):
+    """
+    Bases: ``reiknacontrib.integrator.Sampler``
+
+    A proxy for a sampler of a wavefunction propagated in packed real form
+    (see :py:mod:`beclab.packing`).
+    Before every measurement the packed state is unpacked into ``wfs``
+    and passed to the original sampler.
+    Sampler options are taken from the original sampler.
+    :py:class:`ConvergenceSampler` can read the packed state directly
+    (see its ``packed`` parameter) and does not need this proxy.
+
+    :param wfs: a :py:class:`~beclab.WavefunctionSet` object used as the buffer
+        for the unpacked state (its contents are overwritten).
+    :param sampler: a ``reiknacontrib.integrator.Sampler`` object
+        created for ``wfs``.
+    """
+
+    def __init__(self, wfs, sampler):
+        Sampler.__init__(
+            self, no_mean=sampler.no_mean, no_stderr=sampler.no_stderr,
+            no_values=sampler.no_values)
+        self._wfs_data = wfs.data
+        self._unpack = compile_cached(wfs.thread, get_unpack, wfs)
+        self._sampler = sampler
+
+    def __call__(self, wfs_data, t):
+        self._unpack(self._wfs_data, wfs_data)
+        return self._sampler(self._wfs_data, t)
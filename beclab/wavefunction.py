@@ -5,7 +5,7 @@ from reikna.core import Computation, Parameter, Annotation, Transformation, Type
 from reikna.cbrng import CBRNG
 from reikna.fft import FFT
 from reikna.algorithms import PureParallel
-from reikna.transformations import ignore, broadcast_const
+from reikna.transformations import ignore
 
 
 #: "Classical" representation (wavefunction)
@@ -50,22 +50,46 @@ def trf_mask(psi_arr, mask_arr):
         """)
 
 
+def trf_stream_counters(counters_arr):
+    """
+    Fills the random number generator counters with zeros,
+    except for the highest word, which is set to the ``stream`` number.
+    """
+    words = counters_arr.dtype.fields['v'][0].shape[0]
+    return Transformation(
+        [Parameter('output', Annotation(counters_arr, 'o')),
+        Parameter('stream', Annotation(numpy.uint32))],
+        """
+        ${output.ctype} counters;
+        %for i in range(words - 1):
+        counters.v[${i}] = 0;
+        %endfor
+        counters.v[${words - 1}] = ${stream};
+        ${output.store_same}(counters);
+        """,
+        render_kwds=dict(words=words))
+
+
 class WignerCoherent(Computation):
+    """
+    Adds the vacuum noise to a classical wavefunction.
+    Different values of the ``stream`` argument produce independent noise
+    for the same ``seed``.
+    """
 
     def __init__(self, grid, data_out, data_in, cutoff=None, seed=None):
         Computation.__init__(self, [
             Parameter('output', Annotation(data_out, 'o')),
-            Parameter('input', Annotation(data_in, 'i'))])
+            Parameter('input', Annotation(data_in, 'i')),
+            Parameter('stream', Annotation(numpy.uint32))])
 
         scale = numpy.sqrt(0.5) / numpy.sqrt(grid.dV / grid.size)
 
         self._rng = CBRNG.normal_bm(
             data_out, len(data_out.shape),
             seed=seed, sampler_kwds=dict(std=scale))
-        zeros = broadcast_const(
-            self._rng.parameter.counters,
-            numpy.zeros(tuple(), self._rng.parameter.counters.dtype))
-        self._rng.parameter.counters.connect(zeros, zeros.output)
+        counters = trf_stream_counters(self._rng.parameter.counters)
+        self._rng.parameter.counters.connect(counters, counters.output, stream=counters.stream)
         trf_ignore = ignore(self._rng.parameter.counters)
         self._rng.parameter.counters.connect(trf_ignore, trf_ignore.input)
 
@@ -83,11 +107,11 @@ class WignerCoherent(Computation):
             combine, combine.noise,
             psi_c=combine.psi_c, psi_w=combine.psi_w)
 
-    def _build_plan(self, plan_factory, device_params, output, input_):
+    def _build_plan(self, plan_factory, device_params, output, input_, stream):
         plan = plan_factory()
 
         randoms = plan.temp_array_like(output)
-        plan.computation_call(self._rng, randoms)
+        plan.computation_call(self._rng, randoms=randoms, stream=stream)
 
         if self._cutoff is None:
             plan.computation_call(self._fft, output, input_, randoms, inverse=True)
@@ -126,10 +150,33 @@ def get_multiply(wfs_meta):
             mul=functions.mul(wfs_meta.dtype, real_dtype)))
 
 
+def get_wigner_corrections(wfs_meta, components):
+    r"""
+    Returns a tuple ``(delta, corrections)``, where ``delta`` is the value of
+    the restricted delta function :math:`\delta_P(\mathbf{x}, \mathbf{x}) = M / V`
+    (:math:`M` being the number of active modes),
+    and ``corrections`` is a ``(components, components)`` array of the terms
+    :math:`-(1 + \delta_{jk}) \delta_P / 2` appearing after the symmetric ordering
+    of the two-body interaction terms.
+    """
+    delta = wfs_meta.modes / wfs_meta.grid.V
+    corrections = -(
+        numpy.ones((components, components)) / 2 + numpy.eye(components) / 2) * delta
+    return delta, corrections
+
+
 class WavefunctionSetMetadata:
     """
     Metadata for a wavefunction container object.
 
+    .. py:attribute:: accumulation_dtype
+
+        A real ``numpy.dtype`` object used by meters and filters for reductions
+        over the wavefunction (populations, energies, normalization coefficients).
+        Defaults to the real counterpart of :py:attr:`dtype`; setting it to ``float64``
+        for a ``complex64`` container enables the mixed precision mode
+        (single precision storage and propagation, double precision accumulation).
+
     .. py:attribute:: components
 
         The number of components in this wavefunction.
@@ -170,7 +217,7 @@ class WavefunctionSetMetadata:
 
     def __init__(self, thread, dtype, grid,
             components=1, trajectories=1, representation=REPR_CLASSICAL,
-            cutoff=None):
+            cutoff=None, accumulation_dtype=None):
 
         self.thread = thread
         self.grid = grid
@@ -181,6 +228,9 @@ class WavefunctionSetMetadata:
         self.shape = (trajectories, components) + grid.shape
         self.data = Type(dtype, self.shape)
         self.cutoff = cutoff
+        if accumulation_dtype is None:
+            accumulation_dtype = dtypes.real_for(dtype)
+        self.accumulation_dtype = dtypes.normalize_type(accumulation_dtype)
 
     @property
     def modes(self):
@@ -202,12 +252,12 @@ class WavefunctionSet(WavefunctionSetMetadata):
 
     def __init__(self, thread, dtype, grid,
             components=1, trajectories=1, representation=REPR_CLASSICAL,
-            cutoff=None):
+            cutoff=None, accumulation_dtype=None):
 
         WavefunctionSetMetadata.__init__(
             self, thread, dtype, grid,
             components=components, trajectories=trajectories, representation=representation,
-            cutoff=cutoff)
+            cutoff=cutoff, accumulation_dtype=accumulation_dtype)
         self.data = thread.array(self.shape, dtype)
         self._multiply = get_multiply(self)
 
@@ -218,7 +268,8 @@ class WavefunctionSet(WavefunctionSetMetadata):
             components=wfs_meta.components,
             trajectories=wfs_meta.trajectories,
             representation=wfs_meta.representation,
-            cutoff=wfs_meta.cutoff)
+            cutoff=wfs_meta.cutoff,
+            accumulation_dtype=wfs_meta.accumulation_dtype)
 
     def fill_with(self, data):
         if isinstance(data, type(self.data)):
@@ -240,7 +291,8 @@ class WavefunctionSet(WavefunctionSetMetadata):
         wf = WavefunctionSet(
             self.thread, self.dtype, self.grid,
             components=self.components, trajectories=trajectories,
-            representation=self.representation, cutoff=self.cutoff)
+            representation=self.representation, cutoff=self.cutoff,
+            accumulation_dtype=self.accumulation_dtype)
         # FIXME: need to copy on the device
         # (will require some support for copy with broadcasting)
         wf.fill_with(self.data.get())
@@ -252,10 +304,11 @@ class WavefunctionSet(WavefunctionSetMetadata):
         wf = WavefunctionSet(
             self.thread, self.dtype, self.grid,
             components=self.components, trajectories=trajectories,
-            representation=REPR_WIGNER, cutoff=self.cutoff)
+            representation=REPR_WIGNER, cutoff=self.cutoff,
+            accumulation_dtype=self.accumulation_dtype)
         wcoh = WignerCoherent(self.grid, wf.data, self.data,
             cutoff=self.cutoff, seed=seed).compile(self.thread)
-        wcoh(wf.data, self.data)
+        wcoh(wf.data, self.data, 0)
         return wf
 
     def to_positivep_coherent(self, trajectories):
@@ -263,7 +316,8 @@ class WavefunctionSet(WavefunctionSetMetadata):
         wf = WavefunctionSet(
             self.thread, self.dtype, self.grid,
             components=self.components, trajectories=trajectories,
-            representation=REPR_POSITIVE_P, cutoff=self.cutoff)
+            representation=REPR_POSITIVE_P, cutoff=self.cutoff,
+            accumulation_dtype=self.accumulation_dtype)
         # FIXME: need to copy on the device
         # (will require some support for copy with broadcasting)
         wf.fill_with(self.data.get())
@@ -0,0 +1,38 @@
+import pytest
+
+import reikna.cluda as cluda
+
+from beclab import *
+
+from helpers import N, freqs, components, lattice_size
+
+
+def get_api():
+    for api_factory in (cluda.ocl_api, cluda.cuda_api):
+        try:
+            return api_factory()
+        except Exception:
+            pass
+    return None
+
+
+@pytest.fixture(scope='session')
+def thr():
+    api = get_api()
+    if api is None:
+        pytest.skip("Neither PyOpenCL nor PyCUDA is available")
+    return api.Thread.create()
+
+
+@pytest.fixture(scope='session')
+def system():
+    # Effective one-dimensional interactions for a tight transverse confinement
+    area = const.effective_area(components[0].m, 500., 500.)
+    interactions = const.scattering_matrix(
+        components, B=const.magical_field_Rb87_1m1_2p1) / area
+    return System(components, interactions, potential=HarmonicPotential(freqs))
+
+
+@pytest.fixture(scope='session')
+def grid(system):
+    return UniformGrid(lattice_size, box_for_tf(system, 0, N))
@@ -0,0 +1,64 @@
+"""
+Common parameters and reference implementations for the tests.
+"""
+
+import numpy
+
+from beclab import *
+
+
+# A small one-dimensional two-component system used by the tests.
+N = 2000
+freqs = (50.,)
+components = [const.rb87_1_minus1, const.rb87_2_1]
+lattice_size = (64,)
+
+
+def random_wfs(thr, grid, trajectories=4, components=2, dtype=numpy.complex128, seed=1234):
+    """
+    Returns a :py:class:`WavefunctionSet` filled with random data
+    and a numpy array with the same data.
+    """
+    rng = numpy.random.RandomState(seed)
+    wfs = WavefunctionSet(
+        thr, dtype, grid, components=components, trajectories=trajectories)
+    data = (
+        rng.normal(size=wfs.shape) + 1j * rng.normal(size=wfs.shape)).astype(dtype)
+    # Scaling to physically sensible populations
+    data *= numpy.sqrt(N / grid.V)
+    wfs.fill_with(data)
+    return wfs, data
+
+
+def reference_energy(data, grid, system):
+    """
+    Returns the energy of each trajectory of ``data``
+    (with the shape ``(trajectories, components) + grid.shape``), calculated with numpy.
+    """
+    axes = tuple(range(2, data.ndim))
+    ks = numpy.meshgrid(
+        *[2 * numpy.pi * numpy.fft.fftfreq(n, dx) for n, dx in zip(grid.shape, grid.dxs)],
+        indexing='ij')
+    ksquared = sum(k ** 2 for k in ks)
+
+    kinetic = (
+        -system.kinetic_coeff * grid.dV / grid.size
+        * (ksquared * numpy.abs(numpy.fft.fftn(data, axes=axes)) ** 2).sum(axes))
+
+    densities = numpy.abs(data) ** 2
+    potential = system.potential.get_array(grid, system.components)
+    potential_energy = (potential * densities).sum(axes) * grid.dV
+
+    interaction_energy = 0
+    for j in range(data.shape[1]):
+        for k in range(data.shape[1]):
+            interaction_energy = interaction_energy + (
+                system.interactions[j, k] / 2
+                * (densities[:,j] * densities[:,k]).sum(tuple(range(1, data.ndim - 1)))
+                * grid.dV)
+
+    return (kinetic + potential_energy).sum(1) + interaction_energy
+
+
+def populations(data, grid):
+    return (numpy.abs(data) ** 2).sum(tuple(range(2, data.ndim))) * grid.dV
@@ -0,0 +1,90 @@
+from __future__ import print_function, division
+
+import time
+
+import numpy
+
+import reikna.cluda as cluda
+
+from beclab import *
+from beclab.wavefunction import WavefunctionSet
+
+
+lattice_size = (16, 16, 128) # spatial lattice points
+trajectories = 64 # simulation paths
+interval = 0.02 # time interval
+samples = 20 # how many samples to take during simulation
+steps = samples * 50 # number of time steps (should be multiple of samples)
+freqs = (97.6, 97.6, 11.96)
+components = [const.rb87_1_minus1, const.rb87_2_1]
+N = 55000
+
+# (state dtype, accumulation dtype)
+precisions = [
+    (numpy.complex128, None),
+    (numpy.complex64, None),
+    (numpy.complex64, numpy.float64),
+    ]
+
+
+def run_test(thr, gs, system, state_dtype, accumulation_dtype, seed):
+
+    # Convert the ground state to the target precision
+    psi = WavefunctionSet(
+        thr, state_dtype, gs.grid, components=gs.components,
+        accumulation_dtype=accumulation_dtype)
+    psi.fill_with(gs.data.get().astype(state_dtype))
+    psi = psi.to_wigner_coherent(trajectories, seed=seed)
+
+    integrator = Integrator(psi, system)
+    samplers = dict(
+        N=PopulationSampler(psi),
+        E=EnergySampler(psi, system))
+
+    # Warm-up to exclude the compilation time
+    integrator.fixed_step(psi, 0, interval / samples, steps // samples, samplers=samplers)
+
+    thr.synchronize()
+    t1 = time.time()
+    result, info = integrator.fixed_step(
+        psi, 0, interval, steps, samples=samples, samplers=samplers)
+    thr.synchronize()
+    t2 = time.time()
+
+    return t2 - t1, result['N']['mean'][-1].sum(), result['E']['mean'][-1]
+
+
+if __name__ == '__main__':
+
+    api = cluda.ocl_api()
+    thr = api.Thread.create()
+
+    potential = HarmonicPotential(freqs)
+    scattering = const.scattering_matrix(components, B=const.magical_field_Rb87_1m1_2p1)
+    system = System(components, scattering, potential=potential)
+    grid = UniformGrid(lattice_size, box_for_tf(system, 0, N))
+
+    gs_gen = ImaginaryTimeGroundState(thr, numpy.complex128, grid, system, verbose=False)
+    gs = gs_gen([N, 0], E_diff=1e-7, E_conv=1e-9, sample_time=1e-4)
+
+    rng = numpy.random.RandomState(1234)
+    seed = rng.randint(0, 2**32-1)
+
+    results = [
+        run_test(thr, gs, system, state_dtype, accumulation_dtype, seed)
+        for state_dtype, accumulation_dtype in precisions]
+
+    ref_time, ref_N, ref_E = results[0]
+    for (state_dtype, accumulation_dtype), (t, N_final, E_final) in zip(precisions, results):
+        print(
+            numpy.dtype(state_dtype).name, "/",
+            "default" if accumulation_dtype is None else numpy.dtype(accumulation_dtype).name)
+        print("  time: {t:.3f} s (speedup {s:.2f})".format(t=t, s=ref_time / t))
+        print("  relative N error: {e:.3e}".format(e=abs(N_final - ref_N) / ref_N))
+        print("  relative E error: {e:.3e}".format(e=abs(E_final - ref_E) / abs(ref_E)))
+
+        # Without losses the population is conserved, and with a high precision accumulation
+        # the energy of the single precision run must be close to the double precision one.
+        assert abs(N_final - ref_N) / ref_N < 1e-5
+        E_tolerance = 1e-4 if accumulation_dtype is None else 1e-5
+        assert abs(E_final - ref_E) / abs(ref_E) < E_tolerance
@@ -0,0 +1,59 @@
+from __future__ import print_function, division
+
+import numpy
+
+import reikna.cluda as cluda
+
+from beclab import *
+
+
+lattice_size = (8, 8, 64) # spatial lattice points
+trajectories = 64 # simulation paths
+batch_size = 16 # trajectories per worker batch
+interval = 0.01 # time interval
+samples = 10 # how many samples to take during simulation
+steps = samples * 50 # number of time steps (should be multiple of samples)
+freqs = (97.6, 97.6, 11.96)
+components = [const.rb87_1_minus1, const.rb87_2_1]
+N = 55000
+seed = 1234
+
+
+def samplers(wfs_meta):
+    # Must be a module-level function to be passed to the worker processes.
+    return dict(N=PopulationSampler(wfs_meta))
+
+
+def integrate(system, grid, state, processes):
+    integrator = ParallelIntegrator(
+        system, grid, state, trajectories, batch_size,
+        samplers=samplers, seed=seed, processes=processes)
+    result, infos = integrator.fixed_step(0, interval, steps, samples=samples)
+    return result['N']['mean'][-1], result['N']['stderr'][-1]
+
+
+if __name__ == '__main__':
+
+    api = cluda.ocl_api()
+    thr = api.Thread.create()
+
+    potential = HarmonicPotential(freqs)
+    scattering = const.scattering_matrix(components, B=const.magical_field_Rb87_1m1_2p1)
+    system = System(components, scattering, potential=potential)
+    grid = UniformGrid(lattice_size, box_for_tf(system, 0, N))
+
+    gs_gen = ImaginaryTimeGroundState(thr, numpy.complex128, grid, system, verbose=False)
+    gs = gs_gen([N, 0], E_diff=1e-7, E_conv=1e-9, sample_time=1e-4)
+    state = gs.data.get()[0]
+
+    # The results must not depend on the number of workers.
+    N1, N1_err = integrate(system, grid, state, 1)
+    N4, N4_err = integrate(system, grid, state, 4)
+
+    print("1 worker: N =", N1, "+-", N1_err)
+    print("4 workers: N =", N4, "+-", N4_err)
+    print("Maximum relative difference:", (numpy.abs(N1 - N4) / N1.sum()).max())
+
+    # Every batch has its own noise stream, so only the order of summation may differ.
+    assert numpy.allclose(N1, N4, rtol=1e-12)
+    assert numpy.allclose(N1_err, N4_err, rtol=1e-8)
@@ -0,0 +1,72 @@
+from __future__ import print_function, division
+
+import numpy
+
+import reikna.cluda as cluda
+
+from beclab import *
+
+
+lattice_size = (8, 8, 64) # spatial lattice points
+interval = 0.02 # time interval
+samples = 20 # how many samples to take during simulation
+steps = samples * 50 # number of time steps (should be multiple of samples)
+freqs = (97.6, 97.6, 11.96)
+final_axial_freq = 6.0 # the axial frequency at the end of the decompression
+components = [const.rb87_1_minus1, const.rb87_2_1]
+N = 55000
+
+
+def make_system(axial_freq, frequency_ramps=None):
+    potential = HarmonicPotential(
+        freqs[:2] + (axial_freq,), frequency_ramps=frequency_ramps)
+    scattering = const.scattering_matrix(components, B=const.magical_field_Rb87_1m1_2p1)
+    return System(components, scattering, potential=potential)
+
+
+if __name__ == '__main__':
+
+    api = cluda.ocl_api()
+    thr = api.Thread.create()
+
+    system = make_system(freqs[2])
+    grid = UniformGrid(lattice_size, box_for_tf(system, 0, N))
+
+    gs_gen = ImaginaryTimeGroundState(thr, numpy.complex128, grid, system, verbose=False)
+    gs = gs_gen([N, 0], E_diff=1e-7, E_conv=1e-9, sample_time=1e-4)
+
+    # Linear decompression of the trap in a single integration call
+    ramp = Ramp([0, interval], [freqs[2], final_axial_freq])
+    ramp_system = make_system(freqs[2], frequency_ramps={2: ramp})
+
+    psi = gs.to_trajectories(1)
+    integrator = Integrator(psi, ramp_system)
+    samplers = dict(axial_density=DensityIntegralSampler(psi, axes=[0, 1], no_values=True))
+    result, info = integrator.fixed_step(
+        psi, 0, interval, steps, samples=samples, samplers=samplers)
+    ramped = result['axial_density']['mean'][-1]
+
+    # The same decompression as a sequence of integrations with constant frequencies,
+    # each one requiring a separate compilation.
+    psi = gs.to_trajectories(1)
+    for i in range(samples):
+        t_start = interval * i / samples
+        t_end = interval * (i + 1) / samples
+        step_system = make_system(ramp((t_start + t_end) / 2))
+        integrator = Integrator(psi, step_system)
+        samplers = dict(axial_density=DensityIntegralSampler(psi, axes=[0, 1], no_values=True))
+        result, info = integrator.fixed_step(
+            psi, t_start, t_end, steps // samples, samplers=samplers)
+    chained = result['axial_density']['mean'][-1]
+
+    difference = numpy.abs(ramped - chained).max() / numpy.abs(ramped).max()
+    print("Maximum relative difference of the axial densities:", difference)
+
+    # The chained integration approximates the linear ramp with a piecewise constant one,
+    # so the results are close, but not identical.
+    assert difference < 1e-2
+
+    # The decompression must actually change the density.
+    psi = gs.to_trajectories(1)
+    static = DensityIntegralSampler(psi, axes=[0, 1])(psi.data, 0)[0]
+    assert numpy.abs(ramped - static).max() / numpy.abs(ramped).max() > 10 * difference
@@ -0,0 +1,51 @@
+import numpy
+
+from beclab.cache import (
+    cached, clear_cache, set_cache_size, enable_binary_cache, _make_key)
+
+
+def test_scalar_keys():
+    keys = [_make_key(value, []) for value in (1, 1.0, True)]
+    assert len(set(keys)) == 3
+    assert _make_key({1: 2}, []) != _make_key({1: 2.0}, [])
+
+
+def test_lru_eviction():
+    clear_cache()
+    set_cache_size(2)
+    try:
+        calls = []
+        factory = lambda key: lambda: calls.append(key) or key
+
+        cached(factory('a'), 'a')
+        cached(factory('b'), 'b')
+        cached(factory('a'), 'a') # 'b' is now the least recently used
+        cached(factory('c'), 'c')
+        assert calls == ['a', 'b', 'c']
+
+        cached(factory('a'), 'a')
+        cached(factory('b'), 'b')
+        assert calls == ['a', 'b', 'c', 'b']
+    finally:
+        set_cache_size(256)
+        clear_cache()
+
+
+def test_binary_cache(thr, tmpdir):
+    src = """
+    KERNEL void fill(GLOBAL_MEM int *dest)
+    {
+        const SIZE_T i = get_global_id(0);
+        dest[i] = i;
+    }
+    """
+
+    for attempt in range(2):
+        # A separate thread, so that the compilation in other tests is not affected
+        thread = thr.api.Thread.create()
+        enable_binary_cache(thread, str(tmpdir))
+        program = thread.compile(src)
+        dest = thread.array(16, numpy.int32)
+        program.fill(dest, global_size=16)
+        assert (dest.get() == numpy.arange(16)).all()
+        assert len(tmpdir.listdir()) == 1
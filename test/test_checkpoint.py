@@ -0,0 +1,71 @@
+import numpy
+import pytest
+
+from beclab import *
+from beclab.samplers import PopulationSampler
+
+from helpers import N
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptingSampler(PopulationSampler):
+
+    def __init__(self, wfs_meta, t_interrupt):
+        PopulationSampler.__init__(self, wfs_meta)
+        self._t_interrupt = t_interrupt
+
+    def __call__(self, wfs_data, t):
+        if t >= self._t_interrupt:
+            raise Interrupted()
+        return PopulationSampler.__call__(self, wfs_data, t)
+
+
+def test_resume_bit_equality(thr, grid, system, tmpdir):
+    dtype = numpy.complex128
+    gs = ThomasFermiGroundState(thr, dtype, grid, system)([N, 0])
+    initial = gs.data.get()
+    # Move the state out of equilibrium
+    initial = numpy.concatenate([initial[:,:1], initial[:,:1]], axis=1) / numpy.sqrt(2)
+
+    wfs = WavefunctionSet(thr, dtype, grid, components=2)
+    integrator = Integrator(wfs, system)
+
+    # The step and the sampling times are exactly representable,
+    # so the segments start at the same times as the samples of the plain integration.
+    t_end = 2. ** -10
+    args = (0, t_end, 64)
+    kwds = dict(samples=8)
+
+    wfs.fill_with(initial)
+    reference, _ = integrator.fixed_step(
+        wfs, *args, samplers=dict(N=PopulationSampler(wfs)), **kwds)
+    reference_data = wfs.data.get()
+
+    path = str(tmpdir.join('checkpoint'))
+    checkpointed = CheckpointedIntegrator(integrator, path)
+
+    wfs.fill_with(initial)
+    with pytest.raises(Interrupted):
+        checkpointed.fixed_step(
+            wfs, *args, checkpoint_samples=2,
+            samplers=dict(N=InterruptingSampler(wfs, t_end * 5 / 8)), **kwds)
+
+    wfs.fill_with(numpy.zeros_like(initial))
+    result, infos = checkpointed.fixed_step(
+        wfs, *args, checkpoint_samples=2, resume=True,
+        samplers=dict(N=PopulationSampler(wfs)), **kwds)
+
+    # Two segments were finished before the interruption
+    assert len(infos) == 2
+    assert (wfs.data.get() == reference_data).all()
+    for field in reference['N']:
+        if reference['N'][field] is None:
+            assert result['N'][field] is None
+        else:
+            assert (result['N'][field] == reference['N'][field]).all()
+
+    # The checkpoint and the segment files are removed after the integration is finished
+    assert tmpdir.listdir() == []
@@ -0,0 +1,73 @@
+import numpy
+
+from beclab import *
+from beclab.filters import NormalizationFilter, FreezeFilter
+
+from helpers import random_wfs, populations
+
+
+def test_normalization(thr, grid):
+    wfs, data = random_wfs(thr, grid)
+    target_Ns = [1000., 500.]
+
+    NormalizationFilter(wfs, target_Ns)(wfs.data, 0)
+
+    Ns = populations(wfs.data.get(), grid)
+    assert numpy.allclose(Ns.mean(0), target_Ns, rtol=1e-10)
+    # The relative populations of the trajectories are preserved.
+    assert numpy.allclose(Ns / Ns.mean(0), populations(data, grid) / populations(data, grid).mean(0))
+
+
+def test_normalization_per_trajectory(thr, grid):
+    wfs, data = random_wfs(thr, grid)
+    target_Ns = numpy.array([[1000., 500.], [2000., 0.], [10., 20.], [0., 0.]])
+
+    NormalizationFilter(wfs, target_Ns)(wfs.data, 0)
+
+    assert numpy.allclose(populations(wfs.data.get(), grid), target_Ns, rtol=1e-10)
+
+
+def test_normalization_targets_at_runtime(thr, grid):
+    wfs, data = random_wfs(thr, grid)
+
+    filter1 = NormalizationFilter(wfs, [1000., 500.])
+    filter2 = NormalizationFilter(wfs, [10., 20.])
+    # The targets are not compiled in
+    assert filter1._normalize is filter2._normalize
+
+    filter1.set_targets([30., 40.])
+    filter1(wfs.data, 0)
+    assert numpy.allclose(populations(wfs.data.get(), grid).mean(0), [30., 40.], rtol=1e-10)
+
+
+def test_freeze(thr, grid):
+    wfs, data = random_wfs(thr, grid)
+    freeze_filter = FreezeFilter(wfs)
+    freeze_filter.freeze(wfs.data, [1, 3])
+
+    new_data = data * 2
+    wfs.fill_with(new_data)
+    freeze_filter(wfs.data, 0)
+
+    result = wfs.data.get()
+    assert (result[[0, 2]] == new_data[[0, 2]]).all()
+    assert (result[[1, 3]] == data[[1, 3]]).all()
+
+
+def test_freeze_incremental(thr, grid):
+    wfs, data = random_wfs(thr, grid)
+    freeze_filter = FreezeFilter(wfs)
+    freeze_filter.freeze(wfs.data, [1, 3])
+
+    wfs.fill_with(data * 2)
+    freeze_filter(wfs.data, 0)
+    # Only the trajectory 0 is copied, the snapshots of 1 and 3 stay the same
+    freeze_filter.freeze(wfs.data, [0])
+
+    wfs.fill_with(data * 3)
+    freeze_filter(wfs.data, 0)
+
+    result = wfs.data.get()
+    assert (result[0] == data[0] * 2).all()
+    assert (result[[1, 3]] == data[[1, 3]]).all()
+    assert (result[2] == data[2] * 3).all()
@@ -0,0 +1,157 @@
+import numpy
+
+from beclab import *
+from beclab.bec import _UpsampleSpectral, upsample_spectral
+from beclab.meters import HamiltonianMeter
+
+from helpers import N, freqs, populations, random_wfs
+
+
+dtype = numpy.complex128
+Ns = [N, N / 2]
+tolerances = dict(E_diff=1e-10, E_conv=1e-10, sample_time=1e-4)
+
+
+def test_thomas_fermi(thr, grid, system):
+    gs_gen = ThomasFermiGroundState(thr, dtype, grid, system)
+    gs = gs_gen(Ns)
+    assert numpy.allclose(populations(gs.data.get(), grid)[0], Ns, rtol=1e-10)
+
+
+def test_imaginary_time(thr, grid, system):
+    gs_gen = ImaginaryTimeGroundState(thr, dtype, grid, system, verbose=False)
+    gs = gs_gen(Ns, **tolerances)
+
+    assert numpy.allclose(populations(gs.data.get(), grid)[0], Ns, rtol=1e-10)
+
+    # A converged state is stationary
+    E, mus, r = HamiltonianMeter(gs, system, residual=True)(gs.data)
+    assert r[0] < 1e-3
+
+
+def test_imaginary_time_real(thr, grid, system):
+    gs_gen = ImaginaryTimeGroundState(thr, dtype, grid, system, verbose=False)
+    gs = gs_gen(Ns, **tolerances)
+
+    real_gen = ImaginaryTimeGroundState(thr, dtype, grid, system, verbose=False, real=True)
+    real_gs = real_gen(Ns, **tolerances)
+
+    data = gs.data.get()
+    real_data = real_gs.data.get()
+    assert (real_data.imag == 0).all()
+    assert numpy.abs(real_data - data).max() < 1e-4 * numpy.abs(data).max()
+
+
+def test_gradient(thr, grid, system):
+    meter = lambda gs: HamiltonianMeter(gs, system)(gs.data)
+
+    gs_gen = ImaginaryTimeGroundState(thr, dtype, grid, system, verbose=False)
+    E_ref, mus_ref, _ = meter(gs_gen(Ns, **tolerances))
+
+    gr_gen = GradientGroundState(thr, dtype, grid, system, verbose=False)
+    gs, result, info = gr_gen(
+        Ns, E_diff=1e-12, residual_limit=1e-6, return_info=True,
+        E_conv=tolerances['E_conv'], sample_time=tolerances['sample_time'])
+    E, mus, _ = meter(gs)
+
+    assert info.gradient_converged
+    # The same results as the ones of ImaginaryTimeGroundState
+    assert 'E' in result and len(info.steps) > 0
+    assert numpy.allclose(populations(gs.data.get(), grid)[0], Ns, rtol=1e-10)
+    assert numpy.allclose(E, E_ref, rtol=1e-6)
+    assert numpy.allclose(mus, mus_ref, rtol=1e-5)
+
+
+def test_multigrid(thr, grid, system):
+    meter = lambda gs: HamiltonianMeter(gs, system)(gs.data)
+
+    gs_gen = ImaginaryTimeGroundState(thr, dtype, grid, system, verbose=False)
+    E_ref, mus_ref, _ = meter(gs_gen(Ns, **tolerances))
+
+    mg_gen = MultigridGroundState(thr, dtype, grid, system, levels=2, verbose=False)
+    E, mus, _ = meter(mg_gen(Ns, **tolerances))
+
+    assert numpy.allclose(E, E_ref, rtol=1e-6)
+    assert numpy.allclose(mus, mus_ref, rtol=1e-5)
+
+
+def test_upsample_spectral(thr, grid):
+    coarse_grid = UniformGrid((grid.shape[0] // 2 + 1,), grid.box)
+    coarse, data = random_wfs(thr, coarse_grid, trajectories=1, dtype=numpy.complex64)
+    fine = WavefunctionSet(thr, dtype, grid, components=2)
+
+    upsample = thr.compile(_UpsampleSpectral(coarse, fine))
+    upsample(fine.data, coarse.data)
+
+    reference = upsample_spectral(data.astype(dtype), grid.shape)
+    assert numpy.abs(fine.data.get() - reference).max() < 1e-5 * numpy.abs(reference).max()
+
+
+def test_batched(thr, grid, system):
+    Ns_list = [[N, 0], [N / 2, N / 2], [N / 4, N]]
+    gs_gen = ImaginaryTimeGroundState(thr, dtype, grid, system, verbose=False)
+
+    batch = gs_gen.batched(Ns_list, **tolerances)
+    batch_data = batch.data.get()
+    assert numpy.allclose(populations(batch_data, grid), Ns_list, rtol=1e-10)
+
+    E_batch, _, _ = HamiltonianMeter(batch, system)(batch.data)
+    for i, Ns_single in enumerate(Ns_list):
+        gs = gs_gen(Ns_single, **tolerances)
+        E, _, _ = HamiltonianMeter(gs, system)(gs.data)
+        assert numpy.allclose(E_batch[i], E[0], rtol=1e-6)
+
+
+def test_batched_zero_populations(thr, grid, system):
+    Ns_list = [[N, N / 2], [0, 0]]
+    gs_gen = ImaginaryTimeGroundState(thr, dtype, grid, system, verbose=False)
+
+    # The trajectory with zero populations has zero energy,
+    # and must be considered converged for the propagation to stop.
+    batch, result, _ = gs_gen.batched(Ns_list, return_info=True, **tolerances)
+    batch_data = batch.data.get()
+
+    assert numpy.isfinite(result['E']['mean']).all()
+    assert numpy.allclose(populations(batch_data, grid), Ns_list, rtol=1e-10)
+    assert (batch_data[1] == 0).all()
+
+
+def test_thomas_fermi_batched(thr, grid, system):
+    Ns_list = [[N, 0], [N / 2, N / 2], [0, 0]]
+    tf_gen = ThomasFermiGroundState(thr, dtype, grid, system)
+
+    batch_data = tf_gen.batched(Ns_list).data.get()
+    for i, Ns_single in enumerate(Ns_list):
+        assert numpy.allclose(batch_data[i], tf_gen(Ns_single).data.get()[0], rtol=1e-12)
+
+
+def test_warm_start_lookup(thr, grid, system, tmpdir):
+    gs_gen = ImaginaryTimeGroundState(
+        thr, dtype, grid, system, verbose=False, cache_dir=str(tmpdir))
+    gs = gs_gen(Ns, **tolerances)
+    assert gs_gen._has_cached_state(Ns, **tolerances)
+
+    # The closest state is found by the file name only
+    path = gs_gen._find_warm_start([N * 1.1, N / 2])
+    assert path is not None
+    assert gs_gen._find_warm_start([N, N / 2, 1]) is None
+    assert gs_gen._find_warm_start([N * 1e-10, N / 2]) == path
+
+
+def test_batched_real(thr, grid, system):
+    # A single component, for which the trajectories are packed
+    system_1c = System(
+        system.components[:1], system.interactions[:1, :1],
+        potential=HarmonicPotential(freqs))
+    Ns_list = [[N], [N / 2], [N / 4]]
+
+    gs_gen = ImaginaryTimeGroundState(thr, dtype, grid, system_1c, verbose=False)
+    real_gen = ImaginaryTimeGroundState(thr, dtype, grid, system_1c, verbose=False, real=True)
+    batch = gs_gen.batched(Ns_list, **tolerances)
+    real_batch = real_gen.batched(Ns_list, **tolerances)
+
+    data = batch.data.get()
+    real_data = real_batch.data.get()
+    assert (real_data.imag == 0).all()
+    assert numpy.allclose(populations(real_data, grid), Ns_list, rtol=1e-10)
+    assert numpy.abs(real_data - data).max() < 1e-4 * numpy.abs(data).max()
@@ -0,0 +1,31 @@
+import numpy
+import pytest
+
+from beclab import *
+from beclab.samplers import PopulationSampler
+
+from helpers import N
+
+
+def test_chunked_prefetch(thr, grid, system):
+    dtype = numpy.complex128
+    gs = ThomasFermiGroundState(thr, dtype, grid, system)([N, 0])
+
+    results = []
+    for prefetch in (False, True):
+        chunked = ChunkedIntegrator(
+            gs, system, 8, 2, seed=123, prefetch=prefetch,
+            samplers=lambda wfs_meta: dict(N=PopulationSampler(wfs_meta)))
+        result, infos = chunked.fixed_step(0, 1e-5, 4, samples=2)
+        assert len(infos) == 4
+        results.append(result)
+
+    # The initial state of a chunk does not depend on the buffer it was prepared in
+    assert (results[0]['N']['values'] == results[1]['N']['values']).all()
+
+
+def test_array_potential_size():
+    # 8192 values fit into the constant memory in double precision
+    ArrayPotential(numpy.zeros((2, 4096)))
+    with pytest.raises(ValueError):
+        ArrayPotential(numpy.zeros((2, 128, 128)))
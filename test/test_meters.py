@@ -0,0 +1,187 @@
+import numpy
+
+from beclab import *
+from beclab.meters import (
+    DensityIntegralMeter, OverlapMeter, VisibilityMeter, EnergyMeter, HamiltonianMeter,
+    MeterGroup, EnsembleStatisticsMeter, AsyncMeter)
+
+from beclab.packing import get_pack, get_unpack, get_packed_meta
+
+from helpers import random_wfs, reference_energy, populations
+
+
+def test_density_integral(thr, grid):
+    wfs, data = random_wfs(thr, grid)
+    Ns = DensityIntegralMeter(wfs)(wfs.data)
+    assert numpy.allclose(Ns, populations(data, grid), rtol=1e-10)
+
+
+def test_overlap(thr, grid):
+    wfs, data = random_wfs(thr, grid)
+    Is = OverlapMeter(wfs, comp1=0, comp2=1)(wfs.data)
+    reference = (data[:,0].conj() * data[:,1]).sum(1) * grid.dV
+    assert numpy.allclose(Is, reference, rtol=1e-10)
+
+
+def test_visibility(thr, grid):
+    wfs, data = random_wfs(thr, grid)
+    Ns, Is = VisibilityMeter(wfs, comp1=0, comp2=1)(wfs.data)
+    assert numpy.allclose(Ns, populations(data, grid), rtol=1e-10)
+    assert numpy.allclose(Is, (data[:,0].conj() * data[:,1]).sum(1) * grid.dV, rtol=1e-10)
+
+
+def test_energy(thr, grid, system):
+    wfs, data = random_wfs(thr, grid)
+    reference = reference_energy(data, grid, system)
+
+    E = EnergyMeter(wfs, system)(wfs.data)
+    assert numpy.allclose(E, reference, rtol=1e-10)
+
+    E, mus, _ = HamiltonianMeter(wfs, system)(wfs.data)
+    assert numpy.allclose(E, reference, rtol=1e-10)
+
+
+def test_energy_mixed_precision(thr, grid, system):
+    wfs, data = random_wfs(thr, grid, dtype=numpy.complex64)
+    wfs_mixed = WavefunctionSet(
+        thr, numpy.complex64, grid, components=2, trajectories=4,
+        accumulation_dtype=numpy.float64)
+    wfs_mixed.fill_with(data)
+
+    reference = reference_energy(data.astype(numpy.complex128), grid, system)
+    E_single = EnergyMeter(wfs, system)(wfs.data)
+    E_mixed = EnergyMeter(wfs_mixed, system)(wfs_mixed.data)
+
+    assert E_mixed.dtype == numpy.float64
+    assert numpy.allclose(E_single, reference, rtol=1e-4)
+    assert numpy.allclose(E_mixed, reference, rtol=1e-5)
+
+
+def test_meter_group(thr, grid, system):
+    wfs, data = random_wfs(thr, grid)
+    meters = [
+        DensityIntegralMeter(wfs),
+        OverlapMeter(wfs, comp1=0, comp2=1),
+        EnergyMeter(wfs, system)]
+    results = MeterGroup(wfs, meters)(wfs.data)
+    for meter, result in zip(meters, results):
+        assert numpy.allclose(result, meter(wfs.data), rtol=1e-12)
+
+
+def test_ensemble_statistics(thr, grid):
+    wfs, data = random_wfs(thr, grid, trajectories=16)
+    meter = DensityIntegralMeter(wfs)
+    mean, stderr, values = EnsembleStatisticsMeter(wfs, meter, keep_trajectories=2)(wfs.data)
+
+    reference = populations(data, grid)
+    assert numpy.allclose(mean, reference.mean(0), rtol=1e-10)
+    assert numpy.allclose(stderr, reference.std(0) / numpy.sqrt(16), rtol=1e-6)
+    assert numpy.allclose(values, reference[:2], rtol=1e-10)
+
+
+def test_async_meter(thr, grid):
+    wfs, data = random_wfs(thr, grid)
+    meter = DensityIntegralMeter(wfs)
+    async_meter = AsyncMeter(wfs, meter, buffers=2)
+
+    ts = [0., 1., 2.]
+    for t in ts:
+        async_meter(wfs.data, t)
+    results = async_meter.collect()
+    async_meter.release()
+
+    assert [t for t, _ in results] == ts
+    for _, value in results:
+        assert numpy.allclose(value, populations(data, grid), rtol=1e-10)
+
+    # The meter can be reused after the release
+    async_meter(wfs.data, 3.)
+    assert [t for t, _ in async_meter.collect()] == [3.]
+    async_meter.release()
+
+
+def test_overlap_mixed_precision(thr, grid):
+    wfs, data = random_wfs(thr, grid, dtype=numpy.complex64)
+    wfs_mixed = WavefunctionSet(
+        thr, numpy.complex64, grid, components=2, trajectories=4,
+        accumulation_dtype=numpy.float64)
+    wfs_mixed.fill_with(data)
+
+    data = data.astype(numpy.complex128)
+    reference = (data[:,0].conj() * data[:,1]).sum(1) * grid.dV
+
+    Is = OverlapMeter(wfs_mixed, comp1=0, comp2=1)(wfs_mixed.data)
+    assert Is.dtype == numpy.complex128
+    assert numpy.allclose(Is, reference, rtol=1e-10)
+
+    Ns, Is = VisibilityMeter(wfs_mixed, comp1=0, comp2=1)(wfs_mixed.data)
+    assert Ns.dtype == numpy.float64
+    assert numpy.allclose(Ns, populations(data, grid), rtol=1e-10)
+    assert numpy.allclose(Is, reference, rtol=1e-10)
+
+
+def test_energy_parameter_sweep(thr, grid, system):
+    wfs, data = random_wfs(thr, grid)
+
+    # A sweep over the inter-species interaction, one value per trajectory
+    g12s = system.interactions[0, 1] * numpy.linspace(0.5, 1.5, wfs.trajectories)
+    interactions = numpy.array([system.interactions] * wfs.trajectories)
+    interactions[:, 0, 1] = g12s
+    interactions[:, 1, 0] = g12s
+
+    reference = numpy.array([
+        reference_energy(
+            data[i:i+1], grid,
+            System(system.components, interactions[i], potential=system.potential))[0]
+        for i in range(wfs.trajectories)])
+
+    parameters = SystemParameters(wfs, system)
+    parameters.set_interactions(interactions)
+    meter = EnergyMeter(wfs, system, parameters=parameters)
+    assert numpy.allclose(meter(wfs.data), reference, rtol=1e-10)
+
+    # The runtime arguments are passed by the wrapping meters
+    _, E = MeterGroup(wfs, [DensityIntegralMeter(wfs), meter])(wfs.data)
+    assert numpy.allclose(E, reference, rtol=1e-10)
+
+    mean, _, _ = EnsembleStatisticsMeter(wfs, meter)(wfs.data)
+    assert numpy.allclose(mean, reference.mean(), rtol=1e-10)
+
+    # Changing the values does not require a new computation
+    other = EnergyMeter(wfs, system, parameters=SystemParameters(wfs, system))
+    assert other.computation is meter.computation
+    assert numpy.allclose(other(wfs.data), reference_energy(data, grid, system), rtol=1e-10)
+
+
+def test_energy_ramps(thr, grid, system):
+    wfs, data = random_wfs(thr, grid)
+    g12 = system.interactions[0, 1]
+    ramped = System(
+        system.components, system.interactions, potential=system.potential,
+        interaction_ramps={(0, 1): Ramp([0., 1e-3], [g12, 2 * g12])})
+
+    for t in (0., 5e-4, 2e-3):
+        static = System(
+            system.components, ramped.get_interactions(t), potential=system.potential)
+        reference = reference_energy(data, grid, static)
+
+        E = EnergyMeter(wfs, ramped)(wfs.data, t)
+        assert numpy.allclose(E, reference, rtol=1e-10)
+
+        E, _, _ = HamiltonianMeter(wfs, ramped)(wfs.data, t)
+        assert numpy.allclose(E, reference, rtol=1e-10)
+
+
+def test_hamiltonian_packed(thr, grid, system):
+    wfs, _ = random_wfs(thr, grid)
+    packed = thr.empty_like(get_packed_meta(wfs).data)
+    thr.compile(get_pack(wfs))(packed, wfs.data)
+    # The imaginary parts are discarded by the packing
+    thr.compile(get_unpack(wfs))(wfs.data, packed)
+
+    E_ref, mus_ref, r_ref = HamiltonianMeter(wfs, system, residual=True)(wfs.data)
+    E, mus, r = HamiltonianMeter(wfs, system, residual=True, packed=True)(packed)
+
+    assert numpy.allclose(E, E_ref, rtol=1e-10)
+    assert numpy.allclose(mus, mus_ref, rtol=1e-10)
+    assert numpy.allclose(r, r_ref, rtol=1e-10)
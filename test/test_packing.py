@@ -0,0 +1,71 @@
+import numpy
+
+from beclab import *
+from beclab.filters import PackedNormalizationFilter
+from beclab.packing import (
+    get_pack, get_unpack, get_packed_meta, get_packing_axis,
+    PACK_COMPONENTS, PACK_TRAJECTORIES)
+
+from helpers import random_wfs, populations
+
+
+def pack(thr, wfs):
+    packed = thr.empty_like(get_packed_meta(wfs).data)
+    thr.compile(get_pack(wfs))(packed, wfs.data)
+    return packed
+
+
+def test_packed_size(thr, grid):
+    # (trajectories, components) -> (packing axis, the number of packed fields)
+    expected = {
+        (1, 1): (PACK_COMPONENTS, 1),
+        (1, 2): (PACK_COMPONENTS, 1),
+        (1, 3): (PACK_COMPONENTS, 2),
+        (4, 1): (PACK_TRAJECTORIES, 2),
+        (3, 1): (PACK_TRAJECTORIES, 2),
+        (4, 3): (PACK_TRAJECTORIES, 6),
+        (4, 2): (PACK_COMPONENTS, 4),
+    }
+    for (trajectories, components), (axis, packed_fields) in expected.items():
+        wfs_meta = WavefunctionSet(
+            thr, numpy.complex128, grid, components=components, trajectories=trajectories)
+        packed_meta = get_packed_meta(wfs_meta)
+        assert get_packing_axis(wfs_meta) == axis
+        assert packed_meta.trajectories * packed_meta.components == packed_fields
+        assert packed_meta.data.shape[2:] == wfs_meta.data.shape[2:]
+
+
+def test_pack_trajectories(thr, grid):
+    # A single component can only be packed along the trajectories
+    wfs, data = random_wfs(thr, grid, trajectories=3, components=1)
+    packed = pack(thr, wfs)
+    assert packed.shape == (2, 1) + grid.shape
+
+    packed_data = packed.get()
+    assert (packed_data[:, 0].real == data[::2, 0].real).all()
+    assert (packed_data[0, 0].imag == data[1, 0].real).all()
+    # The imaginary part of the last packed trajectory is unused
+    assert (packed_data[1, 0].imag == 0).all()
+
+    wfs.fill_with(numpy.zeros_like(data))
+    thr.compile(get_unpack(wfs))(wfs.data, packed)
+    assert (wfs.data.get() == data.real).all()
+
+
+def test_packed_normalization(thr, grid):
+    for trajectories, components in ((3, 1), (1, 3)):
+        wfs, data = random_wfs(thr, grid, trajectories=trajectories, components=components)
+        packed = pack(thr, wfs)
+        unpack = thr.compile(get_unpack(wfs))
+
+        target_Ns = numpy.arange(1, components + 1) * 100.
+        PackedNormalizationFilter(wfs, target_Ns)(packed, 0)
+        unpack(wfs.data, packed)
+        assert numpy.allclose(
+            populations(wfs.data.get(), grid).mean(0), target_Ns, rtol=1e-10)
+
+        target_Ns = numpy.arange(1, trajectories * components + 1).reshape(
+            trajectories, components) * 100.
+        PackedNormalizationFilter(wfs, target_Ns)(packed, 0)
+        unpack(wfs.data, packed)
+        assert numpy.allclose(populations(wfs.data.get(), grid), target_Ns, rtol=1e-10)
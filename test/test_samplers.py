@@ -0,0 +1,55 @@
+import numpy
+
+from beclab import *
+
+from helpers import random_wfs, populations
+
+
+def test_sampler_group(thr, grid):
+    wfs, data = random_wfs(thr, grid)
+    group = SamplerGroup(wfs, dict(
+        N=PopulationSampler(wfs),
+        density=DensityIntegralSampler(wfs, axes=[0]))).samplers
+
+    N_ref = populations(data, grid)
+    assert numpy.allclose(group['N'](wfs.data, 0), N_ref, rtol=1e-10)
+
+    # Calling a proxy again at the same time makes a new measurement
+    wfs.fill_with(data * 2)
+    assert numpy.allclose(group['N'](wfs.data, 0), N_ref * 4, rtol=1e-10)
+
+    # The other proxies get the values measured at the same time,
+    # regardless of the order of the calls
+    assert numpy.allclose(group['density'](wfs.data, 0), N_ref * 4, rtol=1e-10)
+    assert numpy.allclose(group['N'](wfs.data, 1), N_ref * 4, rtol=1e-10)
+
+
+def test_ensemble_statistics_sampler(thr, grid, system):
+    wfs, _ = random_wfs(thr, grid, trajectories=16)
+    integrator = Integrator(wfs, system)
+
+    samplers = dict(
+        N=PopulationSampler(wfs),
+        N_stats=EnsembleStatisticsSampler(wfs, PopulationSampler(wfs), keep_trajectories=2))
+    result, _ = integrator.fixed_step(wfs, 0, 1e-5, 4, samples=2, samplers=samplers)
+
+    stats = result['N_stats']
+    assert (stats['time'] == result['N']['time']).all()
+    assert numpy.allclose(stats['mean'], result['N']['mean'], rtol=1e-10)
+    assert numpy.allclose(stats['stderr'], result['N']['stderr'], rtol=1e-6)
+    assert numpy.allclose(stats['values'], result['N']['values'][:, :2], rtol=1e-10)
+
+
+def test_async_sampler(thr, grid, system):
+    wfs, _ = random_wfs(thr, grid)
+    integrator = Integrator(wfs, system)
+
+    samplers = dict(
+        N=PopulationSampler(wfs),
+        N_async=AsyncSampler(wfs, PopulationSampler(wfs)))
+    result, _ = integrator.fixed_step(wfs, 0, 1e-5, 4, samples=2, samplers=samplers)
+    samplers['N_async'].release()
+
+    async_result = result['N_async']
+    assert numpy.allclose(async_result['time'], result['N']['time'])
+    assert numpy.allclose(async_result['values'], result['N']['values'], rtol=1e-10)
@@ -80,7 +80,7 @@ def run_test(thr, stepper_cls, integration, use_cutoff=False, no_losses=False, w
     bs = BeamSplitter(psi, f_detuning=f_detuning, f_rabi=f_rabi)
     n_sampler = DensityIntegralSampler(psi, beam_splitter=bs, theta=numpy.pi / 2)
     ax_sampler = DensityIntegralSampler(psi, axes=(0, 1), beam_splitter=bs, theta=numpy.pi / 2)
-    samplers = dict(N=n_sampler, axial_density=ax_sampler)
+    samplers = SamplerGroup(psi, dict(N=n_sampler, axial_density=ax_sampler)).samplers
 
     # Integrate
     bs(psi.data, 0, numpy.pi / 2)